@@ -0,0 +1,124 @@
+import json
+
+import numpy as np
+
+# === CONFIGURATION ===
+CLUSTER_RADIUS = 64  # cluster cell size in screen pixels, the same at every zoom
+CLUSTER_MIN_ZOOM = -5  # the map's minZoom
+CLUSTER_MAX_ZOOM = 0  # deepest zoom served as clusters; individual palms above it
+COL_OFFSET = 1 << 31
+
+
+def cell_size(zoom):
+    # Map units per cell: CRS.Simple draws 2**zoom screen pixels per unit
+    return CLUSTER_RADIUS * 2.0 ** -zoom
+
+
+def cell_keys(rows, cols):
+    # Row-major int64 keys with no fixed grid width, so cells may go negative
+    return (rows << 32) + (cols + COL_OFFSET)
+
+
+class ClusterIndex:
+    """Per-zoom grid clusters with counts, centroids and class breakdowns.
+
+    Cells double in size from one zoom to the next coarser one, so each cell
+    nests in exactly one cell per coarser zoom: levels are built bottom-up
+    by grouping child cells, and adding or removing a point touches one
+    cell per level.
+    """
+
+    def __init__(self, x, y, cls, class_names):
+        self.class_names = class_names
+        self.class_json = [json.dumps(name) for name in class_names]
+        classes = np.zeros((len(x), len(class_names)), dtype=np.int64)
+        known = np.flatnonzero(cls >= 0)
+        classes[known, cls[known]] = 1
+
+        size = cell_size(CLUSTER_MAX_ZOOM)
+        rows, cols = np.floor(y / size).astype(np.int64), np.floor(x / size).astype(np.int64)
+        level = self._group(rows, cols, np.ones(len(x), dtype=np.int64), x, y, classes)
+        self.levels = {CLUSTER_MAX_ZOOM: level}
+        for zoom in range(CLUSTER_MAX_ZOOM - 1, CLUSTER_MIN_ZOOM - 1, -1):
+            rows, cols = level["keys"] >> 32, (level["keys"] & 0xFFFFFFFF) - COL_OFFSET
+            level = self._group(rows // 2, cols // 2, level["count"], level["sx"], level["sy"], level["classes"])
+            self.levels[zoom] = level
+
+    @staticmethod
+    def _group(rows, cols, count, sx, sy, classes):
+        keys, inverse = np.unique(cell_keys(rows, cols), return_inverse=True)
+        n = len(keys)
+        return {
+            "keys": keys,
+            "count": np.bincount(inverse, weights=count, minlength=n).astype(np.int64),
+            "sx": np.bincount(inverse, weights=sx, minlength=n),
+            "sy": np.bincount(inverse, weights=sy, minlength=n),
+            "classes": np.stack([np.bincount(inverse, weights=classes[:, j], minlength=n)
+                                 for j in range(classes.shape[1])], axis=1).astype(np.int64),
+            "encoded": [None] * n,
+        }
+
+    def level(self, zoom):
+        return min(max(int(np.floor(zoom)), CLUSTER_MIN_ZOOM), CLUSTER_MAX_ZOOM)
+
+    # === Incremental updates ===
+    def update(self, x, y, cls, weight):
+        # Add (weight 1) or remove (weight -1) points at every level
+        classes = np.zeros((len(x), len(self.class_names)), dtype=np.int64)
+        known = np.flatnonzero(cls >= 0)
+        classes[known, cls[known]] = weight[known]
+        for zoom, level in self.levels.items():
+            size = cell_size(zoom)
+            delta = self._group(np.floor(y / size).astype(np.int64), np.floor(x / size).astype(np.int64),
+                                weight, weight * x, weight * y, classes)
+            # Insert cells the level lacks, add the deltas in place, drop emptied cells
+            pos = np.searchsorted(level["keys"], delta["keys"])
+            missing = pos == len(level["keys"])
+            missing[~missing] = level["keys"][pos[~missing]] != delta["keys"][~missing]
+            if missing.any():
+                level["keys"] = np.insert(level["keys"], pos[missing], delta["keys"][missing])
+                for name in ("count", "sx", "sy", "classes"):
+                    level[name] = np.insert(level[name], pos[missing], 0, axis=0)
+                pos = np.searchsorted(level["keys"], delta["keys"])
+            for name in ("count", "sx", "sy", "classes"):
+                level[name][pos] += delta[name]
+            emptied = pos[level["count"][pos] <= 0]
+            if len(emptied):
+                for name in ("keys", "count", "sx", "sy", "classes"):
+                    level[name] = np.delete(level[name], emptied, axis=0)
+            if missing.any() or len(emptied):
+                level["encoded"] = [None] * len(level["keys"])
+            else:
+                for i in pos.tolist():
+                    level["encoded"][i] = None
+
+    # === Queries ===
+    def query(self, zoom, bbox=None):
+        # Cell indices at zoom's level that overlap bbox = (west, south, east, north)
+        level = self.levels[self.level(zoom)]
+        keys = level["keys"]
+        if bbox is None or not len(keys):
+            return np.arange(len(keys))
+        size = cell_size(self.level(zoom))
+        west, south, east, north = (int(np.floor(v / size)) for v in bbox)
+        rows = np.arange(max(south, int(keys[0] >> 32)), min(north, int(keys[-1] >> 32)) + 1, dtype=np.int64)
+        starts = np.searchsorted(keys, cell_keys(rows, np.int64(west)), side="left")
+        ends = np.searchsorted(keys, cell_keys(rows, np.int64(east)), side="right")
+        lengths = ends - starts
+        if not len(rows) or not lengths.sum():
+            return np.empty(0, dtype=np.intp)
+        return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+    def features(self, zoom, bbox=None):
+        # Encoded cluster features at the centroid of their points
+        level = self.levels[self.level(zoom)]
+        count, sx, sy, classes, encoded = (level[k] for k in ("count", "sx", "sy", "classes", "encoded"))
+        idx = self.query(zoom, bbox).tolist()
+        for i in idx:
+            if encoded[i] is None:
+                n = int(count[i])
+                breakdown = ",".join("%s:%d" % (name, c) for name, c in zip(self.class_json, classes[i].tolist()))
+                encoded[i] = ('{"type":"Feature","geometry":{"type":"Point","coordinates":[%r,%r]},'
+                              '"properties":{"cluster":true,"point_count":%d,"classes":{%s}}}'
+                              % (float(sx[i]) / n, float(sy[i]) / n, n, breakdown))
+        return [encoded[i] for i in idx]
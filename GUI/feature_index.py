@@ -0,0 +1,462 @@
+import os
+import copy
+import gzip
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from cluster_index import CLUSTER_MAX_ZOOM, ClusterIndex
+
+# === CONFIGURATION ===
+CELL_TARGET = 64  # average features per grid cell
+MARKER_PX = 6  # circle marker radius in screen pixels, pads bbox queries
+RESPONSE_CACHE = 64  # encoded responses kept per dataset version
+GZIP_LEVEL = 5
+CLASS_NAMES = ['Oil Palm', 'VOP']
+JOURNAL_SUFFIX = ".journal"  # append-only edit log next to the GeoJSON file
+COMPACT_EVERY = 1000  # journal entries before they are folded into the base file
+MEMBERS = ("crs", "georef")  # collection members kept through compaction and saves
+WGS84 = "EPSG:4326"
+
+
+def display_position(feature):
+    # Map position in the GUI's image space: georeferenced exports carry it
+    # in px/py, pixel exports in the geometry itself
+    props = feature.get("properties") or {}
+    if "px" in props and "py" in props:
+        return float(props["px"]), float(props["py"])
+    x, y = feature["geometry"]["coordinates"][:2]
+    return float(x), float(y)
+
+
+def map_projection(members):
+    # (px, py) -> geometry coordinates for a georeferenced export, from its
+    # "georef" member (display affine + source CRS) and geometry "crs", else None
+    georef = members.get("georef")
+    if not georef:
+        return None
+    a, b, c, d, e, f = georef["transform"]
+    target = ((members.get("crs") or {}).get("properties") or {}).get("name", WGS84)
+    project = None
+    if target != georef["crs"]:
+        from pyproj import Transformer  # only reprojected (wgs84) exports need it
+        project = Transformer.from_crs(georef["crs"], target, always_xy=True).transform
+
+    def to_map(px, py):
+        x, y = a * px + b * py + c, d * px + e * py + f
+        return [float(v) for v in project(x, y)] if project else [x, y]
+    return to_map
+
+
+def class_code(feature):
+    # Index into CLASS_NAMES, -1 for anything else
+    name = (feature.get("properties") or {}).get("class")
+    return CLASS_NAMES.index(name) if name in CLASS_NAMES else -1
+
+
+def build_grid(features):
+    # Grid-cell ordered arrays over features that already carry integer ids
+    positions = np.array([display_position(f) for f in features], dtype=np.float64).reshape(-1, 2)
+    x, y = positions[:, 0], positions[:, 1]
+    if len(x):
+        x0, y0 = float(x.min()), float(y.min())
+        area = max(float(x.max()) - x0, 1.0) * max(float(y.max()) - y0, 1.0)
+        cell = max(np.sqrt(area * CELL_TARGET / len(x)), 1e-9)
+        cols = int((float(x.max()) - x0) // cell) + 1
+    else:
+        x0, y0, cell, cols = 0.0, 0.0, 1.0, 1
+    keys = np.floor((y - y0) / cell).astype(np.int64) * cols + np.floor((x - x0) / cell).astype(np.int64)
+    order = np.argsort(keys, kind="stable")
+    ids = np.array([features[i]["id"] for i in order], dtype=np.int64)
+    return {
+        "features": [features[i] for i in order], "x": x[order], "y": y[order], "keys": keys[order],
+        "ids": ids, "id_order": np.argsort(ids, kind="stable"), "origin": (x0, y0), "cell": cell, "cols": cols,
+    }
+
+
+class FeatureIndex:
+    """In-memory grid index over a GeoJSON file and its edit journal.
+
+    The base file is parsed once and reloaded only when it changes on disk.
+    Edits are appended to a journal and held in an overlay that shadows base
+    features by id; every COMPACT_EVERY entries a background thread folds
+    them into the base file with an atomic replace. Features are JSON-encoded
+    the first time a query returns them. Zoomed-out queries are answered
+    from a ClusterIndex that edits update in place.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.compacting_path = self.journal_path + ".compacting"
+        self.lock = threading.RLock()
+        self.base_version = None
+        self.seq = 0  # edits applied in this process, part of the version
+        self.overlay = {}  # id -> (seq, feature, or None once deleted)
+        self.overlay_arrays = None
+        self.touched = {}  # id -> feature before the edits not yet in the clusters
+        self.journal_offset = 0
+        self.journal_entries = 0
+        self.compactor = None
+        self.responses = OrderedDict()
+        self.members = {}  # collection-level crs/georef of the base file
+        self.to_map = None  # px/py -> geometry, for georeferenced files
+        self.georeferenced = False  # features keep their image position in px/py
+        self._set_base(build_grid([]))
+        self.clusters = ClusterIndex(self.x, self.y, np.empty(0, dtype=np.int64), CLASS_NAMES)
+
+    @property
+    def version(self):
+        return f"{self.base_version}+{self.seq}"
+
+    def _set_base(self, grid):
+        self.features, self.x, self.y, self.keys = grid["features"], grid["x"], grid["y"], grid["keys"]
+        self.ids, self.id_order = grid["ids"], grid["id_order"]
+        self.origin, self.cell, self.cols = grid["origin"], grid["cell"], grid["cols"]
+        self.encoded = [None] * len(self.features)
+        base_next = int(self.ids.max()) + 1 if len(self.ids) else 0
+        self.next_id = max(base_next, max(self.overlay, default=-1) + 1)
+
+    def _stat_version(self):
+        try:
+            stat = os.stat(self.path)
+            return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+        except FileNotFoundError:
+            return "empty"
+
+    # === Loading ===
+    def refresh(self):
+        with self.lock:
+            version = self._stat_version()
+            size = os.path.getsize(self.journal_path) if os.path.exists(self.journal_path) else 0
+            if version != self.base_version or size < self.journal_offset:
+                self._load(version)
+            elif size > self.journal_offset:
+                self._read_journal(self.journal_path, self.journal_offset)
+            return self.version
+
+    def _load(self, version):
+        data = {}
+        if version != "empty":
+            with open(self.path) as f:
+                data = json.load(f)
+        features = data.get("features", [])
+        self.members = {key: data[key] for key in MEMBERS if key in data}
+        self.to_map = map_projection(self.members)
+        self.georeferenced = any("px" in (f.get("properties") or {}) for f in features[:1])
+        # Ids are stable once saved; older files get their row index
+        next_id = max((f["id"] for f in features if isinstance(f.get("id"), int)), default=-1) + 1
+        for feature in features:
+            if not isinstance(feature.get("id"), int):
+                feature["id"] = next_id
+                next_id += 1
+
+        self.overlay, self.overlay_arrays, self.touched = {}, None, {}
+        self._set_base(build_grid(features))
+        codes = np.array([class_code(f) for f in self.features], dtype=np.int64)
+        self.clusters = ClusterIndex(self.x, self.y, codes, CLASS_NAMES)
+        self.base_version = version
+        self.journal_offset = self.journal_entries = 0
+        # A crash mid-compaction leaves its journal behind; replaying it is idempotent
+        if os.path.exists(self.compacting_path):
+            self._read_journal(self.compacting_path, 0, track=False)
+        if os.path.exists(self.journal_path):
+            self._read_journal(self.journal_path, 0)
+        self.responses.clear()
+
+    def _read_journal(self, path, offset, track=True):
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        data = data[:data.rfind(b"\n") + 1]  # a torn last line is not an edit yet
+        lines = [line for line in data.splitlines() if line.strip()]
+        for line in lines:
+            self._apply(json.loads(line))
+        self._update_clusters()
+        if track:
+            self.journal_offset = offset + len(data)
+            self.journal_entries += len(lines)
+        self.responses.clear()
+
+    # === Lookups ===
+    def get(self, fid):
+        if fid in self.overlay:
+            return self.overlay[fid][1]
+        pos = np.searchsorted(self.ids, fid, sorter=self.id_order)
+        if pos < len(self.ids) and self.ids[self.id_order[pos]] == fid:
+            return self.features[self.id_order[pos]]
+        return None
+
+    def _overlay_live(self):
+        # (shadowed ids, live ids, x, y, features) for the edit overlay
+        if self.overlay_arrays is None:
+            live = [(fid, f) for fid, (_, f) in self.overlay.items() if f is not None]
+            xy = np.array([display_position(f) for _, f in live], dtype=np.float64).reshape(-1, 2)
+            self.overlay_arrays = (
+                np.fromiter(self.overlay, dtype=np.int64, count=len(self.overlay)),
+                np.array([fid for fid, _ in live], dtype=np.int64), xy[:, 0], xy[:, 1], [f for _, f in live],
+            )
+        return self.overlay_arrays
+
+    # === Queries ===
+    def query(self, bbox=None):
+        # Indices of base features inside bbox = (west, south, east, north)
+        if bbox is None or not len(self.keys):
+            return np.arange(len(self.keys))
+        west, south, east, north = bbox
+        x0, y0 = self.origin
+        col_lo = max(int(np.floor((west - x0) / self.cell)), 0)
+        col_hi = min(int(np.floor((east - x0) / self.cell)), self.cols - 1)
+        row_lo = max(int(np.floor((south - y0) / self.cell)), 0)
+        row_hi = min(int(np.floor((north - y0) / self.cell)), int(self.keys[-1] // self.cols))
+        if col_lo > col_hi or row_lo > row_hi:
+            return np.empty(0, dtype=np.intp)
+
+        # Each cell row's column span is one contiguous run of sorted keys
+        rows = np.arange(row_lo, row_hi + 1, dtype=np.int64)
+        starts = np.searchsorted(self.keys, rows * self.cols + col_lo, side="left")
+        ends = np.searchsorted(self.keys, rows * self.cols + col_hi, side="right")
+        lengths = ends - starts
+        if not lengths.sum():
+            return np.empty(0, dtype=np.intp)
+        idx = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        inside = (self.x[idx] >= west) & (self.x[idx] <= east) & (self.y[idx] >= south) & (self.y[idx] <= north)
+        return idx[inside]
+
+    def etag(self, bbox=None, zoom=None):
+        return hashlib.sha1(repr((self.version, bbox, zoom)).encode()).hexdigest()
+
+    def response(self, bbox=None, zoom=None):
+        # (body, gzipped body) for a query, cached per dataset version
+        if bbox is not None and zoom is not None:
+            # Keep markers whose circle pokes into the viewport
+            pad = MARKER_PX * 2.0 ** -zoom
+            bbox = (bbox[0] - pad, bbox[1] - pad, bbox[2] + pad, bbox[3] + pad)
+        key = (bbox, zoom)
+        with self.lock:
+            if key in self.responses:
+                self.responses.move_to_end(key)
+                return self.responses[key]
+            if zoom is not None and zoom <= CLUSTER_MAX_ZOOM:
+                body = ('{"type":"FeatureCollection","features":['
+                        + ",".join(self.clusters.features(zoom, bbox)) + "]}").encode()
+                return self._cache(key, body)
+            idx = self.query(bbox)
+            edited = []
+            if self.overlay:
+                # Edited features replace their base copies
+                shadowed, _, ov_x, ov_y, ov_features = self._overlay_live()
+                idx = idx[~np.isin(self.ids[idx], shadowed)]
+                inside = np.ones(len(ov_features), dtype=bool) if bbox is None else \
+                    (ov_x >= bbox[0]) & (ov_x <= bbox[2]) & (ov_y >= bbox[1]) & (ov_y <= bbox[3])
+                edited = [json.dumps(ov_features[i], separators=(",", ":")) for i in np.flatnonzero(inside)]
+            idx = idx.tolist()
+            features, encoded = self.features, self.encoded
+            for i in idx:
+                if encoded[i] is None:
+                    encoded[i] = json.dumps(features[i], separators=(",", ":"))
+            body = ('{"type":"FeatureCollection","features":['
+                    + ",".join([encoded[i] for i in idx] + edited) + "]}").encode()
+            return self._cache(key, body)
+
+    def _cache(self, key, body):
+        result = (body, gzip.compress(body, GZIP_LEVEL))
+        self.responses[key] = result
+        while len(self.responses) > RESPONSE_CACHE:
+            self.responses.popitem(last=False)
+        return result
+
+    # === Edits ===
+    def _apply(self, entry):
+        # Entries carry absolute state, so replaying one twice is harmless
+        kind, fid = entry["op"], entry["id"]
+        self.touched.setdefault(fid, self.get(fid))
+        if kind == "add":
+            feature = dict(entry["feature"], id=fid)
+        else:
+            current = self.get(fid)
+            if current is None:
+                return
+            feature = None
+            if kind != "delete":
+                feature = copy.deepcopy(current)
+                props = feature.setdefault("properties", {})
+                if kind == "move":
+                    x, y = entry["coordinates"]
+                    if "px" in props and "py" in props:
+                        # Both spaces move together; the journal carries the map position
+                        props["px"], props["py"] = x, y
+                        coordinates = entry.get("map_coordinates")
+                        if coordinates is None and self.to_map is not None:  # older journals
+                            coordinates = self.to_map(x, y)
+                        if coordinates is not None:
+                            feature["geometry"] = {"type": "Point", "coordinates": coordinates}
+                    else:
+                        feature["geometry"] = {"type": "Point", "coordinates": [x, y]}
+                else:
+                    props["class"] = entry["class"]
+        self.seq += 1
+        self.overlay[fid] = (self.seq, feature)
+        self.overlay_arrays = None
+        self.next_id = max(self.next_id, fid + 1)
+
+    def _update_clusters(self):
+        # Move each touched feature's weight from its old cells to its new ones
+        points = []
+        for fid, before in self.touched.items():
+            after = self.get(fid)
+            if after is before:
+                continue
+            if before is not None:
+                points.append((*display_position(before), class_code(before), -1))
+            if after is not None:
+                points.append((*display_position(after), class_code(after), 1))
+        self.touched = {}
+        if points:
+            x, y, cls, weight = (np.array(column) for column in zip(*points))
+            self.clusters.update(x.astype(np.float64), y.astype(np.float64), cls.astype(np.int64),
+                                 weight.astype(np.int64))
+
+    def _map_point(self, x, y):
+        # Geometry for an image position in a georeferenced file
+        if self.to_map is None:
+            raise ValueError("features are georeferenced but the file has no georef transform; "
+                             "re-export it to edit positions")
+        return self.to_map(x, y)
+
+    def _entry(self, edit):
+        # Validated journal entry for one client edit; positions arrive in
+        # image space and georeferenced files get the map position as well
+        kind = edit.get("op")
+        if kind == "add":
+            feature = edit.get("feature") or {}
+            if (feature.get("geometry") or {}).get("type") != "Point":
+                raise ValueError("added features must be GeoJSON Points")
+            feature.pop("id", None)
+            if self.georeferenced:
+                x, y = (float(v) for v in feature["geometry"]["coordinates"][:2])
+                feature["properties"] = dict(feature.get("properties") or {}, px=x, py=y)
+                feature["geometry"] = {"type": "Point", "coordinates": self._map_point(x, y)}
+            entry = {"op": "add", "id": self.next_id, "feature": feature}
+            self.next_id += 1
+            return entry
+        if kind not in ("move", "delete", "reclassify"):
+            raise ValueError(f"unknown edit op: {kind!r}")
+        fid = int(edit.get("id"))
+        if self.get(fid) is None:
+            raise KeyError(fid)
+        entry = {"op": kind, "id": fid}
+        if kind == "move":
+            x, y = (float(v) for v in edit["coordinates"])
+            entry["coordinates"] = [x, y]
+            if "px" in (self.get(fid).get("properties") or {}):
+                entry["map_coordinates"] = self._map_point(x, y)
+        elif kind == "reclassify":
+            if edit.get("class") not in CLASS_NAMES:
+                raise ValueError(f"class must be one of {CLASS_NAMES}")
+            entry["class"] = edit["class"]
+        return entry
+
+    def apply(self, edits):
+        # Journal a batch of edits, then serve it; returns the id each edit touched
+        with self.lock:
+            self.refresh()
+            entries = []
+            saved = dict(self.overlay), self.seq, self.next_id
+            try:
+                for edit in edits:
+                    entries.append(self._entry(edit))
+                    self._apply(entries[-1])  # later edits may target an earlier add
+            except Exception:
+                # A rejected batch leaves no trace
+                (self.overlay, self.seq, self.next_id), self.overlay_arrays = saved, None
+                self.touched = {}
+                raise
+            try:
+                data = "".join(json.dumps(e, separators=(",", ":")) + "\n" for e in entries).encode()
+                with open(self.journal_path, "ab") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self.journal_offset = f.tell()
+            except Exception:
+                self.base_version = None  # reload from disk, whatever reached the journal
+                raise
+            self._update_clusters()
+            self.journal_entries += len(entries)
+            self.responses.clear()
+            if self.journal_entries >= COMPACT_EVERY and self.compactor is None:
+                self.compactor = threading.Thread(target=self.compact, name="journal-compactor", daemon=True)
+                self.compactor.start()
+        return [e["id"] for e in entries]
+
+    # === Compaction ===
+    def merged_features(self):
+        if not self.overlay:
+            return list(self.features)
+        shadowed, _, _, _, edited = self._overlay_live()
+        keep = np.flatnonzero(~np.isin(self.ids, shadowed)).tolist()
+        return [self.features[i] for i in keep] + edited
+
+    def compact(self):
+        # Fold journaled edits into the base file. The journal is rotated
+        # first, so edits arriving meanwhile go to a fresh one.
+        try:
+            with self.lock:
+                if os.path.exists(self.journal_path):
+                    if os.path.exists(self.compacting_path):
+                        with open(self.journal_path, "rb") as src, open(self.compacting_path, "ab") as dst:
+                            dst.write(src.read())
+                        os.remove(self.journal_path)
+                    else:
+                        os.replace(self.journal_path, self.compacting_path)
+                self.journal_offset = self.journal_entries = 0
+                snapshot_seq = self.seq
+                features = self.merged_features()
+                members = dict(self.members)
+
+            # Edits never mutate features in place, so the snapshot encodes off the lock
+            text = json.dumps(dict({"type": "FeatureCollection"}, **members, features=features),
+                              separators=(",", ":"))
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            with self.lock:
+                os.replace(tmp_path, self.path)
+                if os.path.exists(self.compacting_path):
+                    os.remove(self.compacting_path)
+                self.base_version = self._stat_version()
+
+            # Re-index the snapshot off the lock; only newer edits stay in the overlay
+            grid = build_grid(features)
+            with self.lock:
+                self.overlay = {fid: v for fid, v in self.overlay.items() if v[0] > snapshot_seq}
+                self.overlay_arrays = None
+                self._set_base(grid)
+                self.responses.clear()
+        finally:
+            self.compactor = None
+
+    def replace_all(self, data):
+        # Whole-collection save: becomes the new base and drops the journals.
+        # crs/georef members carry over unless the body brings its own.
+        if not isinstance(data, dict) or not isinstance(data.get("features", []), list):
+            raise ValueError("body must be a GeoJSON FeatureCollection")
+        with self.lock:
+            members = {key: data[key] for key in MEMBERS if key in data} or self.members
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(dict({"type": "FeatureCollection"}, **members, features=data.get("features", [])), f,
+                          separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+            for path in (self.journal_path, self.compacting_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.base_version = None
+            self.refresh()
+            return len(self.features)
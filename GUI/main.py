@@ -1,29 +1,95 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory
 import os
-import json
+
+from cluster_index import CLUSTER_MAX_ZOOM
+from feature_index import FeatureIndex
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 
 GEOJSON_PATH = 'detection_geojson.geojson'
+feature_index = FeatureIndex(GEOJSON_PATH)
 
 @app.route('/')
 def index():
-    return render_template('map.html')
+    return render_template('map.html', cluster_max_zoom=CLUSTER_MAX_ZOOM)
+
+def parse_bbox(value):
+    # "west,south,east,north" in map coordinates
+    if not value:
+        return None
+    west, south, east, north = (float(v) for v in value.split(','))
+    return west, south, east, north
 
 @app.route('/geojson')
 def geojson():
-    if not os.path.exists(GEOJSON_PATH):
-        return jsonify({"type": "FeatureCollection", "features": []})
-    with open(GEOJSON_PATH, 'r') as f:
-        data = json.load(f)
-    return jsonify(data)
+    # Optional ?bbox=west,south,east,north&zoom=z returns only visible features,
+    # as clusters when zoomed out to CLUSTER_MAX_ZOOM or below
+    try:
+        bbox = parse_bbox(request.args.get('bbox'))
+    except ValueError:
+        return jsonify({"error": "bbox must be west,south,east,north"}), 400
+    zoom = request.args.get('zoom', type=float)
+
+    feature_index.refresh()
+    etag = feature_index.etag(bbox, zoom)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    body, gzipped = feature_index.response(bbox, zoom)
+    use_gzip = 'gzip' in request.accept_encodings
+    response = Response(gzipped if use_gzip else body, mimetype='application/geo+json')
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'  # always revalidate with the ETag
+    response.set_etag(etag)
+    return response
+
+def apply_edits(edits):
+    # Journaled edits: {"op": "add"|"move"|"delete"|"reclassify", ...}
+    try:
+        ids = feature_index.apply(edits)
+    except KeyError as e:
+        return jsonify({"error": f"unknown feature id {e.args[0]}"}), 404
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"status": "Edits saved successfully ✅", "ids": ids, "version": feature_index.version})
+
+@app.route('/edits', methods=['POST'])
+def edits():
+    data = request.get_json(silent=True) or {}
+    return apply_edits(data.get('edits', []))
+
+@app.route('/features', methods=['POST'])
+def add_feature():
+    return apply_edits([{"op": "add", "feature": request.get_json(silent=True)}])
+
+@app.route('/features/<int:fid>', methods=['PATCH'])
+def update_feature(fid):
+    # {"coordinates": [x, y]} moves, {"class": name} reclassifies
+    data = request.get_json(silent=True) or {}
+    edits = []
+    if 'coordinates' in data:
+        edits.append({"op": "move", "id": fid, "coordinates": data['coordinates']})
+    if 'class' in data:
+        edits.append({"op": "reclassify", "id": fid, "class": data['class']})
+    return apply_edits(edits)
+
+@app.route('/features/<int:fid>', methods=['DELETE'])
+def delete_feature(fid):
+    return apply_edits([{"op": "delete", "id": fid}])
 
 @app.route('/save', methods=['POST'])
 def save():
-    data = request.get_json()
-    with open(GEOJSON_PATH, 'w') as f:
-        json.dump(data, f, indent=2)
-    return jsonify({"status": "GeoJSON saved successfully ✅"})
+    # Whole-collection replace; the map sends per-feature edits to /edits
+    data = request.get_json(silent=True)
+    try:
+        count = feature_index.replace_all(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"status": "GeoJSON saved successfully ✅", "features": count})
 
 @app.route('/static/<path:filename>')
 def static_files(filename):
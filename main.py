@@ -1,12 +1,10 @@
 import os
 import sys
-import subprocess
+import importlib.util
 import argparse
 import shutil
 import webbrowser
-from glob import glob
 from datetime import datetime
-from PIL import Image
 
 # === CONFIG ===
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -14,85 +12,146 @@ INPUT_DIR = os.path.join(BASE_DIR, "input")
 SCRIPTS_DIR = os.path.join(BASE_DIR, "scripts")
 OUTPUT_DIR = os.path.join(SCRIPTS_DIR, "output")
 TILE_DIR = os.path.join(SCRIPTS_DIR, "tiles")
+MODEL_PATH = os.path.join(BASE_DIR, "model", "best.pt")
 REPORT_BASE = os.path.join(BASE_DIR, "oil_palm_report.html")
 MERGED_PATH = os.path.join(OUTPUT_DIR, "merged_result.jpg")
-PYTHON_EXEC = sys.executable
+CACHE_DIR = os.path.join(BASE_DIR, "cache")  # run cache and input catalog
 
-# === Script Paths ===
-scripts = {
-    "tile":      os.path.join(SCRIPTS_DIR, "tile_image.py"),
-    "detect":    os.path.join(SCRIPTS_DIR, "detect_tiles.py"),
-    "dedupe":    os.path.join(SCRIPTS_DIR, "deduplicate_detections.py"),
-    "merge":     os.path.join(SCRIPTS_DIR, "merge_tiles.py"),
-    "inject":    os.path.join(SCRIPTS_DIR, "inject_exif_to_merged.py"),
-    "export":    os.path.join(SCRIPTS_DIR, "export_geojson.py"),
-    "report":    os.path.join(SCRIPTS_DIR, "generate_report.py"),
-}
+# === Stage modules run in-process ===
+sys.path.insert(0, SCRIPTS_DIR)
+from pipeline import PipelineConfig, PipelineError, find_exif_source, run_pipeline  # noqa: E402
+from tile_image import TILE_OVERLAP, find_images  # noqa: E402
+from tile_filter import PREFILTER_TILES, format_skips  # noqa: E402
+from aggregate import HEATMAP_NAME  # noqa: E402
+from georeference import GEOREF_TARGET  # noqa: E402
+from detect_tiles import BATCH_SIZE, INFERENCE_SHARDS  # noqa: E402
+from inference_backends import INFERENCE_BACKEND  # noqa: E402
+from deduplicate_detections import DEDUP_METHOD, DEDUP_WORKERS  # noqa: E402
+from merge_tiles import MERGE_FORMAT  # noqa: E402
+from export_geojson import EXPORT_FORMAT  # noqa: E402
+from run_cache import CACHE_MAX_MB  # noqa: E402
+from inject_exif_to_merged import WORLD_FILE  # noqa: E402
+
+# Defaults come from the stage modules, so the CLI and library cannot drift apart
 
 # === Argument Parser ===
 parser = argparse.ArgumentParser(description="🧠 Oil Palm Detection Pipeline CLI")
 parser.add_argument("--headless", action="store_true", help="Do not open HTML report automatically")
 parser.add_argument("--skip-exif", action="store_true", help="Skip EXIF embedding step")
-args = parser.parse_args()
-
-# === Timestamped Output ===
-timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-report_output = os.path.join(BASE_DIR, f"oil_palm_report_{timestamp}.html")
+parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Tiles per detection forward pass")
+parser.add_argument("--stream", action="store_true", help="Stream tiles from tiling straight into detection")
+parser.add_argument("--no-save-tiles", action="store_true", help="With --stream, keep tiles in memory only")
+parser.add_argument("--overlap", type=int, default=TILE_OVERLAP, help="Pixels of overlap between neighbouring tiles")
+parser.add_argument("--dedup", choices=["dbscan", "partitioned", "nms"], default=DEDUP_METHOD,
+                    help="Deduplication engine (partitioned = multi-process DBSCAN, nms expects --overlap > 0)")
+parser.add_argument("--merge-format", choices=["jpeg", "dzi", "cog"], default=MERGE_FORMAT,
+                    help="Merged output: one JPEG, a Deep Zoom tile pyramid or a Cloud-Optimized GeoTIFF")
+parser.add_argument("--dedup-workers", type=int, default=DEDUP_WORKERS,
+                    help="Processes for --dedup partitioned")
+parser.add_argument("--export-format", choices=["geojson", "ndjson", "fgb"], default=EXPORT_FORMAT,
+                    help="Detection export: compact GeoJSON, newline-delimited GeoJSON or FlatGeobuf (via fiona)")
+parser.add_argument("--georef", choices=["none", "native", "wgs84"], default=GEOREF_TARGET,
+                    help="Export coordinates for GeoTIFF inputs: pixels, the source CRS or WGS84 lon/lat")
+parser.add_argument("--no-csv", action="store_true",
+                    help="Only write the binary .det detection stores, no CSV copies")
+parser.add_argument("--no-cache", action="store_true", help="Ignore the run cache and redo every stage")
+parser.add_argument("--cache-size-mb", type=int, default=CACHE_MAX_MB,
+                    help="Run cache size limit; least recently used entries are evicted")
+parser.add_argument("--inference-workers", type=int, help="Images in detection at once (one model copy each)")
+parser.add_argument("--cpu-workers", type=int, help="Images tiling or deduplicating at once")
+parser.add_argument("--io-workers", type=int, help="Images merging, exporting or writing EXIF at once")
+parser.add_argument("--inference-shards", type=int, default=INFERENCE_SHARDS,
+                    help="CPU inference worker processes; 0 calibrates processes x torch threads on this machine")
+parser.add_argument("--backend", choices=["torch", "onnx", "onnx-int8"], default=INFERENCE_BACKEND,
+                    help="Inference backend: PyTorch, or ONNX Runtime on CPU (exported / INT8-quantized on first use)")
+parser.add_argument("--tile-filter", action=argparse.BooleanOptionalAction, default=PREFILTER_TILES,
+                    help="Skip nodata, uniform and non-vegetated tiles before detection (heuristic, changes counts)")
+parser.add_argument("--trace", action="store_true",
+                    help="Also write a Chrome trace (run_trace.json) of the stages next to the run manifest")
+parser.add_argument("--world-file", action=argparse.BooleanOptionalAction, default=WORLD_FILE,
+                    help="Write a world file (.jgw/.tfw) and CRS sidecar next to the mosaic when the input is a GeoTIFF")
 
-# === Find EXIF source (if available) ===
-def has_exif(img_path):
-    try:
-        return Image.open(img_path)._getexif() is not None
-    except Exception:
-        return False
 
-all_images = []
-for ext in ["*.jpg", "*.jpeg", "*.png", "*.tif", "*.tiff"]:
-    all_images.extend(glob(os.path.join(INPUT_DIR, ext)))
+def main():
+    args = parser.parse_args()
+    if args.dedup == "nms" and args.overlap <= 0:
+        parser.error("--dedup nms needs overlapping tiles; pass --overlap > 0")
+    if args.export_format == "fgb" and importlib.util.find_spec("fiona") is None:
+        parser.error("--export-format fgb needs fiona; pip install -r requirements.txt")
 
-exif_images = [f for f in all_images if has_exif(f)]
-if exif_images:
-    os.environ["GPS_EXIF_SOURCE"] = exif_images[0]
-    print(f"📂 Using EXIF source: {exif_images[0]}")
-else:
-    os.environ["GPS_EXIF_SOURCE"] = ""
-    print("⚠️ No EXIF found — GPS step will be skipped.")
+    # === Timestamped Output ===
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_output = os.path.join(BASE_DIR, f"oil_palm_report_{timestamp}.html")
 
-# === Wrapper to run script with logging ===
-def run_script(label, path, step_code):
-    print(f"\n🔧 {label}")
-    ret = subprocess.call([PYTHON_EXEC, path])
-    if ret != 0:
-        print(f"❌ Failed at {label}")
-        sys.exit(step_code)
+    # === Find EXIF source (if available) ===
+    exif_source = find_exif_source(find_images(INPUT_DIR), CACHE_DIR)
+    if exif_source:
+        print(f"📂 Using EXIF source: {exif_source}")
+    else:
+        print("⚠️ No EXIF found — GPS step will be skipped.")
 
-# === Pipeline ===
-run_script("Step 1: Tiling", scripts["tile"], 1)
-run_script("Step 2: Detection", scripts["detect"], 2)
-run_script("Step 2.6: Deduplication (DBSCAN)", scripts["dedupe"], 26)
-run_script("Step 2.7: Merge Dots", scripts["merge"], 27)
+    # === Pipeline ===
+    config = PipelineConfig(
+        input_dir=INPUT_DIR,
+        tile_dir=TILE_DIR,
+        output_dir=OUTPUT_DIR,
+        model_path=MODEL_PATH,
+        project_root=BASE_DIR,
+        exif_source=exif_source,
+        skip_exif=args.skip_exif,
+        batch_size=args.batch_size,
+        stream=args.stream,
+        save_tiles=not args.no_save_tiles,
+        tile_overlap=args.overlap,
+        dedup_method=args.dedup,
+        dedup_workers=args.dedup_workers,
+        merge_format=args.merge_format,
+        use_cache=not args.no_cache,
+        cache_max_mb=args.cache_size_mb,
+        export_csv=not args.no_csv,
+        export_format=args.export_format,
+        georef=args.georef,
+        inference_shards=args.inference_shards,
+        inference_backend=args.backend,
+        tile_filter=args.tile_filter,
+        trace=args.trace,
+        world_file=args.world_file,
+        resource_limits={name: value for name, value in (("inference", args.inference_workers),
+                                                          ("cpu", args.cpu_workers),
+                                                          ("io", args.io_workers)) if value},
+    )
+    try:
+        result = run_pipeline(config)
+    except PipelineError as e:
+        sys.exit(e.step_code)
 
-# === Conditional EXIF Injection ===
-if os.environ["GPS_EXIF_SOURCE"] and not args.skip_exif and os.path.exists(MERGED_PATH):
-    run_script("Step 3: Inject GPS EXIF", scripts["inject"], 3)
-else:
-    print("⚠️ Skipping EXIF embedding")
+    # === Save and Open Report ===
+    if os.path.exists(REPORT_BASE):
+        shutil.copyfile(REPORT_BASE, report_output)
+        print(f"\n✅ Report saved: {report_output}")
+        if not args.headless:
+            webbrowser.open(f"file:///{report_output.replace(os.sep, '/')}")
+    else:
+        print(f"❌ Report not found: {REPORT_BASE}")
 
-run_script("Step 4: Export GeoJSON", scripts["export"], 4)
-run_script("Step 5: Generate HTML Report", scripts["report"], 5)
+    # === Final Recap ===
+    print("\n🎯 Pipeline finished.")
+    for job in result.jobs:
+        if len(result.jobs) > 1:
+            print(f"\n📷 {job.name}")
+        print("🖼️ Final image:", job.merged_path)
+        print("📄 Detections:", os.path.join(job.tile_dir, "deduplicated_detections.det"))
+        print("🌍 GeoJSON:", job.geojson_path)
+        print("🔥 Density heatmap:", os.path.join(job.output_dir, HEATMAP_NAME))
+        if config.tile_filter:
+            print("🚫 Pre-filter:", format_skips(job.tiles))
+    print("📊 HTML Report:", report_output)
+    print("🧾 Run manifest:", result.manifest_path)
+    if result.trace_path:
+        print("🧵 Chrome trace:", result.trace_path)
 
-# === Save and Open Report ===
-if os.path.exists(REPORT_BASE):
-    shutil.copyfile(REPORT_BASE, report_output)
-    print(f"\n✅ Report saved: {report_output}")
-    if not args.headless:
-        webbrowser.open(f"file:///{report_output.replace(os.sep, '/')}")
-else:
-    print(f"❌ Report not found: {REPORT_BASE}")
 
-# === Final Recap ===
-print("\n🎯 Pipeline finished.")
-print("🖼️ Final image:", MERGED_PATH)
-print("📄 Output CSV:", os.path.join(SCRIPTS_DIR, "tiles", "deduplicated_detections.csv"))
-print("🌍 GeoJSON:", os.path.join(OUTPUT_DIR, "detection_geojson.geojson"))
-print("📊 HTML Report:", report_output)
+if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()
+    main()
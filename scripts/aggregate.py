@@ -0,0 +1,210 @@
+import os
+import json
+import math
+import warnings
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import rasterio
+from PIL import Image
+from rasterio.enums import Resampling
+from rasterio.errors import NotGeoreferencedWarning
+
+from stage_types import CLASS_NAMES, detection_meta, read_detections
+from georeference import source_georefs
+
+Image.MAX_IMAGE_PIXELS = None  # merged estates are far beyond PIL's bomb limit
+
+# === CONFIGURATION ===
+OUTPUT_DIR = r"C:/Users/palac/Documents/OilPalms/scripts/output"
+DETECTIONS_PATH = r"C:/Users/palac/Documents/OilPalms/scripts/tiles/deduplicated_detections.det"
+MERGED_IMAGE = os.path.join(OUTPUT_DIR, "merged_result.jpg")
+DENSITY_CELL = 512  # density grid cell edge in full-resolution pixels
+CONF_BINS = 20  # confidence histogram bins over [0, 1]
+PREVIEW_SIZE = 1280  # longest edge of the report preview and heatmap
+PREVIEW_QUALITY = 80
+HEATMAP_ALPHA = 0.65  # heatmap opacity over the greyed preview
+HEATMAP_RAMP = [(0, 0, 4), (87, 16, 110), (188, 55, 84), (249, 142, 9), (252, 255, 164)]  # low → high
+AGGREGATES_NAME = "aggregates.json"
+PREVIEW_NAME = "preview.jpg"
+HEATMAP_NAME = "density_heatmap.jpg"  # blended over a photo, so JPEG
+
+
+def aggregate_params():
+    # Everything that shapes the aggregation outputs, for cache keys
+    return [DENSITY_CELL, CONF_BINS, PREVIEW_SIZE, PREVIEW_QUALITY, HEATMAP_ALPHA, HEATMAP_RAMP]
+
+
+def aggregate_paths(output_dir):
+    return {"aggregates": os.path.join(output_dir, AGGREGATES_NAME),
+            "preview": os.path.join(output_dir, PREVIEW_NAME),
+            "heatmap": os.path.join(output_dir, HEATMAP_NAME)}
+
+
+# === Statistics ===
+def cell_area_ha(tiles, cell=DENSITY_CELL, images=None):
+    # Ground area of one grid cell when the image is a single GeoTIFF in a
+    # metre-based projected CRS, else None (pixel units only)
+    sources = {t.source for t in tiles}
+    georefs = source_georefs(sources, images) if len(sources) == 1 else {}
+    if not georefs:
+        return None
+    transform, crs = next(iter(georefs.values()))
+    if not crs.is_projected or (crs.linear_units or "").lower() not in ("metre", "meter", "m"):
+        return None
+    return abs(transform.a * transform.e - transform.b * transform.d) * cell * cell / 10000
+
+
+def aggregate(detections, image_size, cell=DENSITY_CELL, bins=CONF_BINS, area_ha=None):
+    """Report statistics for one image in a single vectorized pass.
+
+    One histogramdd over (class, row, column) gives every per-class density
+    grid at once, and one histogram2d over (class, confidence) gives the
+    per-class confidence histograms; counts and means fall out of those.
+    """
+    width, height = image_size
+    classes = len(CLASS_NAMES)
+    rows, cols = max(1, math.ceil(height / cell)), max(1, math.ceil(width / cell))
+    cls = detections.cls.astype(np.float64)
+
+    grids, _ = np.histogramdd(np.column_stack([cls, detections.y, detections.x]), bins=(classes, rows, cols),
+                              range=((-0.5, classes - 0.5), (0, rows * cell), (0, cols * cell)))
+    conf_hist, _, edges = np.histogram2d(cls, detections.conf, bins=(classes, bins),
+                                         range=((-0.5, classes - 0.5), (0, 1)))
+    conf_sum = np.bincount(detections.cls.astype(np.intp), weights=detections.conf, minlength=classes)[:classes]
+
+    grids, conf_hist = grids.astype(np.int64), conf_hist.astype(np.int64)
+    counts = conf_hist.sum(axis=1)
+    density = grids.sum(axis=0)
+    occupied = density[density > 0]
+    stats = {
+        "image_size": [int(width), int(height)],
+        "total": int(counts.sum()),
+        "counts": {name: int(n) for name, n in zip(CLASS_NAMES, counts)},
+        "mean_conf": {name: round(float(s / n), 4) if n else None
+                      for name, s, n in zip(CLASS_NAMES, conf_sum, counts)},
+        "conf_edges": [round(float(e), 4) for e in edges],
+        "conf_hist": {name: hist.tolist() for name, hist in zip(CLASS_NAMES, conf_hist)},
+        "cell": cell,
+        "cell_area_ha": None if area_ha is None else round(area_ha, 6),
+        "grid_shape": [rows, cols],
+        "max_per_cell": int(density.max()),
+        "mean_per_occupied_cell": round(float(occupied.mean()), 2) if len(occupied) else 0,
+        "occupied_cells": int(len(occupied)),
+        "density": {name: grid.tolist() for name, grid in zip(CLASS_NAMES, grids)},
+    }
+    if area_ha:
+        stats["max_per_ha"] = round(stats["max_per_cell"] / area_ha, 1)
+        stats["mean_per_ha"] = round(stats["mean_per_occupied_cell"] / area_ha, 1)
+    return stats
+
+
+# === Preview ===
+def _preview_size(width, height, max_size):
+    scale = min(1.0, max_size / max(width, height, 1))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _dzi_preview(path, max_size):
+    # Stitch the smallest pyramid level that still covers the preview size
+    root = ET.parse(path).getroot()
+    ns = root.tag.split("}")[0] + "}" if root.tag.startswith("{") else ""
+    size = root.find(f"{ns}Size")
+    width, height, tile = int(size.get("Width")), int(size.get("Height")), int(root.get("TileSize"))
+    fmt = root.get("Format")
+    max_level = math.ceil(math.log2(max(width, height, 1)))
+    level = max_level
+    while level > 0 and max(math.ceil(width / 2 ** (max_level - level + 1)),
+                            math.ceil(height / 2 ** (max_level - level + 1))) >= max_size:
+        level -= 1
+    w, h = math.ceil(width / 2 ** (max_level - level)), math.ceil(height / 2 ** (max_level - level))
+    files_dir = os.path.join(os.path.splitext(path)[0] + "_files", str(level))
+    img = Image.new("RGB", (w, h))
+    for row in range(math.ceil(h / tile)):
+        for col in range(math.ceil(w / tile)):
+            with Image.open(os.path.join(files_dir, f"{col}_{row}.{fmt}")) as part:
+                img.paste(part.convert("RGB"), (col * tile, row * tile))
+    return img.resize(_preview_size(w, h, max_size), Image.LANCZOS)
+
+
+def _raster_preview(path, max_size):
+    # GDAL reads a COG's nearest overview instead of the full raster
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        with rasterio.open(path) as src:
+            w, h = _preview_size(src.width, src.height, max_size)
+            data = src.read([1, 2, 3], out_shape=(3, h, w), resampling=Resampling.average)
+    return Image.fromarray(data.transpose(1, 2, 0))
+
+
+def read_preview(path, max_size=PREVIEW_SIZE):
+    # Downsampled RGB copy of a merged output without decoding it at full size
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".dzi":
+        return _dzi_preview(path, max_size)
+    if ext in (".tif", ".tiff"):
+        return _raster_preview(path, max_size)
+    with Image.open(path) as img:
+        size = _preview_size(*img.size, max_size)
+        img.draft("RGB", size)  # JPEG decodes at 1/2, 1/4 or 1/8 scale
+        return img.convert("RGB").resize(size, Image.LANCZOS)
+
+
+# === Heatmap ===
+def colorize(values):
+    # Map values in [0, 1] onto HEATMAP_RAMP
+    ramp = np.asarray(HEATMAP_RAMP, dtype=np.float32)
+    pos = np.clip(values, 0, 1) * (len(ramp) - 1)
+    lo = np.minimum(pos.astype(np.intp), len(ramp) - 2)
+    frac = (pos - lo)[..., None]
+    return (ramp[lo] * (1 - frac) + ramp[lo + 1] * frac).astype(np.uint8)
+
+
+def render_heatmap(density, image_size, cell=DENSITY_CELL, preview=None, alpha=HEATMAP_ALPHA):
+    # Density grid drawn at preview size; empty cells show the greyed preview.
+    # Edge cells overhang the image, so the scaled grid is cropped to it.
+    width, height = image_size
+    rows, cols = density.shape
+    size = preview.size if preview is not None else _preview_size(width, height, PREVIEW_SIZE)
+    scaled = (round(cols * cell * size[0] / width), round(rows * cell * size[1] / height))
+    grid = density.astype(np.float32)
+    colors = Image.fromarray(colorize(grid / max(grid.max(), 1))).resize(scaled, Image.NEAREST).crop((0, 0, *size))
+    if preview is None:
+        return colors
+    mask = Image.fromarray(np.where(grid > 0, round(alpha * 255), 0).astype(np.uint8))
+    mask = mask.resize(scaled, Image.NEAREST).crop((0, 0, *size))
+    return Image.composite(colors, preview.convert("L").convert("RGB"), mask)
+
+
+# === Stage ===
+def aggregate_outputs(detections, tiles, image_size, merged_path, output_dir, images=None):
+    # Statistics, preview and heatmap for one image; returns the statistics
+    os.makedirs(output_dir, exist_ok=True)
+    paths = aggregate_paths(output_dir)
+    stats = aggregate(detections, image_size, area_ha=cell_area_ha(tiles, images=images) if tiles else None)
+
+    preview = read_preview(merged_path)
+    preview.save(paths["preview"], quality=PREVIEW_QUALITY, optimize=True)
+    density = np.asarray(list(stats["density"].values())).sum(axis=0)
+    render_heatmap(density, image_size, stats["cell"], preview).save(paths["heatmap"], quality=PREVIEW_QUALITY,
+                                                                     optimize=True)
+
+    with open(paths["aggregates"], "w", encoding="utf-8") as f:
+        json.dump(stats, f)
+    print(f"🗺️ {stats['total']} detections over a {stats['grid_shape'][0]} x {stats['grid_shape'][1]} grid "
+          f"of {DENSITY_CELL}px cells; max {stats['max_per_cell']} per cell")
+    print(f"✅ Preview and heatmap saved to: {output_dir}")
+    return stats
+
+
+def load_aggregates(output_dir):
+    with open(aggregate_paths(output_dir)["aggregates"], encoding="utf-8") as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    if not os.path.exists(DETECTIONS_PATH):
+        raise FileNotFoundError(f"❌ Deduplicated detections not found: {DETECTIONS_PATH}")
+    meta = detection_meta(DETECTIONS_PATH)
+    size = (meta["image_width"], meta["image_height"]) if "image_width" in meta else Image.open(MERGED_IMAGE).size
+    aggregate_outputs(read_detections(DETECTIONS_PATH), None, size, MERGED_IMAGE, OUTPUT_DIR)
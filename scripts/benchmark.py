@@ -0,0 +1,380 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import cProfile
+import argparse
+import platform
+import pstats
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+from datetime import datetime
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from stage_types import parse_tile_name
+from telemetry import RssSampler
+from inference_backends import OnnxBoxes, OnnxResult
+from pipeline import (ModelPool, PipelineConfig, dedup_job, detect_job, export_job, merge_job, plan_jobs,
+                      tile_job)
+from generate_report import generate_report
+from input_catalog import read_info
+from deduplicate_detections import DEDUP_METHOD
+from merge_tiles import MERGE_FORMAT
+
+# === CONFIGURATION ===
+BENCH_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks")  # <repo>/benchmarks
+SCALES = {"small": 4096, "medium": 12288, "large": 24576}  # mosaic side in pixels
+DEFAULT_SCALES = ["small", "medium"]
+FORMATS = ["tif", "jpg"]
+BENCH_OVERLAP = 64  # tile overlap, so dedup has real seam duplicates
+PALM_SPACING = 180  # pixels between planted palms (~9 m triangular planting at 5 cm GSD)
+PALM_RADIUS = 60
+PIXEL_SIZE = 0.05  # metres, for the synthetic GeoTIFF transform
+GENERATOR_VERSION = 1  # bump when the synthetic mosaics change, so cached ones are rebuilt
+SEED = 0
+REPEATS = 3  # best-of timings per stage
+TOLERANCE = 0.15  # slower than baseline by more than 15% ...
+MIN_REGRESSION_S = 0.05  # ... and at least this many seconds is a regression
+RSS_TOLERANCE = 0.25  # memory gate on growth above the stage's starting RSS ...
+MIN_REGRESSION_MB = 32  # ... by at least this much
+RSS_SAMPLE_S = 0.01
+PROFILE_TOP = 12
+
+
+# === Synthetic orthomosaics ===
+def estate_mask(xs, ys, size):
+    # Irregular estate boundary; everything outside is nodata
+    dx, dy = xs - size / 2, ys - size / 2
+    radius = 0.46 * size * (1 + 0.08 * np.sin(5 * np.arctan2(dy, dx)))
+    return dx * dx + dy * dy < radius * radius
+
+
+def palm_centres(size, spacing=PALM_SPACING, seed=SEED):
+    # Triangular planting grid with a little jitter, inside the boundary
+    rng = np.random.default_rng(seed)
+    ys = np.arange(spacing / 2, size, spacing * np.sqrt(3) / 2)
+    xs = np.arange(spacing / 2, size, spacing)
+    gx, gy = np.meshgrid(xs, ys)
+    gx[1::2] += spacing / 2
+    palms = np.column_stack([gx.ravel(), gy.ravel()]) + rng.normal(0, spacing * 0.05, (gx.size, 2))
+    inside = estate_mask(palms[:, 0], palms[:, 1], size)
+    inside &= (palms >= PALM_RADIUS).all(axis=1) & (palms < size - PALM_RADIUS).all(axis=1)
+    palms = palms[inside]
+    return palms[np.lexsort((palms[:, 0], palms[:, 1]))]
+
+
+def palm_sprites(radius=PALM_RADIUS, variants=4):
+    # Crown stamps: radial fronds, darker towards the tips; (rgb, alpha) pairs
+    yy, xx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    r = np.hypot(xx, yy) / radius
+    sprites = []
+    for k in range(variants):
+        fronds = 0.6 + 0.4 * np.cos(9 * np.arctan2(yy, xx) + k * 0.7)
+        shade = (fronds * (1 - 0.5 * r)).clip(0, 1)
+        rgb = np.stack([25 + 40 * shade, 70 + 110 * shade, 20 + 35 * shade], axis=2).astype(np.uint8)
+        sprites.append((rgb, r < (0.85 + 0.15 * fronds)))
+    return sprites
+
+
+def render_rows(y0, y1, size, palms, sprites, rng):
+    # Soil and undergrowth texture, crowns stamped on, nodata outside the estate
+    h = y1 - y0
+    coarse = rng.random((h // 32 + 2, size // 32 + 2))
+    blend = np.repeat(np.repeat(coarse, 32, axis=0), 32, axis=1)[:h, :size, None]
+    soil, grass = np.array([150, 120, 80], np.float32), np.array([80, 120, 55], np.float32)
+    rows = (soil * blend + grass * (1 - blend) + rng.normal(0, 6, (h, size, 1))).clip(0, 255).astype(np.uint8)
+
+    r = PALM_RADIUS
+    lo, hi = np.searchsorted(palms[:, 1], [y0 - r - 1, y1 + r + 1])
+    for i in range(lo, hi):
+        cx, cy = int(round(palms[i, 0])), int(round(palms[i, 1]))
+        rgb, alpha = sprites[i % len(sprites)]
+        top, bottom = max(cy - r, y0), min(cy + r + 1, y1)
+        if top >= bottom:
+            continue
+        sy = slice(top - (cy - r), bottom - (cy - r))
+        patch = rows[top - y0:bottom - y0, cx - r:cx + r + 1]
+        patch[alpha[sy]] = rgb[sy][alpha[sy]]
+
+    ys, xs = np.mgrid[y0:y1, 0:size]
+    rows[~estate_mask(xs, ys, size)] = 0
+    return rows
+
+
+def make_mosaic(path, size, palms, seed=SEED):
+    # Tiled, deflated GeoTIFF written a block row at a time; JPEGs are
+    # converted from it by GDAL, so memory stays bounded at any scale
+    tif_path = os.path.splitext(path)[0] + ".tif"
+    if not os.path.exists(tif_path):
+        rng, sprites = np.random.default_rng(seed), palm_sprites()
+        profile = dict(driver="GTiff", width=size, height=size, count=3, dtype="uint8", nodata=0, tiled=True,
+                       blockxsize=256, blockysize=256, compress="deflate", crs="EPSG:32647",
+                       transform=from_origin(500000, 300000, PIXEL_SIZE, PIXEL_SIZE))
+        with rasterio.open(tif_path + ".part", "w", **profile) as dst:
+            for y0 in range(0, size, 256):
+                y1 = min(y0 + 256, size)
+                dst.write(render_rows(y0, y1, size, palms, sprites, rng).transpose(2, 0, 1),
+                          window=Window(0, y0, size, y1 - y0))
+        os.replace(tif_path + ".part", tif_path)
+    if path != tif_path and not os.path.exists(path):
+        rasterio.shutil.copy(tif_path, path, driver="JPEG", QUALITY=90, WORLDFILE="NO", INTERNAL_MASK="NO")
+        for sidecar in (path + ".aux.xml",):
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
+    return path
+
+
+# === Stub detector ===
+class StubDetector:
+    """Stand-in for the YOLO model with deterministic boxes.
+
+    Tiles are decoded like ultralytics does, then every planted palm whose
+    centre lies in the tile comes back as one box, so overlapping tiles
+    report the same palm and dedup has real duplicates. Needs tile paths
+    (the offset comes from the tile name), so benchmarks run unstreamed.
+    """
+
+    def __init__(self, palms, radius=PALM_RADIUS):
+        self.palms, self.size = palms, 2.0 * radius
+        index = np.arange(len(palms))
+        self.conf = 0.5 + (index * 37 % 50) / 100
+        self.cls = (index % 17 == 0).astype(np.float64)  # a few VOP
+        self.calls = 0
+
+    def __call__(self, sources, batch=None, **kwargs):
+        from PIL import Image
+        self.calls += 1
+        results = []
+        for source in sources:
+            with Image.open(source) as img:
+                width, height = img.size
+                img.load()
+            x, y = parse_tile_name(os.path.basename(source))
+            lo, hi = np.searchsorted(self.palms[:, 1], [y, y + height])
+            idx = lo + np.flatnonzero((self.palms[lo:hi, 0] >= x) & (self.palms[lo:hi, 0] < x + width))
+            xywh = np.column_stack([self.palms[idx, 0] - x, self.palms[idx, 1] - y,
+                                    np.full(len(idx), self.size), np.full(len(idx), self.size)])
+            results.append(OnnxResult(OnnxBoxes(xywh, self.conf[idx], self.cls[idx])))
+        return results
+
+
+class StubPool(ModelPool):
+    def __init__(self, model):
+        super().__init__("")
+        self.model = model
+
+    @contextmanager
+    def borrow(self):
+        yield self.model
+
+
+# === Measurement ===
+def measure(func, profile_path=None, verbose=False):
+    # (result, seconds, peak RSS MB, RSS growth MB); stage logs are muted unless verbose
+    profiler = cProfile.Profile() if profile_path else None
+    sink = io.StringIO()
+    with RssSampler(RSS_SAMPLE_S) as rss:
+        with redirect_stdout(sys.stdout if verbose else sink), redirect_stderr(sys.stderr if verbose else sink):
+            start = time.perf_counter()
+            if profiler:
+                profiler.enable()
+            try:
+                result = func()
+            finally:
+                if profiler:
+                    profiler.disable()
+                seconds = time.perf_counter() - start
+    if profiler:
+        profiler.dump_stats(profile_path)
+    if rss.peak is None:
+        return result, seconds, None, None
+    return result, seconds, rss.peak / 2 ** 20, (rss.peak - rss.start_rss) / 2 ** 20
+
+
+# === Scenarios ===
+def run_scenario(mosaic, palms, work_dir, dedup_method=DEDUP_METHOD, merge_format=MERGE_FORMAT,
+                 profile_dir=None, verbose=False):
+    # One pass of every stage over one mosaic: {stage: (seconds, peak MB, growth MB)}, counts
+    shutil.rmtree(work_dir, ignore_errors=True)
+    config = PipelineConfig(input_dir=os.path.dirname(mosaic), tile_dir=os.path.join(work_dir, "tiles"),
+                            output_dir=os.path.join(work_dir, "output"), model_path="", project_root=work_dir,
+                            skip_exif=True, use_cache=False, tile_overlap=BENCH_OVERLAP,
+                            dedup_method=dedup_method, merge_format=merge_format)
+    os.makedirs(config.output_dir, exist_ok=True)
+    job = plan_jobs(config, [mosaic], {mosaic: read_info(mosaic)})[0]
+    detector = StubDetector(palms)
+    stages = [
+        ("tiling", lambda: tile_job(config, job)),
+        ("detection", lambda: detect_job(config, job, StubPool(detector))),
+        ("dedup", lambda: dedup_job(config, job)),
+        ("merge", lambda: merge_job(config, job)),
+        ("export", lambda: export_job(config, job)),
+        ("report", lambda: generate_report(job.deduped, work_dir)),
+    ]
+    timings = {}
+    for stage, func in stages:
+        profile_path = os.path.join(profile_dir, f"{stage}.prof") if profile_dir else None
+        timings[stage] = measure(func, profile_path, verbose)[1:]
+    counts = {
+        "planted": len(palms), "tiles": len(job.tiles), "skipped": sum(1 for t in job.tiles if t.skip),
+        "detections": len(job.detections), "deduplicated": len(job.deduped), "forward_calls": detector.calls,
+    }
+    return timings, counts
+
+
+def run_suite(scales, formats, repeats=REPEATS, bench_dir=BENCH_DIR, dedup_method=DEDUP_METHOD,
+              merge_format=MERGE_FORMAT, profile=False, verbose=False, keep=False):
+    results = {"machine": machine_info(), "repeats": repeats, "settings": {
+        "dedup": dedup_method, "merge_format": merge_format, "overlap": BENCH_OVERLAP,
+        "generator": GENERATOR_VERSION, "seed": SEED}, "scenarios": {}}
+    for scale in scales:
+        size = SCALES[scale]
+        palms = palm_centres(size)
+        for fmt in formats:
+            name = f"{scale}-{fmt}"
+            data_dir = os.path.join(bench_dir, "data", f"{scale}-v{GENERATOR_VERSION}-s{SEED}", fmt)
+            os.makedirs(data_dir, exist_ok=True)
+            print(f"\n📐 {name}: {size}x{size}, {len(palms)} planted palms")
+            mosaic = make_mosaic(os.path.join(data_dir, f"estate_{scale}.{fmt}"), size, palms)
+
+            best, counts = {}, None
+            for run in range(repeats):
+                profile_dir = None
+                if profile and run == 0:
+                    profile_dir = os.path.join(bench_dir, "profiles", name)
+                    os.makedirs(profile_dir, exist_ok=True)
+                timings, run_counts = run_scenario(mosaic, palms, os.path.join(bench_dir, "work", name),
+                                                   dedup_method, merge_format, profile_dir, verbose)
+                if counts is not None and run_counts != counts:
+                    print(f"⚠️ {name}: counts changed between repeats: {counts} vs {run_counts}")
+                counts = run_counts
+                for stage, (seconds, peak, growth) in timings.items():
+                    prev = best.setdefault(stage, {"seconds": seconds, "peak_rss_mb": peak, "rss_growth_mb": growth})
+                    prev["seconds"] = min(prev["seconds"], seconds)
+                    if peak is not None:
+                        prev["peak_rss_mb"] = max(prev["peak_rss_mb"], peak)
+                        prev["rss_growth_mb"] = max(prev["rss_growth_mb"], growth)
+            if not keep:
+                shutil.rmtree(os.path.join(bench_dir, "work", name), ignore_errors=True)
+
+            results["scenarios"][name] = {"stages": best, "counts": counts}
+            total = sum(stage["seconds"] for stage in best.values())
+            print(f"   tiles {counts['tiles']} ({counts['skipped']} skipped), detections {counts['detections']}, "
+                  f"deduplicated {counts['deduplicated']} / {counts['planted']} planted, total {total:.2f}s")
+            for stage, stats in best.items():
+                memory = "RSS n/a" if stats["peak_rss_mb"] is None else \
+                    f"peak RSS {stats['peak_rss_mb']:.0f} MB (+{stats['rss_growth_mb']:.0f} MB)"
+                print(f"   {stage:<10} {stats['seconds']:8.3f}s   {memory}")
+            if profile:
+                print_profiles(os.path.join(bench_dir, "profiles", name))
+    return results
+
+
+def machine_info():
+    return {"platform": platform.platform(), "python": platform.python_version(), "numpy": np.__version__,
+            "cpu_count": os.cpu_count(), "node": platform.node()}
+
+
+def print_profiles(profile_dir, top=PROFILE_TOP):
+    for name in sorted(os.listdir(profile_dir)):
+        out = io.StringIO()
+        pstats.Stats(os.path.join(profile_dir, name), stream=out).sort_stats("cumulative").print_stats(top)
+        print(f"\n🔬 {os.path.join(profile_dir, name)}")
+        print("\n".join(line for line in out.getvalue().splitlines()[6:] if line.strip()))
+
+
+# === Baseline comparison ===
+def compare(results, baseline, tolerance=TOLERANCE, rss_tolerance=RSS_TOLERANCE):
+    # Regressions against a stored run: slower stages, more memory, different counts
+    regressions = []
+    if baseline.get("machine", {}).get("node") != results["machine"]["node"]:
+        print("⚠️ Baseline was recorded on a different machine; timings may not be comparable")
+    if baseline.get("settings") != results["settings"]:
+        print(f"⚠️ Baseline settings differ: {baseline.get('settings')} vs {results['settings']}")
+
+    print("\n📊 Against baseline")
+    for name, scenario in results["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(name)
+        if old is None:
+            print(f"   {name}: not in baseline")
+            continue
+        if scenario["counts"] != old["counts"]:
+            regressions.append(f"{name}: counts {old['counts']} -> {scenario['counts']}")
+        for stage, stats in scenario["stages"].items():
+            before = old["stages"].get(stage)
+            if before is None:
+                continue
+            change = stats["seconds"] / max(before["seconds"], 1e-9) - 1
+            flag = ""
+            if change > tolerance and stats["seconds"] - before["seconds"] > MIN_REGRESSION_S:
+                flag = " ❌ slower"
+                regressions.append(f"{name}/{stage}: {before['seconds']:.3f}s -> {stats['seconds']:.3f}s")
+            elif change < -tolerance and before["seconds"] - stats["seconds"] > MIN_REGRESSION_S:
+                flag = " ✅ faster"
+            grew, grew_before = stats.get("rss_growth_mb"), before.get("rss_growth_mb")
+            if grew is not None and grew_before is not None and \
+                    grew > grew_before * (1 + rss_tolerance) and grew - grew_before > MIN_REGRESSION_MB:
+                flag += " ❌ memory"
+                regressions.append(f"{name}/{stage}: RSS growth {grew_before:.0f} MB -> {grew:.0f} MB")
+            print(f"   {name:<12} {stage:<10} {before['seconds']:8.3f}s -> {stats['seconds']:8.3f}s "
+                  f"({change:+.0%}){flag}")
+    return regressions
+
+
+parser = argparse.ArgumentParser(description="⏱️ Offline pipeline benchmarks on synthetic orthomosaics")
+parser.add_argument("--scales", default=",".join(DEFAULT_SCALES),
+                    help=f"Comma-separated mosaic scales from {', '.join(SCALES)}")
+parser.add_argument("--formats", default=",".join(FORMATS), help="Comma-separated input formats: tif, jpg")
+parser.add_argument("--repeats", type=int, default=REPEATS, help="Runs per scenario; the best time is kept")
+parser.add_argument("--dedup", choices=["dbscan", "partitioned", "nms"], default=DEDUP_METHOD)
+parser.add_argument("--merge-format", choices=["jpeg", "dzi", "cog"], default=MERGE_FORMAT)
+parser.add_argument("--bench-dir", default=BENCH_DIR, help="Synthetic data, work files, profiles and results")
+parser.add_argument("--baseline", help="Stored results to compare against (default <bench-dir>/baseline.json)")
+parser.add_argument("--save-baseline", action="store_true", help="Store this run as the new baseline")
+parser.add_argument("--profile", action="store_true", help="cProfile each stage (first repeat) and print hot spots")
+parser.add_argument("--keep", action="store_true", help="Keep the tiles and outputs of the last repeat")
+parser.add_argument("--verbose", action="store_true", help="Show the stages' own output")
+
+
+def main():
+    args = parser.parse_args()
+    baseline_path = args.baseline or os.path.join(args.bench_dir, "baseline.json")
+    scales = [s for s in args.scales.split(",") if s]
+    formats = [f for f in args.formats.split(",") if f]
+    unknown = [s for s in scales if s not in SCALES] + [f for f in formats if f not in FORMATS]
+    if unknown:
+        parser.error(f"unknown scale/format: {', '.join(unknown)}")
+
+    results = run_suite(scales, formats, args.repeats, args.bench_dir, args.dedup, args.merge_format,
+                        args.profile, args.verbose, args.keep)
+    results_path = os.path.join(args.bench_dir, f"results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\n💾 Results saved to: {results_path}")
+
+    if args.save_baseline:
+        shutil.copyfile(results_path, baseline_path)
+        print(f"📌 Baseline updated: {baseline_path}")
+        return 0
+    if not os.path.exists(baseline_path):
+        print("⚠️ No baseline yet; rerun with --save-baseline to record one")
+        return 0
+    with open(baseline_path) as f:
+        regressions = compare(results, json.load(f))
+    if regressions:
+        print(f"\n❌ {len(regressions)} regression(s):")
+        for line in regressions:
+            print(f"   {line}")
+        return 1
+    print("\n✅ No regressions against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
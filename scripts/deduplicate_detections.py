@@ -1,56 +1,238 @@
-import csv
+import os
+import multiprocessing
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from sklearn.cluster import DBSCAN
 
-INPUT_CSV = r"C:/Users/palac/Documents/OilPalms/scripts/tiles/detections.csv"
-OUTPUT_CSV = r"C:/Users/palac/Documents/OilPalms/scripts/tiles/deduplicated_detections.csv"
+from stage_types import detection_meta, parse_tile_name, read_detections
+
+INPUT_PATH = r"C:/Users/palac/Documents/OilPalms/scripts/tiles/detections.det"  # .det store or .csv
+OUTPUT_PATH = r"C:/Users/palac/Documents/OilPalms/scripts/tiles/deduplicated_detections.det"
+
+DEDUP_METHOD = "dbscan"  # "dbscan", "partitioned" (DBSCAN split over processes) or "nms" (needs tile overlap)
 
 # DBSCAN params
 EPS = 30  # high-res : 10-15 ; low-res : 20-30 ; dense : 8-12
 MIN_SAMPLES = 1  # allow single detections to be kept
 
-# Load detections
-detections = []
-coords = []
-
-with open(INPUT_CSV, newline='') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        x = float(row['X'])
-        y = float(row['Y'])
-
-        coords.append([x, y])
-        detections.append({
-            'Tile': row['Tile'],
-            'Class': row['Class'],
-            'Conf': float(row['Conf']),
-            'X': x,
-            'Y': y,
-            'W': float(row['W']),
-            'H': float(row['H'])
-        })
-
-coords = np.array(coords)
-db = DBSCAN(eps=EPS, min_samples=MIN_SAMPLES).fit(coords)
-labels = db.labels_
-
-# Group by cluster label
-clustered = {}
-for label, det in zip(labels, detections):
-    clustered.setdefault(label, []).append(det)
-
-# Keep top-confidence detection per cluster
-deduped = []
-for cluster_id, group in clustered.items():
-    best = max(group, key=lambda d: d['Conf'])
-    deduped.append(best)
-
-# Write output
-with open(OUTPUT_CSV, 'w', newline='') as f:
-    writer = csv.DictWriter(f, fieldnames=["Tile", "Class", "Conf", "X", "Y", "W", "H"])
-    writer.writeheader()
-    for det in deduped:
-        writer.writerow(det)
-
-print(f"✅ DBSCAN deduplicated detections saved to: {OUTPUT_CSV}")
-print(f"📦 Original: {len(detections)} → Deduplicated: {len(deduped)}")
+# Partitioned DBSCAN params
+BLOCK_SIZE = 4096  # pixels per block side; each block also sees an EPS-wide halo
+DEDUP_WORKERS = os.cpu_count() or 1
+DEDUP_START_METHOD = "spawn"  # the pipeline starts the pool from worker threads; forking those can deadlock
+
+# Seam NMS params
+TILE_SIZE = 640  # must match tile_image.py
+TILE_OVERLAP = 0  # must match tile_image.py
+IOU_THRESHOLD = 0.5
+CONTAIN_THRESHOLD = 0.8  # intersection / smaller box, catches crowns cut by a tile edge
+CELL_PERCENTILE = 95  # pair-search grid cell = this percentile of box size
+
+
+def deduplicate_dbscan(detections, eps=EPS, min_samples=MIN_SAMPLES):
+    if not len(detections):
+        return detections
+
+    coords = np.column_stack([detections.x, detections.y])
+    db = DBSCAN(eps=eps, min_samples=min_samples).fit(coords)
+    return best_per_cluster(detections, db.labels_)
+
+
+def best_per_cluster(detections, labels):
+    # Keep top-confidence detection per cluster (first one wins on ties)
+    order = np.lexsort((np.arange(len(labels)), -detections.conf, labels))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = labels[order][1:] != labels[order][:-1]
+    return detections.take(order[first])
+
+
+# === Partitioned DBSCAN ===
+def _cluster_block(coords, eps):
+    return DBSCAN(eps=eps, min_samples=1).fit(coords).labels_
+
+
+def block_memberships(x, y, eps=EPS, block_size=BLOCK_SIZE):
+    # Every point belongs to its own block and to the halo of each
+    # neighbouring block it lies within eps of
+    bx = np.floor(x / block_size).astype(np.int64)
+    by = np.floor(y / block_size).astype(np.int64)
+    fx, fy = x - bx * block_size, y - by * block_size
+    near = {
+        -1: (fx <= eps, fy <= eps),
+        0: (np.ones(len(x), dtype=bool), np.ones(len(y), dtype=bool)),
+        1: (block_size - fx <= eps, block_size - fy <= eps),
+    }
+
+    points, blocks_x, blocks_y, is_core = [], [], [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            idx = np.flatnonzero(near[dx][0] & near[dy][1])
+            points.append(idx)
+            blocks_x.append(bx[idx] + dx)
+            blocks_y.append(by[idx] + dy)
+            is_core.append(np.full(len(idx), dx == 0 and dy == 0))
+    return (np.concatenate(points), np.concatenate(blocks_x),
+            np.concatenate(blocks_y), np.concatenate(is_core))
+
+
+def deduplicate_partitioned(detections, eps=EPS, block_size=BLOCK_SIZE, max_workers=DEDUP_WORKERS):
+    # min_samples=1 DBSCAN clusters are the connected components of the
+    # eps-graph. Each block clusters its points plus an eps halo, which sees
+    # every edge touching the block; halo points then stitch block-local
+    # clusters together, giving exactly the single-pass labels.
+    if block_size < eps:
+        raise ValueError(f"BLOCK_SIZE ({block_size}) must be at least EPS ({eps})")
+    n = len(detections)
+    if not n:
+        return detections
+
+    points, blocks_x, blocks_y, is_core = block_memberships(detections.x, detections.y, eps, block_size)
+    order = np.lexsort((points, blocks_y, blocks_x))
+    points, blocks_x, blocks_y, is_core = points[order], blocks_x[order], blocks_y[order], is_core[order]
+    change = np.flatnonzero((np.diff(blocks_x) != 0) | (np.diff(blocks_y) != 0)) + 1
+    groups = np.split(np.arange(len(points)), change)
+    if len(groups) == 1:
+        return deduplicate_dbscan(detections, eps)
+
+    coords = np.column_stack([detections.x, detections.y])
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             mp_context=multiprocessing.get_context(DEDUP_START_METHOD)) as executor:
+        local_labels = list(executor.map(_cluster_block, [coords[points[g]] for g in groups],
+                                         [eps] * len(groups)))
+
+    # Number block-local clusters globally, then join them via halo points
+    offsets = np.cumsum([0] + [int(labels.max()) + 1 for labels in local_labels])
+    component = np.concatenate([labels + offset for labels, offset in zip(local_labels, offsets[:-1])])
+    home = np.empty(n, dtype=np.int64)
+    home[points[is_core]] = component[is_core]
+    halo = ~is_core
+    links = coo_matrix((np.ones(int(halo.sum())), (home[points[halo]], component[halo])),
+                       shape=(offsets[-1], offsets[-1]))
+    _, merged = connected_components(links, directed=False)
+
+    # Relabel by first member so the output order matches single-pass DBSCAN
+    labels = merged[home]
+    first_seen = np.full(labels.max() + 1, n, dtype=np.int64)
+    np.minimum.at(first_seen, labels, np.arange(n))
+    return best_per_cluster(detections, first_seen[labels])
+
+
+# === Seam-aware NMS ===
+def seam_candidates(detections, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    # A box lying wholly inside the part of its tile that no neighbour covers
+    # cannot overlap a box from another tile, so only seam boxes are compared.
+    names, tile_ids = np.unique(detections.tile.astype(str), return_inverse=True)
+    offsets = np.array([parse_tile_name(n) for n in names], dtype=np.float64).reshape(-1, 2)[tile_ids]
+    tx, ty = offsets[:, 0], offsets[:, 1]
+    half_w, half_h = detections.w / 2, detections.h / 2
+
+    interior = (
+        (detections.x - half_w >= tx + overlap) & (detections.x + half_w <= tx + tile_size - overlap)
+        & (detections.y - half_h >= ty + overlap) & (detections.y + half_h <= ty + tile_size - overlap)
+    )
+    return ~interior, tile_ids
+
+
+def _cell_pairs(x, y, w, h, cell):
+    # All (i, j) whose boxes cover a common grid cell. Each box is inserted
+    # into every cell its extent touches, so boxes up to a cell wide land in
+    # at most four and outliers in as many as they span; any two overlapping
+    # boxes share a cell. Pairs are returned once, in both directions.
+    x0, y0 = np.floor((x - w / 2) / cell).astype(np.int64), np.floor((y - h / 2) / cell).astype(np.int64)
+    x1, y1 = np.floor((x + w / 2) / cell).astype(np.int64), np.floor((y + h / 2) / cell).astype(np.int64)
+    nx, ny = x1 - x0 + 1, y1 - y0 + 1
+    counts = nx * ny
+    box = np.repeat(np.arange(len(x)), counts)
+    k = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+    cx, cy = x0[box] + k % nx[box], y0[box] + k // nx[box]
+    cy = cy - cy.min()
+    keys = (cx - cx.min()) * (int(cy.max()) + 1) + cy
+
+    # Every member of a cell paired with every member of the same cell
+    order = np.argsort(keys, kind="stable")
+    box, keys = box[order], keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    sizes = np.diff(np.r_[starts, len(keys)])
+    per_member = np.repeat(sizes, sizes)
+    first_of = np.repeat(starts, sizes)
+    firsts = np.repeat(box, per_member)
+    offsets = np.arange(int(per_member.sum())) - np.repeat(np.cumsum(per_member) - per_member, per_member)
+    seconds = box[np.repeat(first_of, per_member) + offsets]
+
+    pairs = np.unique(firsts * len(x) + seconds)
+    return pairs // len(x), pairs % len(x)
+
+
+def deduplicate_nms(detections, tile_size=TILE_SIZE, overlap=TILE_OVERLAP,
+                    iou_threshold=IOU_THRESHOLD, contain_threshold=CONTAIN_THRESHOLD):
+    # Greedy NMS across tiles: in confidence order, a box that survives
+    # suppresses every weaker overlapping box of its class from another
+    # tile. A box suppressed itself suppresses nothing, so in a chain
+    # A > B > C where only A-B and B-C overlap, A and C are both kept.
+    if not len(detections):
+        return detections
+
+    seam, tile_ids = seam_candidates(detections, tile_size, overlap)
+    idx = np.flatnonzero(seam)
+    if len(idx) < 2:
+        return detections
+
+    x, y = detections.x[idx], detections.y[idx]
+    w, h = detections.w[idx], detections.h[idx]
+    cls, conf, tiles = detections.cls[idx], detections.conf[idx], tile_ids[idx]
+
+    # Cells sized from typical boxes; an outlier box spans more cells instead
+    # of widening every cell
+    cell = max(float(np.percentile(np.maximum(w, h), CELL_PERCENTILE)), 1.0)
+    i, j = _cell_pairs(x, y, w, h, cell)
+
+    # i may suppress j: same class, different tile, i ranks higher
+    rank = np.empty(len(idx), dtype=np.int64)
+    rank[np.lexsort((np.arange(len(idx)), -conf))] = np.arange(len(idx))
+    keep = (cls[i] == cls[j]) & (tiles[i] != tiles[j]) & (rank[i] < rank[j])
+    i, j = i[keep], j[keep]
+
+    ix = np.clip(np.minimum(x[i] + w[i] / 2, x[j] + w[j] / 2) - np.maximum(x[i] - w[i] / 2, x[j] - w[j] / 2), 0, None)
+    iy = np.clip(np.minimum(y[i] + h[i] / 2, y[j] + h[j] / 2) - np.maximum(y[i] - h[i] / 2, y[j] - h[j] / 2), 0, None)
+    inter = ix * iy
+    area_i, area_j = w[i] * h[i], w[j] * h[j]
+    iou = inter / np.maximum(area_i + area_j - inter, 1e-9)
+    contain = inter / np.maximum(np.minimum(area_i, area_j), 1e-9)
+    hit = (iou >= iou_threshold) | (contain >= contain_threshold)
+    i, j = i[hit], j[hit]
+
+    # Resolve in rank order: only boxes still standing suppress their targets
+    order = np.argsort(rank[i], kind="stable")
+    i, j = i[order], j[order]
+    starts = np.flatnonzero(np.r_[True, i[1:] != i[:-1]]) if len(i) else np.empty(0, dtype=np.intp)
+    suppressed = np.zeros(len(idx), dtype=bool)
+    for start, end in zip(starts.tolist(), np.r_[starts[1:], len(i)].tolist()):
+        if not suppressed[i[start]]:
+            suppressed[j[start:end]] = True
+
+    removed = np.zeros(len(detections), dtype=bool)
+    removed[idx[suppressed]] = True
+    return detections.take(np.flatnonzero(~removed))
+
+
+def deduplicate(detections, method=DEDUP_METHOD, tile_size=TILE_SIZE, overlap=TILE_OVERLAP,
+                max_workers=DEDUP_WORKERS, eps=EPS, block_size=BLOCK_SIZE):
+    if method == "dbscan":
+        return deduplicate_dbscan(detections, eps)
+    if method == "partitioned":
+        return deduplicate_partitioned(detections, eps, block_size, max_workers)
+    if method == "nms":
+        if overlap <= 0:
+            raise ValueError("NMS dedup needs overlapping tiles (overlap > 0)")
+        return deduplicate_nms(detections, tile_size, overlap)
+    raise ValueError(f"Unknown dedup method: {method!r}")
+
+
+if __name__ == "__main__":
+    detections = read_detections(INPUT_PATH)
+    deduped = deduplicate(detections, DEDUP_METHOD)
+    deduped.save(OUTPUT_PATH, meta=detection_meta(INPUT_PATH))
+
+    print(f"✅ {DEDUP_METHOD.upper()} deduplicated detections saved to: {OUTPUT_PATH}")
+    print(f"📦 Original: {len(detections)} → Deduplicated: {len(deduped)}")
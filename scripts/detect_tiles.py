@@ -1,53 +1,249 @@
 import os
-import glob
-import csv
-from ultralytics import YOLO
-from pathlib import Path
+import time
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import numpy as np
 from tqdm import tqdm
 
+from stage_types import Detections, tiles_from_dir
+
 # Updated TILE_DIR to reflect actual saved tiles directory
 TILE_DIR = r"C:/Users/palac/Documents/Oilpalms/scripts/tiles"
 MODEL_PATH = r"C:/Users/palac/Documents/Oilpalms/model/best.pt"
-OUTPUT_CSV = os.path.join(TILE_DIR, "detections.csv")
+OUTPUT_PATH = os.path.join(TILE_DIR, "detections.det")  # columnar store; Detections.to_csv on demand
+BATCH_SIZE = 16  # tiles per forward pass
+CONF_THRESHOLD = 0.25  # ultralytics defaults, pinned so cached detections know what produced them
+NMS_IOU = 0.7
+INFERENCE_SHARDS = 1  # worker processes; 1 runs in-process, 0 calibrates a layout on the first tiles
+CALIBRATION_ROUNDS = 2  # timed batches per worker for each candidate layout
+SHARD_START_METHOD = "spawn"  # fresh interpreters, so torch thread pools are set before first use
 
-CLASS_NAMES = ['Oil Palm', 'VOP']
 
-# Ensure model exists
-if not os.path.exists(MODEL_PATH):
-    raise FileNotFoundError(f"❌ Model file not found: {MODEL_PATH}")
+# === Load model ===
+def load_model(model_path=MODEL_PATH, backend="torch", threads=0):
+    # Ensure model exists
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"❌ Model file not found: {model_path}")
 
-# Get tile images
-tile_paths = glob.glob(os.path.join(TILE_DIR, "*.jpg"))
-if not tile_paths:
-    raise FileNotFoundError(f"❌ No tile images found in {TILE_DIR}")
+    if backend != "torch":
+        # Exported .onnx file, see inference_backends.prepare_backend
+        from inference_backends import OnnxDetector
+        return OnnxDetector(model_path, threads)
+    from ultralytics import YOLO
+    return YOLO(model_path)
 
-# Load model
-model = YOLO(MODEL_PATH)
 
-# Prepare output
-with open(OUTPUT_CSV, 'w', newline='') as f:
-    writer = csv.writer(f)
-    writer.writerow(["Tile", "Class", "Conf", "X", "Y", "W", "H"])
+# === Batched detection ===
+def _batches(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
 
-    for tile_path in tqdm(tile_paths, desc="🧠 Detecting tiles"):
-        tile_name = Path(tile_path).name
 
-        try:
-            x_offset = int(tile_name.split("_")[-2])
-            y_offset = int(tile_name.split("_")[-1].split(".")[0])
-        except (IndexError, ValueError):
-            print(f"⚠️ Skipping file with unexpected name format: {tile_name}")
-            continue
+def _to_numpy(values):
+    return values.cpu().numpy() if hasattr(values, "cpu") else np.asarray(values)
+
+
+def detect_batch(model, batch, arrays=None):
+    if arrays is None:
+        sources = [tile.path for tile in batch]
+    else:
+        # In-memory tiles are RGB; ultralytics expects numpy input as BGR
+        sources = [np.ascontiguousarray(array[..., ::-1]) for array in arrays]
+    results = model(sources, batch=len(batch), conf=CONF_THRESHOLD, iou=NMS_IOU, verbose=False)
+
+    # Pull whole box arrays per image instead of calling .item() per box
+    counts = np.array([len(r.boxes) for r in results], dtype=np.intp)
+    if not counts.sum():
+        return Detections()
+    boxes = [r.boxes for r in results if len(r.boxes)]
+    xywh = np.concatenate([_to_numpy(b.xywh) for b in boxes]).astype(np.float64)
+    conf = np.concatenate([_to_numpy(b.conf) for b in boxes]).astype(np.float64)
+    cls = np.concatenate([_to_numpy(b.cls) for b in boxes]).astype(np.int8)
+
+    # Shift every box into image coordinates with one vectorized add
+    offsets = np.array([(tile.x, tile.y) for tile in batch], dtype=np.float64)
+    xywh[:, :2] += np.repeat(offsets, counts, axis=0)
+    names = np.array([tile.name for tile in batch], dtype=object)
+
+    return Detections(
+        tile=np.repeat(names, counts), cls=cls, conf=np.round(conf, 3),
+        x=xywh[:, 0], y=xywh[:, 1], w=xywh[:, 2], h=xywh[:, 3],
+    )
+
+
+def detect_tiles(tiles, model, batch_size=BATCH_SIZE, on_batch=None):
+    if not tiles:
+        raise FileNotFoundError("❌ No tile images to detect")
+
+    parts = []
+    with tqdm(total=len(tiles), desc="🧠 Detecting tiles") as progress:
+        for batch in _batches(tiles, batch_size):
+            parts.append(detect_batch(model, batch))
+            if on_batch:
+                on_batch(batch, parts[-1])
+            progress.update(len(batch))
+
+    return Detections.concat(parts)
+
+
+def stream_batches(tile_stream, batch_size=BATCH_SIZE):
+    # Group (Tile, array) pairs into (tiles, arrays) batches as they arrive
+    batch, arrays = [], []
+    for tile, array in tile_stream:
+        batch.append(tile)
+        arrays.append(array)
+        if len(batch) == batch_size:
+            yield batch, arrays
+            batch, arrays = [], []
+    if batch:
+        yield batch, arrays
+
+
+def detect_stream(tile_stream, model, batch_size=BATCH_SIZE, on_batch=None, allow_empty=False):
+    # Consume (Tile, array) pairs as they are produced, batching in memory
+    tiles, parts = [], []
+    with tqdm(desc="🧠 Detecting tiles (streaming)", unit="tile") as progress:
+        for batch, arrays in stream_batches(tile_stream, batch_size):
+            parts.append(detect_batch(model, batch, arrays))
+            if on_batch:
+                on_batch(batch, parts[-1])
+            tiles.extend(batch)
+            progress.update(len(batch))
+
+    if not tiles and not allow_empty:
+        raise FileNotFoundError("❌ No tile images to detect")
+    return Detections.concat(parts), tiles
+
+
+# === Sharded CPU inference ===
+_worker_model = None
 
-        results = model(tile_path)[0]
-        for box in results.boxes:
-            cls = int(box.cls.item())
-            conf = float(box.conf.item())
-            x_center, y_center, w, h = map(float, box.xywh[0])
 
-            abs_x = x_center + x_offset
-            abs_y = y_center + y_offset
+def _init_worker(model_path, threads, backend):
+    # Once per worker process: size torch's / ONNX Runtime's thread pools, then load the model
+    global _worker_model
+    os.environ["OMP_NUM_THREADS"] = os.environ["MKL_NUM_THREADS"] = str(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+    except (ImportError, RuntimeError):
+        pass
+    _worker_model = load_model(model_path, backend, threads)
+
+
+def _worker_batch(batch, arrays):
+    return detect_batch(_worker_model, batch, arrays)
+
+
+def shard_layouts(cores=None):
+    # (processes, threads per process) candidates that together use every core
+    cores = cores or os.cpu_count() or 1
+    layouts, processes = [], 1
+    while processes <= cores:
+        layouts.append((processes, cores // processes))
+        processes *= 2
+    return layouts
+
+
+class ShardedDetector:
+    """Worker processes that each load the model once and detect whole batches.
+
+    Batches go to whichever worker is free and results are collected in
+    submission order, so the output matches in-process detection row for row.
+    """
+
+    def __init__(self, model_path, processes, threads, backend="torch"):
+        self.processes, self.threads = processes, threads
+        self.executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context(SHARD_START_METHOD),
+                                            initializer=_init_worker, initargs=(model_path, threads, backend))
+
+    def run(self, batches, on_batch=None, limit=None, progress=None):
+        # Detect (tiles, arrays or None) batches; stops after `limit` batches.
+        # Returns (detections, tiles done).
+        parts, pending, done = [], deque(), 0
+
+        def _collect():
+            batch, future = pending.popleft()
+            parts.append(future.result())
+            if on_batch:
+                on_batch(batch, parts[-1])
+            if progress is not None:
+                progress.update(len(batch))
+            return len(batch)
+
+        for batch, arrays in islice(batches, limit):
+            pending.append((batch, self.executor.submit(_worker_batch, batch, arrays)))
+            if len(pending) >= 2 * self.processes:  # bound tiles in flight
+                done += _collect()
+        while pending:
+            done += _collect()
+        return Detections.concat(parts), done
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def calibrate_shards(model_path, batches, on_batch=None, layouts=None, rounds=CALIBRATION_ROUNDS, progress=None,
+                     backend="torch"):
+    # Time each layout on the next batches of the real work (their detections
+    # go to on_batch like any others) and keep the fastest pool running.
+    # Returns (detector, detections from calibration).
+    best, best_rate, parts = None, 0.0, []
+    for processes, threads in layouts or shard_layouts():
+        detector = ShardedDetector(model_path, processes, threads, backend)
+        warm, _ = detector.run(batches, on_batch, limit=processes, progress=progress)  # every worker loads once
+        start = time.perf_counter()
+        timed, done = detector.run(batches, on_batch, limit=rounds * processes, progress=progress)
+        rate = done / max(time.perf_counter() - start, 1e-9)
+        parts += [warm, timed]
+        print(f"⏱️ {processes} process(es) x {threads} thread(s): {rate:.1f} tiles/s")
+        if best is None or rate > best_rate:
+            if best is not None:
+                best.close()
+            best, best_rate = detector, rate
+        else:
+            detector.close()
+        if not done:  # ran out of tiles
+            break
+    print(f"⚙️ Inference layout: {best.processes} process(es) x {best.threads} thread(s)")
+    return best, Detections.concat(parts)
+
+
+def detect_sharded(tiles, model_path, batch_size=BATCH_SIZE, on_batch=None, shards=INFERENCE_SHARDS, arrays=None,
+                   detector=None, backend="torch"):
+    # detect_tiles over worker processes; shards=0 calibrates the layout first
+    if not tiles:
+        raise FileNotFoundError("❌ No tile images to detect")
+    batches = ((batch, None if arrays is None else arrays[start:start + batch_size])
+               for start, batch in zip(range(0, len(tiles), batch_size), _batches(tiles, batch_size)))
+    owned = detector is None
+    parts = []
+    with tqdm(total=len(tiles), desc="🧠 Detecting tiles (sharded)") as progress:
+        if detector is None and not shards:
+            detector, calibrated = calibrate_shards(model_path, batches, on_batch, progress=progress, backend=backend)
+            parts.append(calibrated)
+        elif detector is None:
+            detector = ShardedDetector(model_path, shards, max(1, (os.cpu_count() or 1) // shards), backend)
+        try:
+            parts.append(detector.run(batches, on_batch, progress=progress)[0])
+        finally:
+            if owned:
+                detector.close()
+    return Detections.concat(parts)
+
 
-            writer.writerow([tile_name, CLASS_NAMES[cls], round(conf, 3), abs_x, abs_y, w, h])
+if __name__ == "__main__":
+    # Get tile images
+    tiles = tiles_from_dir(TILE_DIR)
+    if not tiles:
+        raise FileNotFoundError(f"❌ No tile images found in {TILE_DIR}")
 
-print(f"\n✅ Detection CSV saved to {OUTPUT_CSV}")
+    if INFERENCE_SHARDS == 1:
+        detections = detect_tiles(tiles, load_model(MODEL_PATH), BATCH_SIZE)
+    else:
+        detections = detect_sharded(tiles, MODEL_PATH, BATCH_SIZE, shards=INFERENCE_SHARDS)
+    detections.save(OUTPUT_PATH)
+    print(f"\n✅ Detections saved to {OUTPUT_PATH}")
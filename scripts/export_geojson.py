@@ -1,54 +1,126 @@
 import os
-import csv
 import json
 from PIL import Image
 
+from stage_types import CLASS_NAMES, detection_meta, read_detections
+
 # === Configurable paths ===
-CSV_PATH = r"C:/Users/palac/Documents/Oilpalms/scripts/tiles/deduplicated_detections.csv"
-IMAGE_PATH = r"C:/Users/palac/Documents/Oilpalms/scripts/output/merged_result.jpg"
+DETECTIONS_PATH = r"C:/Users/palac/Documents/Oilpalms/scripts/tiles/deduplicated_detections.det"
+IMAGE_PATH = r"C:/Users/palac/Documents/Oilpalms/scripts/output/merged_result.jpg"  # only for CSV input
 OUTPUT_PATH = r"C:/Users/palac/Documents/Oilpalms/scripts/output/detection_geojson_corrected.geojson"
+EXPORT_FORMAT = "geojson"  # "geojson" (compact), "ndjson" (one feature per line) or "fgb" (FlatGeobuf)
+EXPORT_EXTS = {"geojson": "geojson", "ndjson": "ndjson", "fgb": "fgb"}
+CHUNK = 65536  # features encoded per write
 
-# === Load image to get width and height ===
-image = Image.open(IMAGE_PATH)
-image_width, image_height = image.size
-print(f"🖼️ Loaded image with dimensions: {image_width} x {image_height}")
 
-features = []
+def _feature_chunks(detections, image_height, chunk=CHUNK, coords=None):
+    # Compact feature strings, identical to json.dumps(feature, separators=(",", ":"))
+    class_json = [json.dumps(name) for name in CLASS_NAMES]
+    tile_json = {}
+    for start in range(0, len(detections), chunk):
+        part = detections.take(slice(start, start + chunk))
+        # Apply 180° rotation (mirror X and Y)
+        px, py = part.x.tolist(), (image_height - part.y).tolist()
+        tiles = [tile_json.get(tile) or tile_json.setdefault(tile, json.dumps(tile)) for tile in part.tile.tolist()]
+        if coords is None:
+            yield [
+                '{"type":"Feature","geometry":{"type":"Point","coordinates":[%r,%r]},'
+                '"properties":{"class":%s,"confidence":%r,"tile":%s}}'
+                % (x, y, class_json[cls], conf, tile)
+                for x, y, cls, conf, tile in zip(px, py, part.cls.tolist(), part.conf.tolist(), tiles)
+            ]
+        else:
+            # Map coordinates as geometry; px/py keep the GUI's image position
+            wx, wy = coords[0][start:start + chunk].tolist(), coords[1][start:start + chunk].tolist()
+            yield [
+                '{"type":"Feature","geometry":{"type":"Point","coordinates":[%r,%r]},'
+                '"properties":{"class":%s,"confidence":%r,"tile":%s,"px":%r,"py":%r}}'
+                % (x, y, class_json[cls], conf, tile, p, q)
+                for x, y, cls, conf, tile, p, q in zip(wx, wy, part.cls.tolist(), part.conf.tolist(), tiles, px, py)
+            ]
 
-# === Read and transform detection data ===
-with open(CSV_PATH, newline='') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        class_name = row['Class']
-        x = float(row['X'])
-        y = float(row['Y'])
 
-        # Apply 180° rotation (mirror X and Y)
-        corrected_x = x
-        corrected_y = image_height - y
-
-        feature = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [corrected_x, corrected_y]
-            },
-            "properties": {
-                "class": class_name,
-                "confidence": float(row['Conf']),
-                "tile": row['Tile']
-            }
-        }
-        features.append(feature)
-
-# === Save to GeoJSON ===
-geojson = {
-    "type": "FeatureCollection",
-    "features": features
-}
-
-os.makedirs(os.path.dirname(OUTPUT_PATH), exist_ok=True)
-with open(OUTPUT_PATH, 'w') as f:
-    json.dump(geojson, f, indent=2)
-
-print(f"✅ Rotated + flipped GeoJSON saved to: {OUTPUT_PATH}")
+def _crs_member(crs):
+    # Pre-RFC 7946 named CRS, only written for non-WGS84 map coordinates
+    if crs is None or crs == "EPSG:4326":
+        return ""
+    return '"crs":{"type":"name","properties":{"name":%s}},' % json.dumps(crs)
+
+
+def _georef_member(georef):
+    # Display-space (px, py) to source CRS affine, read by the GUI to move features
+    if georef is None:
+        return ""
+    return '"georef":%s,' % json.dumps(georef, separators=(",", ":"))
+
+
+def _write_geojson(detections, image_height, output_path, chunk, coords=None, crs=None, georef=None):
+    with open(output_path, "w") as f:
+        f.write('{"type":"FeatureCollection",%s%s"features":[' % (_crs_member(crs), _georef_member(georef)))
+        first = True
+        for features in _feature_chunks(detections, image_height, chunk, coords):
+            if not first:
+                f.write(",")
+            f.write(",".join(features))
+            first = False
+        f.write("]}")
+
+
+def _write_ndjson(detections, image_height, output_path, chunk, coords=None, crs=None, georef=None):
+    with open(output_path, "w") as f:
+        for features in _feature_chunks(detections, image_height, chunk, coords):
+            f.write("\n".join(features))
+            f.write("\n")
+
+
+def _write_flatgeobuf(detections, image_height, output_path, chunk, coords=None, crs=None, georef=None):
+    import fiona  # only needed for FlatGeobuf output, so the other formats import without GDAL
+
+    properties = {"class": "str", "confidence": "float", "tile": "str"}
+    if coords is not None:
+        properties.update(px="float", py="float")
+    schema = {"geometry": "Point", "properties": properties}
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    # GDAL's FlatGeobuf driver builds the packed Hilbert R-tree index on close
+    with fiona.open(output_path, "w", driver="FlatGeobuf", schema=schema, crs=crs, SPATIAL_INDEX="YES") as dst:
+        for start in range(0, len(detections), chunk):
+            part = detections.take(slice(start, start + chunk))
+            px, py = part.x.tolist(), (image_height - part.y).tolist()
+            xs, ys = (px, py) if coords is None else \
+                (coords[0][start:start + chunk].tolist(), coords[1][start:start + chunk].tolist())
+            records = []
+            for x, y, cls, conf, tile, p, q in zip(xs, ys, part.cls.tolist(), part.conf.tolist(),
+                                                   part.tile.tolist(), px, py):
+                props = {"class": CLASS_NAMES[cls], "confidence": conf, "tile": tile}
+                if coords is not None:
+                    props.update(px=p, py=q)
+                records.append({"geometry": {"type": "Point", "coordinates": (x, y)}, "properties": props})
+            dst.writerecords(records)
+
+
+def export_geojson(detections, image_height, output_path=OUTPUT_PATH, fmt=EXPORT_FORMAT, chunk=CHUNK,
+                   coords=None, crs=None, georef=None):
+    # coords: optional (X, Y) map coordinates from georeference.py, in crs;
+    # georef: optional {"transform", "crs"} from px/py to the source CRS (GeoJSON only)
+    writers = {"geojson": _write_geojson, "ndjson": _write_ndjson, "fgb": _write_flatgeobuf}
+    if fmt not in writers:
+        raise ValueError(f"Unknown export format: {fmt!r}")
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    writers[fmt](detections, image_height, output_path, chunk, coords, crs, georef)
+
+    space = f"{crs} coordinates" if coords is not None else "rotated + flipped pixel coordinates"
+    print(f"✅ {fmt.upper()} ({len(detections)} features, {space}) saved to: {output_path}")
+    return output_path
+
+
+if __name__ == "__main__":
+    # === Image height from the detection store, falling back to the merged image ===
+    image_height = detection_meta(DETECTIONS_PATH).get("image_height")
+    if image_height is None:
+        with Image.open(IMAGE_PATH) as image:
+            image_height = image.height
+    print(f"🖼️ Image height: {image_height}")
+
+    export_geojson(read_detections(DETECTIONS_PATH), image_height, OUTPUT_PATH)
@@ -1,43 +1,28 @@
 import os
-import csv
+import base64
 from datetime import datetime
+from html import escape
+from pathlib import Path
+from urllib.parse import quote
+
+import numpy as np
+
+from stage_types import CLASS_NAMES, read_detections
+from aggregate import AGGREGATES_NAME, aggregate_paths, load_aggregates
+from overlay import CLASS_COLORS
 
 # === Configuration ===
 PROJECT_ROOT = r"C:/Users/palac/Documents/Oilpalms"
 TILE_DIR     = os.path.join(PROJECT_ROOT, "scripts", "tiles")
 OUTPUT_DIR   = os.path.join(PROJECT_ROOT, "scripts", "output")
 REPORT_DIR   = os.path.join(PROJECT_ROOT, "reports")
-os.makedirs(REPORT_DIR, exist_ok=True)
 
-CSV_PATH     = os.path.join(TILE_DIR, "deduplicated_detections.csv")
+DETECTIONS_PATH = os.path.join(TILE_DIR, "deduplicated_detections.det")
 MERGED_IMAGE = os.path.join(OUTPUT_DIR, "merged_with_exif.jpg")
 GEOJSON_PATH = os.path.join(OUTPUT_DIR, "detection_geojson.geojson")
 
-# === Output Report Filename ===
-timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-REPORT_NAME = f"oil_palm_report_{timestamp}.html"
-REPORT_PATH = os.path.join(REPORT_DIR, REPORT_NAME)
-
-# === Count Classes ===
-count_oil_palm = 0
-count_vop = 0
-total = 0
-
-if not os.path.exists(CSV_PATH):
-    raise FileNotFoundError(f"❌ Deduplicated Detection CSV not found: {CSV_PATH}")
-
-with open(CSV_PATH, newline='') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        cls = row['Class'].lower()
-        if cls == 'oil palm':
-            count_oil_palm += 1
-        elif cls == 'vop':
-            count_vop += 1
-        total += 1
-
-# === Build HTML ===
-html = f"""<!DOCTYPE html>
+# === HTML Template ===
+HTML_TEMPLATE = """<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
@@ -114,6 +99,48 @@ html = f"""<!DOCTYPE html>
             margin-top: 10px;
             margin-bottom: 20px;
         }}
+        table.metrics {{
+            border-collapse: collapse;
+            width: 100%;
+            font-size: 14px;
+        }}
+        table.metrics th, table.metrics td {{
+            padding: 6px 10px;
+            border-bottom: 1px solid #ddd;
+            text-align: right;
+        }}
+        table.metrics th:first-child, table.metrics td:first-child {{
+            text-align: left;
+        }}
+        .dark-mode table.metrics th, .dark-mode table.metrics td {{
+            border-color: #444;
+        }}
+        .views {{
+            display: flex;
+            flex-wrap: wrap;
+            gap: 20px;
+        }}
+        .views figure {{
+            flex: 1 1 400px;
+            margin: 0;
+        }}
+        .hist {{
+            display: flex;
+            align-items: flex-end;
+            gap: 2px;
+            height: 80px;
+            margin-bottom: 4px;
+        }}
+        .hist span {{
+            flex: 1;
+            min-height: 1px;
+        }}
+        .hist-axis {{
+            display: flex;
+            justify-content: space-between;
+            font-size: 12px;
+            margin-bottom: 12px;
+        }}
     </style>
 </head>
 <body>
@@ -130,20 +157,16 @@ html = f"""<!DOCTYPE html>
         <p>🔵 VOPs: <strong>{count_vop}</strong></p>
         <p>🧮 Total Detections: <strong>{total}</strong></p>
     </div>
+{metrics_section}
 
     <div class="stats">
         <h2>📂 Download Files</h2>
         <ul>
-            <li><a href="../scripts/output/merged_with_exif.jpg" download>📷 Merged Image with EXIF</a></li>
-            <li><a href="../scripts/tiles/detections.csv" download>📄 deduplicated_detections.csv</a></li>
-            <li><a href="../scripts/output/detection_geojson.geojson" download>🌍 GeoJSON</a></li>
+            {downloads}
         </ul>
     </div>
 
-    <div class="preview">
-        <h2>🖼️ Merged Image Preview</h2>
-        <img id="previewImg" src="../scripts/output/merged_with_exif.jpg" alt="Merged Image">
-    </div>
+{images_section}
 
     <div class="fullscreen" id="fullscreen">
         <img id="fullImg" src="">
@@ -157,30 +180,191 @@ html = f"""<!DOCTYPE html>
             body.classList.toggle('dark-mode');
         }});
 
-        const previewImg = document.getElementById('previewImg');
         const fullscreen = document.getElementById('fullscreen');
         const fullImg = document.getElementById('fullImg');
 
-        previewImg.addEventListener('click', () => {{
-            fullImg.src = previewImg.src;
-            fullscreen.style.display = 'flex';
+        // The full-resolution image is only fetched when a preview is clicked
+        document.querySelectorAll('img.zoom').forEach(img => {{
+            img.addEventListener('click', () => {{
+                fullImg.src = img.dataset.full || img.src;
+                fullscreen.style.display = 'flex';
+            }});
         }});
 
         fullscreen.addEventListener('click', () => {{
             fullscreen.style.display = 'none';
+            fullImg.src = '';
         }});
     </script>
 </body>
 </html>
 """
 
-# === Save HTML file ===
-with open(REPORT_PATH, "w", encoding="utf-8") as f:
-    f.write(html)
 
-# Save a base copy for auto-preview
-legacy = os.path.join(PROJECT_ROOT, "oil_palm_report.html")
-with open(legacy, "w", encoding="utf-8") as f:
-    f.write(html)
+METRICS_TEMPLATE = """
+    <div class="stats">
+        <h2>⏱️ Run Metrics</h2>
+        <table class="metrics">
+            <tr><th>Stage</th><th>Wall (s)</th><th>CPU (s)</th><th>Peak RSS (MB)</th><th>Items</th><th>Throughput</th></tr>
+            {rows}
+        </table>
+    </div>
+"""
+
+
+def metrics_section(telemetry):
+    # Per-stage table from the run telemetry ({"totals": ..., "stages": [...]})
+    if not telemetry:
+        return ""
+    rows = []
+    for stage in telemetry["stages"]:
+        name = stage["name"] + (f" [{stage['image']}]" if stage.get("image") else "")
+        name += " ♻️" if stage.get("cached") else ""
+        items = ", ".join(f"{value:,} {key.replace('_', ' ')}" for key, value in stage["items"].items())
+        rates = [f"{value:,.1f} {key[:-6]}/s" for key, value in stage["throughput"].items()
+                 if key != "mb_written_per_s"]
+        if "mb_written_per_s" in stage["throughput"]:
+            rates.append(f"{stage['throughput']['mb_written_per_s']:.1f} MB/s written")
+        peak = "" if stage["peak_rss_mb"] is None else f"{stage['peak_rss_mb']:.0f}"
+        rows.append(f"<tr><td>{escape(name)}</td><td>{stage['wall_s']:.2f}</td><td>{stage['cpu_s']:.2f}</td>"
+                    f"<td>{peak}</td><td>{escape(items)}</td><td>{escape(', '.join(rates))}</td></tr>")
+    totals = telemetry["totals"]
+    peak = "" if totals["peak_rss_mb"] is None else f"{totals['peak_rss_mb']:.0f}"
+    rows.append(f"<tr><th>Total</th><th>{totals['wall_s']:.2f}</th><th>{totals['cpu_s']:.2f}</th>"
+                f"<th>{peak}</th><th></th><th></th></tr>")
+    return METRICS_TEMPLATE.format(rows="\n            ".join(rows))
+
+
+IMAGE_TEMPLATE = """
+    <div class="stats preview">
+        <h2>🗺️ {name}</h2>
+        <p>{counts}</p>
+        <p>{density}</p>
+        <div class="views">
+            <figure>
+                <img class="zoom" src="{preview}" data-full="{full_src}" alt="{name} preview">
+                <figcaption>🖼️ Preview, click for {full_label}</figcaption>
+            </figure>
+            <figure>
+                <img class="zoom" src="{heatmap}" alt="{name} density heatmap">
+                <figcaption>🔥 Detections per {cell}px cell</figcaption>
+            </figure>
+        </div>
+        <h3>🎯 Confidence</h3>
+        {histograms}
+        <p><a href="{full_uri}">📂 Full-resolution output</a></p>
+    </div>
+"""
+
+
+def relative_uri(path, report_dir):
+    # Link from the report's directory; a path it cannot reach relatively
+    # (another drive on Windows) falls back to an absolute file URI
+    try:
+        return quote(Path(os.path.relpath(path, report_dir)).as_posix())
+    except ValueError:
+        return Path(os.path.abspath(path)).as_uri()
+
+
+def download_links(downloads, report_dir):
+    # downloads: (label, path) pairs; outputs that were not written are left out
+    links = [f'<li><a href="{escape(relative_uri(path, report_dir))}" download>'
+             f'{escape(label)} ({escape(os.path.basename(path))})</a></li>'
+             for label, path in downloads or [] if path and os.path.exists(path)]
+    return "\n            ".join(links) or "<li>No output files found.</li>"
+
+
+def data_uri(path, mime):
+    # Embed a small artefact so the report opens without its neighbours
+    with open(path, "rb") as f:
+        return f"data:{mime};base64,{base64.b64encode(f.read()).decode('ascii')}"
+
+
+def histogram_html(stats):
+    # One bar chart per class, bars scaled to that class's fullest bin
+    edges = stats["conf_edges"]
+    charts = []
+    for code, name in enumerate(CLASS_NAMES):
+        hist = stats["conf_hist"][name]
+        if not sum(hist):
+            continue
+        color = "#%02x%02x%02x" % CLASS_COLORS.get(code, (128, 128, 128))
+        peak = max(hist)
+        bars = "".join(f'<span style="height:{100 * n / peak:.1f}%;background:{color}" '
+                       f'title="{lo:.2f}–{hi:.2f}: {n}"></span>'
+                       for n, lo, hi in zip(hist, edges[:-1], edges[1:]))
+        charts.append(f'<p>{escape(name)} (mean {stats["mean_conf"][name]:.2f})</p>'
+                      f'<div class="hist">{bars}</div>'
+                      f'<div class="hist-axis"><span>{edges[0]:.1f}</span><span>{edges[-1]:.1f}</span></div>')
+    return "\n        ".join(charts) or "<p>No detections.</p>"
+
+
+def image_section(image, report_dir):
+    # image: {"name", "stats", "preview", "heatmap", "full"} from the aggregation stage
+    stats = image["stats"]
+    counts = ", ".join(f"{escape(name)}: <strong>{n:,}</strong>" for name, n in stats["counts"].items())
+    density = (f"🌴 Densest {stats['cell']}px cell: <strong>{stats['max_per_cell']}</strong>, "
+               f"mean over {stats['occupied_cells']:,} occupied cells: <strong>{stats['mean_per_occupied_cell']}</strong>")
+    if stats.get("max_per_ha") is not None:
+        density += (f" (peak <strong>{stats['max_per_ha']:,}</strong>/ha, "
+                    f"mean <strong>{stats['mean_per_ha']:,}</strong>/ha)")
+    full_uri = escape(relative_uri(image["full"], report_dir))
+    viewable = os.path.splitext(image["full"])[1].lower() in (".jpg", ".jpeg", ".png")
+    return IMAGE_TEMPLATE.format(
+        name=escape(image["name"]), counts=counts, density=density, cell=stats["cell"],
+        preview=data_uri(image["preview"], "image/jpeg"), heatmap=data_uri(image["heatmap"], "image/jpeg"),
+        full_src=full_uri if viewable else "", full_label="full resolution" if viewable else "a larger view",
+        histograms=histogram_html(stats), full_uri=full_uri,
+    )
+
+
+def generate_report(detections, project_root=PROJECT_ROOT, telemetry=None, images=None, downloads=None):
+    report_dir = os.path.join(project_root, "reports")
+    os.makedirs(report_dir, exist_ok=True)
+
+    # === Output Report Filename ===
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_path = os.path.join(report_dir, f"oil_palm_report_{timestamp}.html")
+
+    # === Count Classes ===
+    # Per-image aggregates already hold the counts; bare detections fall back to one bincount
+    if images:
+        counts = [sum(image["stats"]["counts"][name] for image in images) for name in CLASS_NAMES]
+    else:
+        counts = np.bincount(detections.cls.astype(np.intp), minlength=len(CLASS_NAMES)).tolist()
+    count_oil_palm, count_vop = counts[0], counts[1]
+    total = sum(counts)
+
+    # === Build HTML ===
+    # Links are relative to the file, so each copy is rendered for its own directory
+    def render(directory):
+        return HTML_TEMPLATE.format(timestamp=timestamp, count_oil_palm=count_oil_palm,
+                                    count_vop=count_vop, total=total, metrics_section=metrics_section(telemetry),
+                                    downloads=download_links(downloads, directory),
+                                    images_section="".join(image_section(image, directory) for image in images or []))
+
+    # === Save HTML file ===
+    with open(report_path, "w", encoding="utf-8") as f:
+        f.write(render(report_dir))
+
+    # Save a base copy for auto-preview
+    legacy = os.path.join(project_root, "oil_palm_report.html")
+    with open(legacy, "w", encoding="utf-8") as f:
+        f.write(render(project_root))
+
+    print(f"✅ Enhanced HTML Report saved to: {report_path}")
+    return report_path
+
+
+if __name__ == "__main__":
+    if not os.path.exists(DETECTIONS_PATH):
+        raise FileNotFoundError(f"❌ Deduplicated detections not found: {DETECTIONS_PATH}")
 
-print(f"✅ Enhanced HTML Report saved to: {REPORT_PATH}")
+    images = None
+    if os.path.exists(os.path.join(OUTPUT_DIR, AGGREGATES_NAME)):
+        paths = aggregate_paths(OUTPUT_DIR)
+        images = [{"name": os.path.basename(MERGED_IMAGE), "stats": load_aggregates(OUTPUT_DIR),
+                   "preview": paths["preview"], "heatmap": paths["heatmap"], "full": MERGED_IMAGE}]
+    downloads = [("📷 Merged image with EXIF", MERGED_IMAGE), ("📄 Deduplicated detections", DETECTIONS_PATH),
+                 ("🌍 GeoJSON", GEOJSON_PATH)]
+    generate_report(read_detections(DETECTIONS_PATH), PROJECT_ROOT, images=images, downloads=downloads)
@@ -0,0 +1,96 @@
+import numpy as np
+import rasterio
+from rasterio.warp import transform as warp_transform
+
+from stage_types import read_detections
+from tile_image import is_geotiff
+
+# === CONFIGURATION ===
+DETECTIONS_PATH = r"C:/Users/palac/Documents/OilPalms/scripts/tiles/deduplicated_detections.det"
+SOURCE_IMAGE = r"C:/Users/palac/Documents/OilPalms/input/orthomosaic.tif"
+GEOREF_TARGET = "none"  # "none" (pixel coordinates, what the GUI edits), "native" (source CRS) or "wgs84" (lon/lat)
+REPROJECT_CHUNK = 262144  # points per reprojection call
+WGS84 = "EPSG:4326"
+
+
+def source_georefs(sources, images=None):
+    # {source: (transform, crs)} for every GeoTIFF source that carries a CRS;
+    # images ({path: ImageInfo} from the input catalog) spares reopening them
+    georefs = {}
+    for source in sources:
+        info = images.get(source) if images else None
+        if info is not None and not info.error:
+            if info.georef is not None:
+                georefs[source] = info.georef
+        elif is_geotiff(source):
+            with rasterio.open(source) as src:
+                if src.crs is not None:
+                    georefs[source] = (src.transform, src.crs)
+    return georefs
+
+
+def pixel_to_world(x, y, transform):
+    # Affine in one vectorized pass: X = a*x + b*y + c, Y = d*x + e*y + f
+    a, b, c, d, e, f = transform[:6]
+    return a * x + b * y + c, d * x + e * y + f
+
+
+def display_transform(transform, image_height):
+    # Affine from the exports' display position (px, py) = (x, height - y) to
+    # source map coordinates, so editors can re-derive geometry after a move
+    a, b, c, d, e, f = transform[:6]
+    return [a, -b, b * image_height + c, d, -e, e * image_height + f]
+
+
+def reproject(xs, ys, src_crs, dst_crs=WGS84, chunk=REPROJECT_CHUNK):
+    # GDAL transforms whole arrays; chunks bound the temporary lists it builds
+    out_x, out_y = np.empty_like(xs), np.empty_like(ys)
+    for start in range(0, len(xs), chunk):
+        part_x, part_y = warp_transform(src_crs, dst_crs, xs[start:start + chunk], ys[start:start + chunk])
+        out_x[start:start + chunk], out_y[start:start + chunk] = part_x, part_y
+    return out_x, out_y
+
+
+def georeference(detections, tiles, target=GEOREF_TARGET, chunk=REPROJECT_CHUNK, images=None):
+    # (X, Y, crs) map coordinates for every detection, or None when some
+    # detection comes from a source without a geotransform
+    if target == "none":
+        return None
+    if target not in ("native", "wgs84"):
+        raise ValueError(f"Unknown georeference target: {target!r}")
+
+    tile_source = {t.name: t.source for t in tiles}
+    sources = set(tile_source.values())
+    georefs = source_georefs(sources, images)
+    if len(georefs) < len(sources):
+        print("⚠️ Not every source image is a georeferenced GeoTIFF; keeping pixel coordinates")
+        return None
+
+    crs_set = {crs.to_string() for _, crs in georefs.values()}
+    if target == "native" and len(crs_set) > 1:
+        raise ValueError(f"Sources use different CRSs {sorted(crs_set)}; use the wgs84 target")
+
+    # Source per detection via tile-name runs, not a per-row lookup
+    names, codes = detections.tile_codes()
+    source_ids = {source: i for i, source in enumerate(georefs)}
+    det_source = np.array([source_ids[tile_source[name]] for name in names] or [0], dtype=np.intp)[codes]
+    xs, ys = np.empty(len(detections)), np.empty(len(detections))
+    for source, (transform, crs) in georefs.items():
+        idx = np.flatnonzero(det_source == source_ids[source]) if len(georefs) > 1 else slice(None)
+        world_x, world_y = pixel_to_world(detections.x[idx], detections.y[idx], transform)
+        if target == "wgs84":
+            world_x, world_y = reproject(world_x, world_y, crs, WGS84, chunk)
+        xs[idx], ys[idx] = world_x, world_y
+
+    return xs, ys, WGS84 if target == "wgs84" else crs_set.pop()
+
+
+if __name__ == "__main__":
+    from stage_types import Tile
+    detections = read_detections(DETECTIONS_PATH)
+    tiles = [Tile(name, 0, 0, 0, 0, source=SOURCE_IMAGE) for name in set(detections.tile.tolist())]
+    result = georeference(detections, tiles, GEOREF_TARGET)
+    if result is not None:
+        xs, ys, crs = result
+        print(f"🌍 {len(xs)} detections georeferenced to {crs}")
+        print(f"📍 Extent: {xs.min():.6f}, {ys.min():.6f} → {xs.max():.6f}, {ys.max():.6f}")
@@ -0,0 +1,298 @@
+import os
+import time
+from glob import glob
+
+import numpy as np
+from PIL import Image
+
+from stage_types import tiles_from_dir
+from detect_tiles import BATCH_SIZE, CONF_THRESHOLD, MODEL_PATH, NMS_IOU, TILE_DIR, detect_batch, load_model
+
+# === CONFIGURATION ===
+INFERENCE_BACKEND = "torch"  # "torch" (ultralytics/PyTorch), "onnx" or "onnx-int8" (ONNX Runtime CPU)
+BACKENDS = ("torch", "onnx", "onnx-int8")
+ONNX_IMGSZ = 640  # export input size, matches TILE_SIZE; smaller edge tiles are letterboxed
+ONNX_OPSET = 17
+CALIBRATION_DIR = r"C:/Users/palac/Documents/OilPalms/datasets/roboflow/train/images"
+CALIBRATION_IMAGES = 100  # tiles fed through the float model to pick INT8 activation ranges
+LETTERBOX_FILL = 114  # ultralytics pad colour
+MAX_DET = 300
+MAX_NMS = 30000  # candidate boxes kept for NMS, as in ultralytics
+MAX_WH = 7680  # class offset for per-class NMS in one pass
+PARITY_TILES = 64
+
+
+# === Model files ===
+def backend_model_path(model_path, backend=INFERENCE_BACKEND):
+    # best.pt -> best.onnx / best.int8.onnx next to it
+    root = os.path.splitext(model_path)[0]
+    return {"torch": model_path, "onnx": root + ".onnx", "onnx-int8": root + ".int8.onnx"}[backend]
+
+
+def export_onnx(model_path, onnx_path=None, imgsz=ONNX_IMGSZ):
+    # Offline export of the PyTorch weights; NMS is done on our side
+    from ultralytics import YOLO
+    onnx_path = onnx_path or backend_model_path(model_path, "onnx")
+    exported = YOLO(model_path).export(format="onnx", imgsz=imgsz, dynamic=True, opset=ONNX_OPSET)
+    if os.path.abspath(exported) != os.path.abspath(onnx_path):
+        os.replace(exported, onnx_path)
+    print(f"✅ ONNX export saved to: {onnx_path}")
+    return onnx_path
+
+
+class _CalibrationReader:
+    # onnxruntime CalibrationDataReader over letterboxed calibration tiles
+    def __init__(self, input_name, paths, imgsz):
+        self.input_name, self.imgsz = input_name, imgsz
+        self.paths = iter(paths)
+
+    def get_next(self):
+        path = next(self.paths, None)
+        if path is None:
+            return None
+        with Image.open(path) as img:
+            array = np.asarray(img.convert("RGB"))
+        return {self.input_name: letterbox_batch([array], self.imgsz)[0]}
+
+
+def calibration_images(image_dir=CALIBRATION_DIR, count=CALIBRATION_IMAGES):
+    # Evenly spaced sample of the training tiles
+    paths = sorted(p for ext in ("*.jpg", "*.jpeg", "*.png") for p in glob(os.path.join(image_dir, ext)))
+    if not paths:
+        raise FileNotFoundError(f"❌ No calibration images in {image_dir}")
+    step = max(len(paths) / count, 1.0)
+    return [paths[int(i * step)] for i in range(min(count, len(paths)))]
+
+
+def quantize_onnx(onnx_path, int8_path=None, image_dir=CALIBRATION_DIR, count=CALIBRATION_IMAGES):
+    # INT8 static quantization (QDQ, per-channel weights) calibrated on real tiles
+    import onnx
+    import onnxruntime as ort
+    from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    int8_path = int8_path or onnx_path.replace(".onnx", ".int8.onnx")
+    prepared = int8_path + ".prep.onnx"
+    quant_pre_process(onnx_path, prepared, skip_symbolic_shape=True)
+    try:
+        # The head concatenates pixel boxes with 0-1 class scores; one int8
+        # scale for both rounds every score to zero, so it stays float
+        model = onnx.load(prepared)
+        outputs = {output.name for output in model.graph.output}
+        for i, node in enumerate(model.graph.node):
+            node.name = node.name or f"{node.op_type}_{i}"
+        head = [node.name for node in model.graph.node if outputs & set(node.output)]
+        onnx.save(model, prepared)
+
+        session = ort.InferenceSession(prepared, providers=["CPUExecutionProvider"])
+        model_input = session.get_inputs()[0]
+        imgsz = model_input.shape[2] if isinstance(model_input.shape[2], int) else ONNX_IMGSZ
+        reader = _CalibrationReader(model_input.name, calibration_images(image_dir, count), imgsz)
+        quantize_static(prepared, int8_path, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        calibrate_method=CalibrationMethod.MinMax, nodes_to_exclude=head)
+    finally:
+        os.remove(prepared)
+    print(f"✅ INT8 model saved to: {int8_path}")
+    return int8_path
+
+
+def prepare_backend(model_path, backend=INFERENCE_BACKEND, image_dir=CALIBRATION_DIR):
+    # Model file for a backend, exporting and quantizing on first use
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {backend!r}")
+    path = backend_model_path(model_path, backend)
+    if backend == "torch" or os.path.exists(path):
+        return path
+    onnx_path = backend_model_path(model_path, "onnx")
+    if not os.path.exists(onnx_path):
+        export_onnx(model_path, onnx_path)
+    if backend == "onnx-int8":
+        quantize_onnx(onnx_path, path, image_dir)
+    return path
+
+
+# === ONNX Runtime detector ===
+def letterbox_batch(arrays, imgsz):
+    # RGB uint8 tiles -> (N, 3, imgsz, imgsz) float input plus per-tile (gain, pad_x, pad_y)
+    batch = np.full((len(arrays), imgsz, imgsz, 3), LETTERBOX_FILL, dtype=np.uint8)
+    geometry = []
+    for i, array in enumerate(arrays):
+        h, w = array.shape[:2]
+        gain = min(imgsz / h, imgsz / w)
+        new_w, new_h = int(round(w * gain)), int(round(h * gain))
+        if (new_w, new_h) != (w, h):
+            array = np.asarray(Image.fromarray(array).resize((new_w, new_h), Image.BILINEAR))
+        # Centre the tile like ultralytics' LetterBox
+        left, top = int(round((imgsz - new_w) / 2 - 0.1)), int(round((imgsz - new_h) / 2 - 0.1))
+        batch[i, top:top + new_h, left:left + new_w] = array
+        geometry.append((gain, left, top))
+    return batch.transpose(0, 3, 1, 2).astype(np.float32) / 255.0, geometry
+
+
+def nms(boxes, scores, iou_threshold):
+    # Greedy NMS over xyxy boxes, highest score first
+    order = np.argsort(-scores, kind="stable")
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1) * (y2 - y1)
+    keep = []
+    while order.size:
+        i, rest = order[0], order[1:]
+        keep.append(i)
+        inter = (np.clip(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0, None)
+                 * np.clip(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0, None))
+        order = rest[inter / (areas[i] + areas[rest] - inter + 1e-9) <= iou_threshold]
+    return np.array(keep, dtype=np.intp)
+
+
+class OnnxBoxes:
+    # The slice of ultralytics' Boxes that detect_batch reads
+    def __init__(self, xywh, conf, cls):
+        self.xywh, self.conf, self.cls = xywh, conf, cls
+
+    def __len__(self):
+        return len(self.conf)
+
+
+class OnnxResult:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class OnnxDetector:
+    """ONNX Runtime CPU session behind the ultralytics call signature.
+
+    Takes tile paths or BGR arrays like YOLO.__call__ and returns results
+    whose boxes hold xywh/conf/cls in tile pixels, so detect_batch and the
+    detection store are unchanged.
+    """
+
+    def __init__(self, onnx_path, threads=0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.imgsz = model_input.shape[2] if isinstance(model_input.shape[2], int) else ONNX_IMGSZ
+
+    def __call__(self, sources, batch=None, conf=CONF_THRESHOLD, iou=NMS_IOU, verbose=False, **kwargs):
+        arrays = []
+        for source in sources:
+            if isinstance(source, str):
+                with Image.open(source) as img:
+                    arrays.append(np.asarray(img.convert("RGB")))
+            else:
+                arrays.append(np.ascontiguousarray(source[..., ::-1]))  # BGR like ultralytics input
+        inputs, geometry = letterbox_batch(arrays, self.imgsz)
+        # (N, 4 + classes, anchors): cx, cy, w, h in input pixels, then class scores
+        outputs = self.session.run(None, {self.input_name: inputs})[0]
+        return [self._decode(pred.T, conf, iou, gain, pad_x, pad_y, array.shape[:2])
+                for pred, (gain, pad_x, pad_y), array in zip(outputs, geometry, arrays)]
+
+    @staticmethod
+    def _decode(pred, conf_threshold, iou_threshold, gain, pad_x, pad_y, shape):
+        scores = pred[:, 4:]
+        cls = scores.argmax(axis=1)
+        conf = scores[np.arange(len(scores)), cls]
+        keep = np.flatnonzero(conf > conf_threshold)
+        keep = keep[np.argsort(-conf[keep], kind="stable")[:MAX_NMS]]
+        cx, cy, w, h = pred[keep, :4].T
+        xyxy = np.column_stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2])
+        picked = keep[nms(xyxy + (cls[keep] * MAX_WH)[:, None], conf[keep], iou_threshold)[:MAX_DET]]
+
+        # Back to tile pixels, clipped to the tile
+        cx, cy, w, h = pred[picked, :4].T.astype(np.float64)
+        x1 = np.clip((cx - w / 2 - pad_x) / gain, 0, shape[1])
+        y1 = np.clip((cy - h / 2 - pad_y) / gain, 0, shape[0])
+        x2 = np.clip((cx + w / 2 - pad_x) / gain, 0, shape[1])
+        y2 = np.clip((cy + h / 2 - pad_y) / gain, 0, shape[0])
+        xywh = np.column_stack([(x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1])
+        return OnnxResult(OnnxBoxes(xywh, conf[picked].astype(np.float64), cls[picked].astype(np.float64)))
+
+
+# === Parity check against the PyTorch baseline ===
+def match_boxes(a, b, iou_threshold=0.5):
+    # Greedy one-to-one matching of xywh boxes by IoU; returns index pairs
+    def _xyxy(v):
+        return np.column_stack([v[:, 0] - v[:, 2] / 2, v[:, 1] - v[:, 3] / 2,
+                                v[:, 0] + v[:, 2] / 2, v[:, 1] + v[:, 3] / 2])
+    if not len(a) or not len(b):
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty(0)
+    pa, pb = _xyxy(a), _xyxy(b)
+    w = np.clip(np.minimum(pa[:, None, 2], pb[None, :, 2]) - np.maximum(pa[:, None, 0], pb[None, :, 0]), 0, None)
+    h = np.clip(np.minimum(pa[:, None, 3], pb[None, :, 3]) - np.maximum(pa[:, None, 1], pb[None, :, 1]), 0, None)
+    inter = w * h
+    iou = inter / ((a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None, :] - inter + 1e-9)
+    ia, ib, ious = [], [], []
+    for flat in np.argsort(-iou, axis=None):
+        i, j = divmod(int(flat), iou.shape[1])
+        if iou[i, j] < iou_threshold:
+            break
+        if i not in ia and j not in ib:
+            ia.append(i)
+            ib.append(j)
+            ious.append(iou[i, j])
+    return np.array(ia, dtype=np.intp), np.array(ib, dtype=np.intp), np.array(ious)
+
+
+def _timed_detect(model, tiles, batch_size):
+    start = time.perf_counter()
+    parts = [detect_batch(model, tiles[i:i + batch_size]) for i in range(0, len(tiles), batch_size)]
+    return parts, time.perf_counter() - start
+
+
+def parity_check(model_path, tiles, backend="onnx", batch_size=BATCH_SIZE):
+    # Box / confidence differences and speedup of a backend against PyTorch
+    baseline = load_model(model_path)
+    candidate = load_model(prepare_backend(model_path, backend), backend)
+    _timed_detect(baseline, tiles[:batch_size], batch_size)  # warm-up
+    _timed_detect(candidate, tiles[:batch_size], batch_size)
+    ref_parts, ref_time = _timed_detect(baseline, tiles, batch_size)
+    new_parts, new_time = _timed_detect(candidate, tiles, batch_size)
+
+    ref_total = new_total = 0
+    shifts, conf_diffs, ious, class_flips = [], [], [], 0
+    for ref, new in zip(ref_parts, new_parts):
+        for name in dict.fromkeys(ref.tile.tolist() + new.tile.tolist()):
+            r, n = ref.take(ref.tile == name), new.take(new.tile == name)
+            ref_total, new_total = ref_total + len(r), new_total + len(n)
+            ia, ib, iou = match_boxes(np.column_stack([r.x, r.y, r.w, r.h]), np.column_stack([n.x, n.y, n.w, n.h]))
+            shifts.append(np.hypot(r.x[ia] - n.x[ib], r.y[ia] - n.y[ib]))
+            conf_diffs.append(np.abs(r.conf[ia] - n.conf[ib]))
+            ious.append(iou)
+            class_flips += int((r.cls[ia] != n.cls[ib]).sum())
+    shifts, conf_diffs, ious = (np.concatenate(v) if v else np.empty(0) for v in (shifts, conf_diffs, ious))
+    report = {
+        "backend": backend, "tiles": len(tiles),
+        "torch_boxes": ref_total, "backend_boxes": new_total, "matched": len(ious),
+        "mean_iou": float(ious.mean()) if len(ious) else None,
+        "mean_center_shift_px": float(shifts.mean()) if len(shifts) else None,
+        "max_center_shift_px": float(shifts.max()) if len(shifts) else None,
+        "mean_conf_diff": float(conf_diffs.mean()) if len(conf_diffs) else None,
+        "max_conf_diff": float(conf_diffs.max()) if len(conf_diffs) else None,
+        "class_flips": class_flips,
+        "torch_tiles_per_s": len(tiles) / ref_time, "backend_tiles_per_s": len(tiles) / new_time,
+        "speedup": ref_time / new_time,
+    }
+
+    print(f"📏 Parity {backend} vs torch on {len(tiles)} tiles")
+    print(f"   boxes: torch {ref_total}, {backend} {new_total}, matched {len(ious)} (IoU ≥ 0.5), "
+          f"class flips {class_flips}")
+    if len(ious):
+        print(f"   mean IoU {report['mean_iou']:.4f}, centre shift mean {report['mean_center_shift_px']:.2f}px "
+              f"/ max {report['max_center_shift_px']:.2f}px")
+        print(f"   confidence diff mean {report['mean_conf_diff']:.4f} / max {report['max_conf_diff']:.4f}")
+    print(f"⚡ {report['torch_tiles_per_s']:.1f} → {report['backend_tiles_per_s']:.1f} tiles/s "
+          f"(speedup x{report['speedup']:.2f})")
+    return report
+
+
+if __name__ == "__main__":
+    # Export / quantize, then compare against the PyTorch model on saved tiles
+    tiles = tiles_from_dir(TILE_DIR)[:PARITY_TILES]
+    if not tiles:
+        raise FileNotFoundError(f"❌ No tile images found in {TILE_DIR}")
+    for name in ("onnx", "onnx-int8"):
+        parity_check(MODEL_PATH, tiles, name)
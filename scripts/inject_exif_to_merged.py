@@ -1,35 +1,200 @@
 import os
-from PIL import Image
+import shutil
+import struct
+import warnings
+from xml.sax.saxutils import escape
+
 import piexif
+import rasterio
+from rasterio.errors import NotGeoreferencedWarning
 
 # === Configuration ===
 MERGED_IMAGE = r"C:/Users/palac/Documents/OilPalms/scripts/output/merged_result.jpg"
 OUTPUT_IMAGE = MERGED_IMAGE.replace("merged_result.jpg", "merged_with_exif.jpg")
+WORLD_FILE = False  # also write a world file (+ CRS in .aux.xml) when the mosaic has a geotransform
+COPY_BUFFER = 16 * 2 ** 20  # bytes per read when copying the entropy-coded data
+APP1_MAX = 65533  # largest APP1 payload a JPEG segment length can describe
+EXIF_HEADER = b"Exif\x00\x00"
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
 
-# === 1. Get source image path from env
-ORIGINAL_IMAGE = os.environ.get("GPS_EXIF_SOURCE")
-
-# === 2. Validate source
-if not ORIGINAL_IMAGE or not os.path.exists(ORIGINAL_IMAGE):
-    print("⚠️ GPS_EXIF_SOURCE not set or file missing. Skipping EXIF injection.")
-    exit(0)
 
-try:
-    exif_dict = piexif.load(ORIGINAL_IMAGE)
+# === EXIF ===
+def load_gps_exif(original_image):
+    # The source's EXIF when it carries GPS, else None (with the reason printed)
+    if not original_image or not os.path.exists(original_image):
+        print("⚠️ GPS_EXIF_SOURCE not set or file missing. Skipping EXIF injection.")
+        return None
+    try:
+        exif_dict = piexif.load(original_image)
+    except Exception as e:
+        print(f"⚠️ Failed to extract EXIF: {e}. Skipping injection.")
+        return None
     if not exif_dict or not exif_dict.get("GPS"):
         print("⚠️ No GPS metadata found in EXIF. Skipping injection.")
-        exit(0)
+        return None
+    return exif_dict
 
+
+def exif_segment(exif_dict, size=None):
+    # APP1 payload for the mosaic: the source thumbnail shows the source
+    # photo, not the mosaic, so it is dropped; pixel dimensions are updated
+    exif_dict = dict(exif_dict, thumbnail=None, **{"1st": {}})
+    if size is not None:
+        exif_dict["Exif"] = dict(exif_dict.get("Exif") or {})
+        exif_dict["Exif"][piexif.ExifIFD.PixelXDimension], exif_dict["Exif"][piexif.ExifIFD.PixelYDimension] = size
     exif_bytes = piexif.dump(exif_dict)
-except Exception as e:
-    print(f"⚠️ Failed to extract EXIF: {e}. Skipping injection.")
-    exit(0)
-
-# === 3. Inject into merged image
-try:
-    merged = Image.open(MERGED_IMAGE)
-    merged.save(OUTPUT_IMAGE, "jpeg", exif=exif_bytes)
-    print(f"✅ EXIF metadata injected into: {OUTPUT_IMAGE}")
-except Exception as e:
-    print(f"❌ Failed to save merged image with EXIF: {e}")
-    exit(1)
+    if len(exif_bytes) > APP1_MAX:
+        raise ValueError(f"EXIF block is {len(exif_bytes)} bytes, more than one APP1 segment holds")
+    return exif_bytes
+
+
+# === JPEG ===
+def jpeg_header(f):
+    # ([(marker, start, end)], (width, height), scan_start) for the marker
+    # segments between SOI and the first SOS; nothing past SOS is read
+    if f.read(2) != b"\xff\xd8":
+        raise ValueError("Not a JPEG file")
+    segments, size = [], None
+    while True:
+        start = f.tell()
+        prefix = f.read(2)
+        if len(prefix) < 2 or prefix[0] != 0xFF:
+            raise ValueError(f"Corrupt JPEG marker at byte {start}")
+        marker = prefix[1]
+        while marker == 0xFF:  # fill bytes
+            marker = f.read(1)[0]
+        if marker == 0xDA:
+            return segments, size, start
+        body = f.tell()
+        length = struct.unpack(">H", f.read(2))[0]
+        if marker in SOF_MARKERS:
+            height, width = struct.unpack(">HH", f.read(5)[1:])
+            size = (width, height)
+        end = body + length
+        segments.append((marker, start, end))
+        f.seek(end)
+
+
+def splice_exif(jpeg_path, exif_bytes, output_path):
+    """Write jpeg_path with exif_bytes as its EXIF APP1 segment, without decoding.
+
+    Marker segments before the scan are rewritten (any old EXIF APP1
+    dropped, the new one placed after JFIF/APP0 as the spec asks); the
+    entropy-coded data is copied through byte for byte.
+    """
+    tmp_path = output_path + ".tmp"
+    with open(jpeg_path, "rb") as src:
+        segments, _, scan_start = jpeg_header(src)
+        src.seek(0)
+        header = src.read(scan_start)
+        app0 = [seg for seg in segments if seg[0] == 0xE0]
+        insert_at = app0[-1][2] if app0 and segments[:len(app0)] == app0 else 2
+        app1 = b"\xff\xe1" + struct.pack(">H", len(exif_bytes) + 2) + exif_bytes
+
+        with open(tmp_path, "wb") as dst:
+            dst.write(header[:insert_at])
+            dst.write(app1)
+            for marker, start, end in segments:
+                if start < insert_at:
+                    continue
+                if marker == 0xE1 and header[start + 4:start + 4 + len(EXIF_HEADER)] == EXIF_HEADER:
+                    continue
+                dst.write(header[start:end])
+            shutil.copyfileobj(src, dst, COPY_BUFFER)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def jpeg_size(jpeg_path):
+    with open(jpeg_path, "rb") as f:
+        return jpeg_header(f)[1]
+
+
+# === GeoTIFF ===
+def gps_tags(exif_dict):
+    # GPS IFD as GDAL-style EXIF_GPS* metadata items, rationals as "(value)"
+    rational = (piexif.TYPES.Rational, piexif.TYPES.SRational)
+    tags = {}
+    for tag, value in exif_dict["GPS"].items():
+        info = piexif.TAGS["GPS"].get(tag)
+        if info is None:
+            continue
+        if isinstance(value, bytes):
+            value = value.rstrip(b"\x00").decode("ascii", "replace")
+        elif info["type"] in rational:
+            pairs = value if isinstance(value[0], tuple) else (value,)
+            value = " ".join(f"({n / d:.10g})" if d else "(0)" for n, d in pairs)
+        elif isinstance(value, tuple):
+            value = " ".join(str(v) for v in value)
+        tags[f"EXIF_{info['name']}"] = str(value)
+    return tags
+
+
+def write_geotiff_tags(path, transform=None, crs=None, tags=None):
+    # Update tags in place; no pixel data is read or re-encoded. On a COG the
+    # rewritten IFD lands at the end of the file: still a valid tiled GeoTIFF
+    # with its overviews, which is why this runs on a copy of the merged COG.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        with rasterio.open(path, "r+", IGNORE_COG_LAYOUT_BREAK="YES") as dst:
+            if crs is not None and dst.crs is None:
+                dst.crs, dst.transform = crs, transform
+            if tags:
+                dst.update_tags(**tags)
+
+
+# === World files ===
+def world_file_path(image_path):
+    # .jpg -> .jgw, .tif -> .tfw: first and last letter of the extension plus "w"
+    stem, ext = os.path.splitext(image_path)
+    return f"{stem}.{ext[1]}{ext[-1]}w" if len(ext) > 2 else f"{stem}.wld"
+
+
+def write_world_file(image_path, transform, crs=None):
+    # Six-line ESRI world file (origin at the centre of the top-left pixel);
+    # the CRS goes in a GDAL .aux.xml sidecar, which GDAL and QGIS read
+    a, b, c, d, e, f = transform[:6]
+    path = world_file_path(image_path)
+    with open(path, "w") as out:
+        out.write("\n".join(f"{v:.10f}" for v in (a, d, b, e, c + a / 2 + b / 2, f + d / 2 + e / 2)) + "\n")
+    if crs is not None:
+        with open(image_path + ".aux.xml", "w", encoding="utf-8") as out:
+            out.write(f"<PAMDataset>\n  <SRS>{escape(crs.to_wkt())}</SRS>\n</PAMDataset>\n")
+    return path
+
+
+def inject_exif(original_image, merged_image=MERGED_IMAGE, output_image=OUTPUT_IMAGE, transform=None, crs=None,
+                world_file=WORLD_FILE):
+    # Attach the source's GPS EXIF to the merged output without re-encoding:
+    # JPEG gets an APP1 splice, GeoTIFF/COG a byte copy with tags updated in place
+    if world_file and transform is not None:
+        print(f"🌐 World file saved to: {write_world_file(merged_image, transform, crs)}")
+
+    # === 1. Validate source
+    exif_dict = load_gps_exif(original_image)
+    if exif_dict is None:
+        return False
+
+    # === 2. Inject into merged image
+    ext = os.path.splitext(merged_image)[1].lower()
+    if ext in (".jpg", ".jpeg"):
+        splice_exif(merged_image, exif_segment(exif_dict, jpeg_size(merged_image)), output_image)
+    elif ext in (".tif", ".tiff"):
+        shutil.copyfile(merged_image, output_image)
+        write_geotiff_tags(output_image, transform, crs, gps_tags(exif_dict))
+    else:
+        print(f"⚠️ Cannot embed EXIF in {ext} output. Skipping injection.")
+        return False
+    if world_file and transform is not None:
+        write_world_file(output_image, transform, crs)
+    print(f"✅ EXIF metadata injected into: {output_image}")
+    return True
+
+
+if __name__ == "__main__":
+    # === Get source image path from env
+    try:
+        inject_exif(os.environ.get("GPS_EXIF_SOURCE"), MERGED_IMAGE, OUTPUT_IMAGE)
+    except Exception as e:
+        print(f"❌ Failed to save merged image with EXIF: {e}")
+        exit(1)
@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import sqlite3
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import List, Optional
+
+import piexif
+import rasterio
+from PIL import Image
+from rasterio.crs import CRS
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.transform import Affine
+
+from tile_image import find_images, is_geotiff
+
+# === CONFIGURATION ===
+CATALOG_DIR = r"C:/Users/palac/Documents/OilPalms/cache"
+CATALOG_NAME = "input_catalog.sqlite"
+CATALOG_WORKERS = 16  # header reads are I/O bound, so more threads than cores help
+INPUT_FOLDER = r"C:/Users/palac/Documents/OilPalms/input"
+
+
+@dataclass
+class ImageInfo:
+    # Header metadata for one input image; exif holds the serialized EXIF
+    # block, dumped once here and reused for every tile of the image
+    path: str
+    size: int
+    mtime_ns: int
+    width: int = 0
+    height: int = 0
+    bands: int = 0
+    dtype: str = ""
+    crs: Optional[str] = None  # WKT
+    transform: Optional[List[float]] = None  # affine a, b, c, d, e, f
+    nodata: Optional[float] = None
+    gps: bool = False
+    exif: Optional[bytes] = None
+    error: Optional[str] = None
+
+    @property
+    def georef(self):
+        # (Affine, CRS) for a georeferenced GeoTIFF, else None
+        if self.crs is None or self.transform is None:
+            return None
+        return Affine(*self.transform), CRS.from_wkt(self.crs)
+
+
+def read_info(path, stat=None):
+    # Headers only: rasterio for GeoTIFFs, PIL's lazy open (no pixel decode) otherwise
+    stat = stat or os.stat(path)
+    info = ImageInfo(path, stat.st_size, stat.st_mtime_ns)
+    try:
+        if is_geotiff(path):
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", NotGeoreferencedWarning)
+                with rasterio.open(path) as src:
+                    info.width, info.height, info.bands, info.dtype = src.width, src.height, src.count, src.dtypes[0]
+                    info.nodata = src.nodata
+                    if src.crs is not None:
+                        info.crs, info.transform = src.crs.to_wkt(), list(src.transform)[:6]
+        else:
+            with Image.open(path) as img:
+                info.width, info.height, info.bands = img.width, img.height, len(img.getbands())
+                info.dtype = img.mode
+                raw = img.info.get("exif")
+            if raw:
+                info.gps, info.exif = _exif(raw)
+    except Exception as e:
+        info.error = f"{type(e).__name__}: {e}"
+    return info
+
+
+def _exif(raw):
+    # (has GPS, serialized EXIF); unparseable EXIF counts as none
+    try:
+        exif_dict = piexif.load(raw)
+        return bool(exif_dict.get("GPS")), piexif.dump(exif_dict)
+    except Exception:
+        return False, None
+
+
+class InputCatalog:
+    """Header metadata for input images, indexed in SQLite by path.
+
+    A row is reused while the file's size and mtime are unchanged, so a
+    rerun over a large flight folder only stats the files; new or changed
+    images are read in parallel, headers only.
+    """
+
+    def __init__(self, catalog_dir=CATALOG_DIR, workers=CATALOG_WORKERS):
+        os.makedirs(catalog_dir, exist_ok=True)
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(catalog_dir, CATALOG_NAME), check_same_thread=False)
+        self.db.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,
+                                               info TEXT, exif BLOB);
+        """)
+        self.read = 0  # images whose headers the last scan had to read
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+    def _lookup(self, path, stat):
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, info, exif FROM images WHERE path = ?",
+                                  (path,)).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None
+        return ImageInfo(**json.loads(row[2]), exif=row[3])
+
+    def scan(self, image_paths):
+        # {path: ImageInfo} in input order; only new or changed files are opened
+        stats = {path: os.stat(path) for path in image_paths}
+        infos = {path: self._lookup(os.path.abspath(path), stats[path]) for path in image_paths}
+        missing = [path for path, info in infos.items() if info is None]
+        self.read = len(missing)
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(missing))) as executor:
+                fresh = list(executor.map(lambda p: read_info(os.path.abspath(p), stats[p]), missing))
+            with self.lock:
+                self.db.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)", [
+                    (info.path, info.size, info.mtime_ns,
+                     json.dumps({k: v for k, v in asdict(info).items() if k != "exif"}), info.exif)
+                    for info in fresh])
+                self.db.commit()
+            infos.update(zip(missing, fresh))
+        for path in missing:
+            if infos[path].error:
+                print(f"⚠️ Could not read {os.path.basename(path)}: {infos[path].error}")
+        return infos
+
+
+def scan_inputs(image_paths, catalog_dir=CATALOG_DIR):
+    # One-off scan that opens and closes its own catalog
+    catalog = InputCatalog(catalog_dir)
+    try:
+        return catalog.scan(image_paths)
+    finally:
+        catalog.close()
+
+
+def format_catalog(infos, read):
+    with_gps = sum(1 for info in infos.values() if info.gps)
+    georeferenced = sum(1 for info in infos.values() if info.crs)
+    return (f"{len(infos)} image(s), {read} read, {len(infos) - read} from the index; "
+            f"{with_gps} with GPS EXIF, {georeferenced} georeferenced")
+
+
+if __name__ == "__main__":
+    # Scan a folder and list what the catalog knows about it
+    folder = sys.argv[1] if len(sys.argv) > 1 else INPUT_FOLDER
+    catalog = InputCatalog(CATALOG_DIR)
+    infos = catalog.scan(sorted(find_images(folder)))
+    print(f"🗂️ {format_catalog(infos, catalog.read)}")
+    for info in infos.values():
+        georef = "georeferenced" if info.crs else ("GPS EXIF" if info.gps else "no georef")
+        print(f"   {os.path.basename(info.path)}: {info.width}x{info.height}, {info.bands} band(s), {georef}")
+    catalog.close()
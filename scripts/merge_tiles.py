@@ -1,75 +1,173 @@
 import os
-import csv
-from glob import glob
+import heapq
+import math
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from tqdm import tqdm
 
+from stage_types import canvas_size, read_detections, tiles_from_dir
+from tile_image import read_tiles
+from georeference import source_georefs
+from pyramid import CogWriter, DeepZoomWriter
+from overlay import MARKER_RADIUS, MARKER_SCALE, overlay_array, overlay_image
+
 # === CONFIGURATION ===
 TILE_DIR = r"C:/Users/palac/Documents/OilPalms/scripts/tiles"
-DETECTIONS_CSV = os.path.join(TILE_DIR, "deduplicated_detections.csv")  # ✅ using deduplicated CSV
+DETECTIONS_PATH = os.path.join(TILE_DIR, "deduplicated_detections.det")  # ✅ using deduplicated detections
 OUTPUT_IMAGE = os.path.join(os.path.dirname(TILE_DIR), "output", "merged_result.jpg")
+MERGE_FORMAT = "jpeg"  # "jpeg" (one image), "dzi" (Deep Zoom tile pyramid) or "cog"
+STRIP_HEIGHT = 1024  # rows composed at a time for pyramid output
+
+
+def _infer_overlap(source_tiles, tile_size):
+    # Streamed tiles only carry offsets; recover the tiling stride from them
+    for axis in ("x", "y"):
+        starts = sorted({getattr(t, axis) for t in source_tiles})
+        if len(starts) > 1:
+            return tile_size - (starts[1] - starts[0])
+    return 0
+
+
+def _streamed_pixels(source, source_tiles):
+    # Streamed tiles have no JPEG on disk; re-read them from their source image
+    wanted = {t.name for t in source_tiles}
+    tile_size = max(max(t.width, t.height) for t in source_tiles)
+    overlap = _infer_overlap(source_tiles, tile_size)
+    for tile, array in read_tiles(source, tile_size, overlap=overlap):
+        if tile.name in wanted:
+            yield tile, array
+
+
+def _disk_pixels(disk_tiles):
+    for tile in disk_tiles:
+        with Image.open(tile.path) as img:
+            yield tile, np.asarray(img.convert("RGB"))
+
+
+def iter_tile_pixels(tiles):
+    # (Tile, RGB array) pairs in top-to-bottom order, decoded one at a time
+    streams = [_disk_pixels(sorted((t for t in tiles if t.path), key=lambda t: (t.y, t.x)))]
+    streamed = {}
+    for tile in tiles:
+        if not tile.path:
+            streamed.setdefault(tile.source, []).append(tile)
+    streams.extend(_streamed_pixels(source, source_tiles) for source, source_tiles in streamed.items())
+    return heapq.merge(*streams, key=lambda item: item[0].y)
+
+
+def iter_canvas_strips(tiles, image_size, strip_height=STRIP_HEIGHT):
+    # Compose the mosaic as full-width row strips; only tiles overlapping the
+    # current strip are held in memory.
+    width, height = image_size
+    pixels = iter_tile_pixels(tiles)
+    pending = next(pixels, None)
+    active = []
+
+    for y0 in range(0, height, strip_height):
+        y1 = min(y0 + strip_height, height)
+        while pending is not None and pending[0].y < y1:
+            active.append(pending)
+            pending = next(pixels, None)
+
+        strip = np.zeros((y1 - y0, width, 3), dtype=np.uint8)
+        for tile, array in active:
+            top, bottom = max(tile.y, y0), min(tile.y + array.shape[0], y1)
+            right = min(tile.x + array.shape[1], width)
+            if bottom > top and right > tile.x:
+                strip[top - y0:bottom - y0, tile.x:right] = array[top - tile.y:bottom - tile.y, :right - tile.x]
+
+        active = [(tile, array) for tile, array in active if tile.y + array.shape[0] > y1]
+        yield y0, strip
+
+
+def source_georef(tiles, images=None):
+    # The mosaic shares pixel space with its source, so a single GeoTIFF
+    # source lends its transform and CRS to the merged raster
+    sources = {t.source for t in tiles}
+    if len(sources) != 1:
+        return None, None
+    return next(iter(source_georefs(sources, images).values()), (None, None))
+
+
+def merge_tiles_pyramid(tiles, detections, output_path, image_size=None, fmt="dzi", marker_scale=MARKER_SCALE,
+                        images=None):
+    print(f"🧩 Step 2.5: Merging tiles into a {fmt.upper()} pyramid...")
+    width, height = image_size or canvas_size(tiles)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    if fmt == "dzi":
+        writer = DeepZoomWriter(output_path, width, height)
+    elif fmt == "cog":
+        transform, crs = source_georef(tiles, images)
+        writer = CogWriter(output_path, width, height, transform, crs)
+    else:
+        raise ValueError(f"Unknown pyramid format: {fmt!r}")
+
+    dot_count = 0
+    if detections is not None:
+        detections = detections.take(np.argsort(detections.y, kind="stable"))
+        dot_count = len(detections)
+        reach = MARKER_RADIUS if marker_scale is None else \
+            int(np.ceil(marker_scale * max(detections.w.max(initial=0), detections.h.max(initial=0)) / 2)) + 1
+
+    strips = iter_canvas_strips(tiles, (width, height))
+    for y0, strip in tqdm(strips, total=math.ceil(height / STRIP_HEIGHT), desc="🧱 Writing strips"):
+        if detections is not None:
+            lo, hi = np.searchsorted(detections.y, [y0 - reach, y0 + strip.shape[0] + reach])
+            overlay_array(strip, detections.take(slice(lo, hi)), 0, y0, scale=marker_scale)
+        if y0 == 0:
+            strip_img = Image.fromarray(strip)
+            ImageDraw.Draw(strip_img).text((10, 10), f"Detected Oil Palms: {dot_count}", fill="yellow",
+                                           font=ImageFont.load_default())
+            strip = np.asarray(strip_img)
+        writer.write_strip(y0, strip)
+    writer.close()
+
+    print(f"✅ {dot_count} detection dots drawn")
+    print(f"✅ Merged pyramid saved to: {output_path}")
+    return width, height
+
+
+def merge_tiles(tiles, detections, output_image=OUTPUT_IMAGE, image_size=None, fmt=MERGE_FORMAT,
+                marker_scale=MARKER_SCALE, images=None):
+    # images: {path: ImageInfo} from the input catalog, for the COG's georeferencing
+    if fmt != "jpeg":
+        return merge_tiles_pyramid(tiles, detections, output_image, image_size, fmt, marker_scale, images)
+    os.makedirs(os.path.dirname(output_image), exist_ok=True)
+
+    # === Step 1: Calculate canvas size ===
+    print("🧩 Step 2.5: Merging tiles with detection dots...")
+    max_x, max_y = image_size or canvas_size(tiles)
+
+    print(f"🖼️ Creating canvas: {max_x} x {max_y}")
+    merged = Image.new("RGB", (max_x, max_y))
+
+    # === Step 2: Paste tiles ===
+    for tile, array in tqdm(iter_tile_pixels(tiles), total=len(tiles), desc="🧱 Pasting tiles"):
+        merged.paste(Image.fromarray(array), (tile.x, tile.y))
+
+    # === Step 3: Stamp detection dots (vectorized, per output block) ===
+    dot_count = 0
+    if detections is not None:
+        overlay_image(merged, detections, scale=marker_scale)
+        dot_count = len(detections)
+
+        print(f"✅ {dot_count} detection dots drawn")
+    else:
+        print("⚠️ No deduplicated detections found. Skipping dot drawing.")
+
+    # === Step 4: Overlay dot count text ===
+    draw = ImageDraw.Draw(merged)
+    text = f"Detected Oil Palms: {dot_count}"
+    font = ImageFont.load_default()
+    draw.text((10, 10), text, fill="yellow", font=font)
 
-os.makedirs(os.path.dirname(OUTPUT_IMAGE), exist_ok=True)
-
-# === Step 1: Load all tiles and calculate canvas size ===
-print("🧩 Step 2.5: Merging tiles with detection dots...")
-
-tiles = []
-max_x, max_y = 0, 0
-tile_w, tile_h = 0, 0
-
-for tile_path in glob(os.path.join(TILE_DIR, "*.jpg")):
-    tile_name = os.path.basename(tile_path)
-    parts = tile_name.replace(".jpg", "").split("_")
-
-    try:
-        x_offset = int(parts[-2])
-        y_offset = int(parts[-1])
-    except ValueError:
-        print(f"⚠️ Skipped malformed tile name: {tile_name}")
-        continue
-
-    img = Image.open(tile_path)
-    tile_w, tile_h = img.size
-
-    max_x = max(max_x, x_offset + tile_w)
-    max_y = max(max_y, y_offset + tile_h)
-
-    tiles.append((img, x_offset, y_offset))
-
-print(f"🖼️ Creating canvas: {max_x} x {max_y}")
-merged = Image.new("RGB", (max_x, max_y))
-
-# === Step 2: Paste tiles ===
-for img, x, y in tqdm(tiles, desc="🧱 Pasting tiles"):
-    merged.paste(img, (x, y))
+    # === Step 5: Save final image ===
+    merged.save(output_image)
+    print(f"✅ Merged image saved to: {output_image}")
+    return merged.size
 
-# === Step 3: Draw detection dots ===
-dot_count = 0
-if os.path.exists(DETECTIONS_CSV):
-    draw = ImageDraw.Draw(merged)
 
-    with open(DETECTIONS_CSV, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            x = float(row['X'])
-            y = float(row['Y'])
-            class_name = row['Class'].lower()
-
-            radius = 12
-            color = "red" if class_name == "oil palm" else "blue"
-            draw.ellipse([(x - radius, y - radius), (x + radius, y + radius)], fill=color, outline=color)
-            dot_count += 1
-
-    print(f"✅ {dot_count} detection dots drawn from: {DETECTIONS_CSV}")
-else:
-    print("⚠️ No deduplicated_detections.csv found. Skipping dot drawing.")
-
-# === Step 4: Overlay dot count text ===
-text = f"Detected Oil Palms: {dot_count}"
-font = ImageFont.load_default()
-draw.text((10, 10), text, fill="yellow", font=font)
-
-# === Step 5: Save final image ===
-merged.save(OUTPUT_IMAGE)
-print(f"✅ Merged image saved to: {OUTPUT_IMAGE}")
+if __name__ == "__main__":
+    detections = read_detections(DETECTIONS_PATH) if os.path.exists(DETECTIONS_PATH) else None
+    merge_tiles(tiles_from_dir(TILE_DIR), detections, OUTPUT_IMAGE)
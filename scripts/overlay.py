@@ -0,0 +1,170 @@
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+# === CONFIGURATION ===
+MARKER_RADIUS = 12
+MARKER_SCALE = None  # e.g. 0.5 sizes each marker from its box: radius = 0.5 * max(W, H) / 2
+CLASS_COLORS = {0: (255, 0, 0), 1: (0, 0, 255)}  # Oil Palm red, VOP blue
+BLOCK_SIZE = 2048  # overlay work unit in pixels
+MAX_WORKERS = os.cpu_count() or 1
+CHUNK = 4096  # markers stamped per vectorized step
+
+
+@lru_cache(maxsize=None)
+def disc_offsets(radius):
+    # Render one marker with PIL so stamped markers match draw.ellipse exactly;
+    # PIL's ellipse at (x, y) equals this mask shifted to (floor(x), floor(y)).
+    size = 2 * radius + 3
+    mask = Image.new("L", (size, size))
+    c = radius + 1
+    ImageDraw.Draw(mask).ellipse([(c - radius, c - radius), (c + radius, c + radius)], fill=255, outline=255)
+    dy, dx = np.nonzero(np.asarray(mask))
+    return dy - c, dx - c
+
+
+def marker_radii(detections, radius=MARKER_RADIUS, scale=MARKER_SCALE):
+    if scale is None:
+        return np.full(len(detections), radius, dtype=np.int64)
+    return np.maximum(np.rint(scale * np.maximum(detections.w, detections.h) / 2), 1).astype(np.int64)
+
+
+def clipped_offsets(x, y, radius, frame):
+    # Offsets from (floor(x), floor(y)) of a marker cut by the frame edge. PIL
+    # rasterizes a clipped ellipse a row or column off the whole disc, so such
+    # markers are drawn with PIL on a local canvas sharing the frame's edges.
+    fx0, fy0, fx1, fy1 = frame
+    cx, cy = math.floor(x), math.floor(y)
+    left, top = max(fx0, cx - radius - 2), max(fy0, cy - radius - 2)
+    right, bottom = min(fx1, cx + radius + 3), min(fy1, cy + radius + 3)
+    if right <= left or bottom <= top:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    mask = Image.new("L", (right - left, bottom - top))
+    ImageDraw.Draw(mask).ellipse([(x - radius - left, y - radius - top), (x + radius - left, y + radius - top)],
+                                 fill=255, outline=255)
+    dy, dx = np.nonzero(np.asarray(mask))
+    return dy + top - cy, dx + left - cx
+
+
+def stamp_markers(array, x, y, cls, radii, x0=0, y0=0, frame=None):
+    # Paint filled discs into an (H, W, 3) array whose top-left pixel sits at
+    # (x0, y0) in image coordinates, exactly as draw.ellipse called once per
+    # marker on the frame (x0, y0, x1, y1) would: later markers cover earlier
+    # ones and markers crossing the frame edge keep PIL's clipped shape. Each
+    # marker's draw index is max-scattered into a padded mask with flat indices
+    # (no bounds checks), then the top marker's colour is applied through a
+    # 3-byte pixel view.
+    known = np.isin(cls, list(CLASS_COLORS))
+    x, y, cls, radii = x[known], y[known], cls[known], radii[known]
+    if not len(x):
+        return array
+    height, width = array.shape[:2]
+    frame = frame or (x0, y0, x0 + width, y0 + height)
+    pad = 2 * int(radii.max()) + 2
+    label = np.zeros((height + 2 * pad, width + 2 * pad), dtype=np.int32)
+    flat = label.reshape(-1)
+    stride = label.shape[1]
+    fx, fy = np.floor(x).astype(np.int64), np.floor(y).astype(np.int64)
+    cx = np.clip(fx - x0, -pad // 2, width + pad // 2) + pad
+    cy = np.clip(fy - y0, -pad // 2, height + pad // 2) + pad
+    centers = cy * stride + cx
+    rank = np.arange(1, len(x) + 1, dtype=np.int32)  # draw order, 0 = unpainted
+    clipped = ((fx - radii - 1 < frame[0]) | (fy - radii - 1 < frame[1])
+               | (fx + radii + 1 >= frame[2]) | (fy + radii + 1 >= frame[3]))
+
+    for radius in np.unique(radii[~clipped]):
+        dy, dx = disc_offsets(int(radius))
+        disc = dy * stride + dx
+        idx = np.flatnonzero(~clipped & (radii == radius))
+        for start in range(0, len(idx), CHUNK):
+            part = idx[start:start + CHUNK]
+            np.maximum.at(flat, (centers[part, None] + disc[None, :]).ravel(), np.repeat(rank[part], len(disc)))
+    for k in np.flatnonzero(clipped).tolist():
+        dy, dx = clipped_offsets(float(x[k]), float(y[k]), int(radii[k]), frame)
+        np.maximum.at(flat, centers[k] + dy * stride + dx, rank[k])
+
+    # Top marker's class per pixel, then one masked write per class colour
+    codes = np.zeros(len(x) + 1, dtype=np.uint8)
+    for code, cls_id in enumerate(CLASS_COLORS, start=1):
+        codes[1:][cls == cls_id] = code
+    top = codes[label[pad:pad + height, pad:pad + width]]
+    pixels = array.view("V3")[..., 0]
+    for code, color in enumerate(CLASS_COLORS.values(), start=1):
+        pixels[top == code] = np.array(color, dtype=np.uint8).view("V3")[0]
+    return array
+
+
+def markers_in(x, y, reach, x0, y0, x1, y1):
+    # x, y sorted by y: slice the block's rows, then filter columns
+    lo, hi = np.searchsorted(y, [y0 - reach, y1 + reach])
+    return lo + np.flatnonzero((x[lo:hi] >= x0 - reach) & (x[lo:hi] < x1 + reach))
+
+
+def _sorted_markers(detections, radius, scale):
+    # (x, y, cls, radii) ordered by y for markers_in, each marker's row (its
+    # draw order) and the widest reach
+    order = np.argsort(detections.y, kind="stable")
+    radii = marker_radii(detections, radius, scale)[order]
+    return detections.x[order], detections.y[order], detections.cls[order], radii, order, int(radii.max()) + 1
+
+
+def _drawn_in(x, y, order, reach, x0, y0, x1, y1):
+    # markers_in, back in row order so later rows are drawn on top
+    sel = markers_in(x, y, reach, x0, y0, x1, y1)
+    return sel[np.argsort(order[sel], kind="stable")]
+
+
+def overlay_array(array, detections, x0=0, y0=0, radius=MARKER_RADIUS, scale=MARKER_SCALE,
+                  block_size=BLOCK_SIZE, max_workers=MAX_WORKERS):
+    # Split the array into blocks and stamp each block's markers independently;
+    # blocks write disjoint regions, so they run on a thread pool
+    if detections is None or not len(detections):
+        return array
+    x, y, cls, radii, order, reach = _sorted_markers(detections, radius, scale)
+    height, width = array.shape[:2]
+    frame = (x0, y0, x0 + width, y0 + height)
+
+    def _block(origin):
+        bx, by = origin
+        view = array[by:by + block_size, bx:bx + block_size]
+        sel = _drawn_in(x, y, order, reach, x0 + bx, y0 + by, x0 + bx + view.shape[1], y0 + by + view.shape[0])
+        if len(sel):
+            stamp_markers(view, x[sel], y[sel], cls[sel], radii[sel], x0 + bx, y0 + by, frame)
+
+    origins = [(bx, by) for by in range(0, height, block_size) for bx in range(0, width, block_size)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(_block, origins))
+    return array
+
+
+def overlay_image(img, detections, radius=MARKER_RADIUS, scale=MARKER_SCALE,
+                  block_size=BLOCK_SIZE, max_workers=MAX_WORKERS):
+    # PIL canvas variant: blocks with markers are copied out, stamped and pasted
+    # back one strip of blocks at a time, so the canvas is never copied whole
+    if detections is None or not len(detections):
+        return img
+    if img.mode != "RGB":
+        raise ValueError(f"Overlay expects an RGB canvas, got {img.mode}")
+    x, y, cls, radii, order, reach = _sorted_markers(detections, radius, scale)
+    width, height = img.size
+
+    def _block(box):
+        sel = _drawn_in(x, y, order, reach, *box)
+        if not len(sel):
+            return None
+        array = np.array(img.crop(box))
+        stamp_markers(array, x[sel], y[sel], cls[sel], radii[sel], box[0], box[1], (0, 0, width, height))
+        return box, array
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for by in range(0, height, block_size):
+            boxes = [(bx, by, min(bx + block_size, width), min(by + block_size, height))
+                     for bx in range(0, width, block_size)]
+            for result in executor.map(_block, boxes):
+                if result is not None:
+                    img.paste(Image.fromarray(result[1]), result[0][:2])
+    return img
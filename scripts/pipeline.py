@@ -0,0 +1,616 @@
+import os
+import json
+import platform
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+from tqdm import tqdm
+
+import deduplicate_detections as dedup_params
+from stage_types import Detections, Tile, TilingResult, canvas_size
+from tile_image import TILE_SIZE, TILE_OVERLAP, find_images, tile_images, save_geo_csv, stream_tiles
+from detect_tiles import (BATCH_SIZE, CONF_THRESHOLD, INFERENCE_SHARDS, NMS_IOU, ShardedDetector, calibrate_shards,
+                          detect_stream, detect_tiles, load_model, stream_batches)
+from inference_backends import INFERENCE_BACKEND, prepare_backend
+from tile_filter import PREFILTER_TILES, filter_params, format_skips, skip_summary
+from input_catalog import InputCatalog, format_catalog, scan_inputs
+from deduplicate_detections import DEDUP_METHOD, DEDUP_WORKERS, deduplicate
+from merge_tiles import MERGE_FORMAT, merge_tiles, source_georef
+from overlay import MARKER_RADIUS, MARKER_SCALE
+from run_cache import CACHE_MAX_MB, RunCache, digest
+from inject_exif_to_merged import WORLD_FILE, inject_exif
+from export_geojson import EXPORT_EXTS, EXPORT_FORMAT, export_geojson
+from georeference import GEOREF_TARGET, display_transform, georeference, source_georefs
+from aggregate import aggregate_outputs, aggregate_params, aggregate_paths, load_aggregates
+from generate_report import generate_report
+from scheduler import RESOURCE_LIMITS, Task, TaskSkipped, run_dag
+from telemetry import MANIFEST_NAME, TRACE_NAME, Telemetry, current_span, format_stage, mark_cached
+
+
+# === In-process pipeline engine ===
+@dataclass
+class PipelineConfig:
+    input_dir: str
+    tile_dir: str
+    output_dir: str
+    model_path: str
+    project_root: str
+    exif_source: str = ""
+    skip_exif: bool = False
+    batch_size: int = BATCH_SIZE
+    stream: bool = False  # overlap tiling with detection, tiles kept in memory
+    save_tiles: bool = True  # write tile JPEGs to tile_dir
+    tile_size: int = TILE_SIZE
+    tile_overlap: int = TILE_OVERLAP
+    dedup_method: str = DEDUP_METHOD
+    dedup_workers: int = DEDUP_WORKERS
+    merge_format: str = MERGE_FORMAT  # "jpeg", "dzi" or "cog"
+    export_format: str = EXPORT_FORMAT  # "geojson", "ndjson" or "fgb"
+    georef: str = GEOREF_TARGET  # "none", "native" or "wgs84" (GeoTIFF inputs only)
+    use_cache: bool = True  # skip tiles and stages whose inputs are unchanged
+    cache_dir: str = ""  # defaults to <project_root>/cache
+    cache_max_mb: int = CACHE_MAX_MB
+    export_csv: bool = True  # CSV copies next to the .det stores
+    resource_limits: Dict[str, int] = field(default_factory=dict)  # overrides RESOURCE_LIMITS
+    inference_shards: int = INFERENCE_SHARDS  # CPU worker processes; 1 in-process, 0 calibrated
+    inference_backend: str = INFERENCE_BACKEND  # "torch", "onnx" or "onnx-int8" (ONNX Runtime CPU)
+    calibration_dir: str = ""  # INT8 calibration tiles; defaults to <project_root>/datasets/roboflow/train/images
+    tile_filter: bool = PREFILTER_TILES  # skip nodata / uniform / non-vegetated tiles before detection
+    trace: bool = False  # also write Chrome trace events next to the run manifest
+    world_file: bool = WORLD_FILE  # write .jgw/.tfw + .prj next to the mosaic (GeoTIFF inputs only)
+
+
+@dataclass
+class ImageJob:
+    # One input image and its stage outputs; with several inputs each job
+    # gets its own tile_dir/<name> and output_dir/<name> namespace
+    image_path: str
+    name: str
+    tile_dir: str
+    output_dir: str
+    merged_path: str
+    exif_path: str
+    geojson_path: str
+    exif_source: str = ""
+    images: Dict = field(default_factory=dict)  # {image_path: ImageInfo} from the input catalog
+    tiles: Optional[List[Tile]] = None
+    per_tile: Dict[str, Detections] = field(default_factory=dict)
+    meta: Dict = field(default_factory=dict)
+    tiling: Optional[TilingResult] = None
+    detections: Optional[Detections] = None
+    deduped: Optional[Detections] = None
+    dedup_key: Optional[str] = None
+    merge_key: Optional[str] = None
+    aggregates: Optional[Dict] = None
+    exif_written: bool = False
+
+
+@dataclass
+class PipelineResult:
+    jobs: List[ImageJob]
+    report_path: Optional[str]
+    manifest_path: str = ""
+    trace_path: str = ""
+
+
+class PipelineError(RuntimeError):
+    def __init__(self, label, step_code):
+        super().__init__(f"Failed at {label}")
+        self.label = label
+        self.step_code = step_code
+
+
+# === Find EXIF source (if available) ===
+def find_exif_source(image_paths, catalog_dir):
+    # First image with EXIF; the header reads land in the input catalog the run
+    # then uses, so catalog_dir should be the run's cache directory
+    images = scan_inputs(image_paths, catalog_dir)
+    return next((path for path in image_paths if images[path].exif), "")
+
+
+# === Wrapper to run a stage with logging ===
+def run_step(label, step_code, func, *args, **kwargs):
+    print(f"\n🔧 {label}")
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        print(f"❌ Failed at {label}: {e}")
+        raise PipelineError(label, step_code) from e
+
+
+def run_cached_step(cache, key, outputs, label, step_code, func, *args, **kwargs):
+    # Skip a stage whose inputs hash to the same key and whose outputs still exist
+    if cache is not None and cache.stage_fresh(key, outputs):
+        print(f"\n♻️ {label}: unchanged, reusing {os.path.basename(outputs[0])}")
+        mark_cached()
+        return None
+    result = run_step(label, step_code, func, *args, **kwargs)
+    if cache is not None:
+        cache.mark_stage(key, outputs)
+    return result
+
+
+def _image_keys(cache, image_paths, config, model_file):
+    # Everything that decides an image's tiles and their detections; options
+    # left at their old behaviour keep the keys they had before they existed
+    model_hash = cache.file_digest(model_file)
+    extra = [] if config.inference_backend == "torch" else [config.inference_backend]
+    if config.tile_filter:
+        extra += filter_params()
+    return {path: digest(cache.file_digest(path), config.tile_size, config.tile_overlap,
+                         model_hash, CONF_THRESHOLD, NMS_IOU, *extra)
+            for path in image_paths}
+
+
+# === Per-image jobs ===
+def plan_jobs(config, image_paths, images):
+    # One namespace per input image; a single image keeps the top-level dirs
+    merged_ext = {"jpeg": "jpg", "dzi": "dzi", "cog": "tif"}[config.merge_format]
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in image_paths]
+    jobs = []
+    for path, stem in zip(image_paths, stems):
+        if len(image_paths) == 1:
+            name, tile_dir, output_dir, exif_source = stem, config.tile_dir, config.output_dir, config.exif_source
+        else:
+            name = stem if stems.count(stem) == 1 else f"{stem}_{os.path.splitext(path)[1].lstrip('.').lower()}"
+            tile_dir, output_dir = os.path.join(config.tile_dir, name), os.path.join(config.output_dir, name)
+            exif_source = path if images[path].exif else ""
+        jobs.append(ImageJob(
+            image_path=path, name=name, tile_dir=tile_dir, output_dir=output_dir, exif_source=exif_source,
+            images={path: images[path]},
+            merged_path=os.path.join(output_dir, f"merged_result.{merged_ext}"),
+            exif_path=os.path.join(output_dir, f"merged_with_exif.{'tif' if merged_ext == 'tif' else 'jpg'}"),
+            geojson_path=os.path.join(output_dir, f"detection_geojson.{EXPORT_EXTS[config.export_format]}"),
+        ))
+    return jobs
+
+
+class ModelPool:
+    # Models are loaded on first use and lent to one inference task at a
+    # time, so there are never more than the inference limit in memory.
+    # Sharded inference instead keeps one set of worker processes for the run.
+    def __init__(self, model_path, shards=1, cache=None, layout_key=None, backend="torch"):
+        self.model_path, self.backend = model_path, backend
+        self.lock = threading.Lock()
+        self.free = []
+        self.shards, self.cache, self.layout_key = shards, cache, layout_key
+        self.detector = None
+
+    @contextmanager
+    def borrow(self):
+        with self.lock:
+            model = self.free.pop() if self.free else None
+        if model is None:
+            model = run_step("Step 2: Load Model", 2, load_model, self.model_path, self.backend)
+        try:
+            yield model
+        finally:
+            with self.lock:
+                self.free.append(model)
+
+    def detect_sharded(self, batches, on_batch=None, total=None):
+        # The first call may calibrate on its own batches; the chosen layout
+        # is remembered in the run cache for this machine and model
+        with tqdm(total=total, desc="🧠 Detecting tiles (sharded)", unit="tile") as progress:
+            with self.lock:
+                if self.detector is None:
+                    self.detector = self._start_shards(batches, on_batch, progress)
+            self.detector.run(batches, on_batch, progress=progress)
+
+    def _start_shards(self, batches, on_batch, progress):
+        layout = None
+        if self.shards:
+            layout = (self.shards, max(1, (os.cpu_count() or 1) // self.shards))
+        elif self.cache is not None:
+            stored = self.cache.get(self.layout_key)
+            if stored is not None:
+                layout = tuple(json.loads(stored))
+                print(f"♻️ Calibrated inference layout: {layout[0]} process(es) x {layout[1]} thread(s)")
+        if layout:
+            return ShardedDetector(self.model_path, *layout, self.backend)
+        detector, _ = calibrate_shards(self.model_path, batches, on_batch, progress=progress, backend=self.backend)
+        if self.cache is not None:
+            self.cache.put(self.layout_key, json.dumps([detector.processes, detector.threads]).encode())
+        return detector
+
+    def close(self):
+        if self.detector is not None:
+            self.detector.close()
+
+
+def tile_job(config, job, cache=None, image_key=None):
+    # Step 1: a fully cached image restores its tiles and detections instead
+    os.makedirs(job.tile_dir, exist_ok=True)
+    os.makedirs(job.output_dir, exist_ok=True)
+    if cache is not None:
+        hit = cache.load_image(image_key, job.image_path)
+        if hit is not None:
+            print(f"♻️ {job.name}: every tile cached")
+            mark_cached()
+            job.tiles, job.per_tile = hit
+            return
+    if not config.stream:  # streaming tiles inside the detection task
+        job.tiles = run_step(f"Step 1: Tiling [{job.name}]", 1, tile_images, [job.image_path], job.tile_dir,
+                             config.tile_size, overlap=config.tile_overlap, prefilter=config.tile_filter,
+                             infos=job.images).tiles
+
+
+def detect_job(config, job, models, cache=None, image_key=None):
+    # Step 2: inference for the tiles the cache does not have
+    def _record(batch, detections):
+        # Store each tile's detections as soon as its batch finishes, one commit per batch
+        names = detections.tile.astype(str)
+        for tile in batch:
+            job.per_tile[tile.name] = detections.take(names == tile.name)
+        if cache is not None:
+            cache.put_detections_many([(digest(image_key, tile.name), job.per_tile[tile.name]) for tile in batch])
+
+    def _uncached(tile_list):
+        # Pull cached tiles out of the work list
+        for item in tile_list:
+            tile = item[0] if isinstance(item, tuple) else item
+            if tile.skip:  # pre-filtered: no palms, nothing to run or cache
+                job.per_tile[tile.name] = Detections()
+                continue
+            hit = None
+            if cache is not None:
+                hit = cache.get_detections(digest(image_key, tile.name))
+            if hit is None:
+                yield item
+            else:
+                job.per_tile[tile.name] = hit
+
+    fresh = job.tiles is None or len(job.per_tile) < len(job.tiles)
+    if not fresh:
+        mark_cached()
+    if job.tiles is None:
+        tile_stream = stream_tiles([job.image_path], config.tile_size,
+                                   output_dir=job.tile_dir if config.save_tiles else None,
+                                   overlap=config.tile_overlap, prefilter=config.tile_filter, infos=job.images)
+        job.tiles = []
+
+        def _seen(stream):
+            for tile, array in stream:
+                job.tiles.append(tile)
+                yield tile, array
+
+        label = f"Step 1-2: Streaming Tiling + Detection [{job.name}]"
+        if config.inference_shards != 1:
+            run_step(label, 2, models.detect_sharded,
+                     stream_batches(_uncached(_seen(tile_stream)), config.batch_size), _record)
+        else:
+            with models.borrow() as model:
+                run_step(label, 2, detect_stream, _uncached(_seen(tile_stream)), model, config.batch_size, _record,
+                         allow_empty=True)
+    elif fresh:
+        todo = list(_uncached(job.tiles))
+        if todo and config.inference_shards != 1:
+            batches = ((todo[i:i + config.batch_size], None) for i in range(0, len(todo), config.batch_size))
+            run_step(f"Step 2: Detection [{job.name}]", 2, models.detect_sharded, batches, _record, len(todo))
+        elif todo:
+            with models.borrow() as model:
+                run_step(f"Step 2: Detection [{job.name}]", 2, detect_tiles, todo, model, config.batch_size,
+                         _record)
+        if len(todo) < len(job.tiles):
+            print(f"♻️ {job.name}: {len(job.tiles) - len(todo)} tile(s) reused from cache")
+            if current_span() is not None:
+                current_span().count(cached_tiles=len(job.tiles) - len(todo))
+
+    if not job.tiles:
+        print(f"❌ Failed at Step 1: Tiling [{job.name}]: no tiles were produced")
+        raise PipelineError(f"Step 1: Tiling [{job.name}]", 1)
+    if cache is not None and fresh:
+        cache.store_manifest(image_key, job.tiles)
+    job.tiles.sort(key=lambda t: (t.y, t.x))
+    job.tiling = TilingResult(tiles=job.tiles, image_size=canvas_size(job.tiles))
+    job.detections = Detections.concat([job.per_tile[t.name] for t in job.tiles])
+    job.per_tile = {}
+
+    save_geo_csv(job.tiles, os.path.join(job.tile_dir, "tile_geolocation.csv"))
+    job.meta = {"image_width": job.tiling.image_width, "image_height": job.tiling.image_height,
+                "tile_size": config.tile_size, "tile_overlap": config.tile_overlap}
+    if config.tile_filter:
+        job.meta["skipped_tiles"] = skip_summary(job.tiles)
+        print(f"🚫 {job.name}: {format_skips(job.tiles)}")
+    job.detections.save(os.path.join(job.tile_dir, "detections.det"), job.meta)
+    if config.export_csv:
+        job.detections.to_csv(os.path.join(job.tile_dir, "detections.csv"))
+
+
+def dedup_job(config, job, cache=None, image_key=None):
+    # Step 2.6, reused from the cache while the detections and params match
+    label = f"Step 2.6: Deduplication ({config.dedup_method.upper()}) [{job.name}]"
+    if cache is not None:
+        job.dedup_key = digest("dedup", [image_key], config.dedup_method,
+                               dedup_params.EPS, dedup_params.MIN_SAMPLES, dedup_params.BLOCK_SIZE,
+                               dedup_params.IOU_THRESHOLD, dedup_params.CONTAIN_THRESHOLD)
+        job.deduped = cache.get_detections(job.dedup_key)
+        if job.deduped is not None:
+            print(f"\n♻️ {label}: unchanged, reusing cached result")
+            mark_cached()
+    if job.deduped is None:
+        job.deduped = run_step(label, 26, deduplicate, job.detections, config.dedup_method,
+                               config.tile_size, config.tile_overlap, config.dedup_workers)
+        if cache is not None:
+            cache.put_detections(job.dedup_key, job.deduped)
+    job.deduped.save(os.path.join(job.tile_dir, "deduplicated_detections.det"),
+                     dict(job.meta, dedup=config.dedup_method))
+    if config.export_csv:
+        job.deduped.to_csv(os.path.join(job.tile_dir, "deduplicated_detections.csv"))
+    print(f"📦 {job.name}: Original: {len(job.detections)} → Deduplicated: {len(job.deduped)}")
+
+
+def export_detections(detections, tiling, output_path, fmt=EXPORT_FORMAT, georef=GEOREF_TARGET, images=None):
+    # Map coordinates when every source is a georeferenced GeoTIFF, else pixels
+    result = georeference(detections, tiling.tiles, georef, images=images)
+    coords, crs = (result[:2], result[2]) if result is not None else (None, None)
+    display = None
+    if result is not None:
+        georefs = source_georefs({t.source for t in tiling.tiles}, images)
+        if len(georefs) == 1:  # one transform maps every px/py back to the map
+            transform, source_crs = next(iter(georefs.values()))
+            display = {"transform": display_transform(transform, tiling.image_height),
+                       "crs": source_crs.to_string()}
+    return export_geojson(detections, tiling.image_height, output_path, fmt, coords=coords, crs=crs,
+                          georef=display)
+
+
+def export_job(config, job, cache=None):
+    # Step 4 only needs the tiling's image size, so it runs alongside the merge
+    key = digest("geojson", job.dedup_key, job.tiling.image_height, config.export_format, config.georef) \
+        if cache else None
+    run_cached_step(cache, key, [job.geojson_path], f"Step 4: Export GeoJSON [{job.name}]", 4,
+                    export_detections, job.deduped, job.tiling, job.geojson_path, config.export_format,
+                    config.georef, job.images)
+
+
+def merge_job(config, job, cache=None):
+    job.merge_key = digest("merge", job.dedup_key, config.merge_format, MARKER_RADIUS, MARKER_SCALE) \
+        if cache else None
+    run_cached_step(cache, job.merge_key, [job.merged_path], f"Step 2.7: Merge Dots [{job.name}]", 27,
+                    merge_tiles, job.tiling.tiles, job.deduped, job.merged_path, job.tiling.image_size,
+                    config.merge_format, MARKER_SCALE, job.images)
+
+
+def aggregate_job(config, job, cache=None):
+    # Step 2.8: report statistics, preview and density heatmap from the merged output
+    key = digest("aggregate", job.merge_key, *aggregate_params()) if cache else None
+    run_cached_step(cache, key, list(aggregate_paths(job.output_dir).values()),
+                    f"Step 2.8: Aggregate Statistics [{job.name}]", 28, aggregate_outputs, job.deduped,
+                    job.tiling.tiles, job.tiling.image_size, job.merged_path, job.output_dir, job.images)
+    job.aggregates = load_aggregates(job.output_dir)
+
+
+def exif_job(config, job, cache=None):
+    # Metadata only: the merged pixels are copied, never decoded
+    transform, crs = source_georef(job.tiling.tiles, job.images)
+    key = digest("exif", job.merge_key, job.exif_source and cache.file_digest(job.exif_source),
+                 config.world_file) if cache else None
+    written = run_cached_step(cache, key, [job.exif_path], f"Step 3: Inject GPS EXIF [{job.name}]", 3, inject_exif,
+                              job.exif_source, job.merged_path, job.exif_path, transform, crs, config.world_file)
+    job.exif_written = written is None or written
+
+
+def _stage_task(label, step_code, func, *args):
+    # Errors outside run_step still surface as the stage's PipelineError
+    def _run():
+        try:
+            return func(*args)
+        except PipelineError:
+            raise
+        except Exception as e:
+            print(f"❌ Failed at {label}: {e}")
+            raise PipelineError(label, step_code) from e
+    return _run
+
+
+def _stage_metrics(span, stage, config, job):
+    # Items and bytes a finished stage accounts for in the run telemetry
+    cached = span.args.get("cached")
+    if stage == "tile" and job.tiles is not None and not cached:
+        span.count(tiles=len(job.tiles))
+        span.wrote(*(tile.path for tile in job.tiles))
+    elif stage == "detect":
+        skipped = sum(1 for tile in job.tiles if tile.skip)
+        span.count(skipped_tiles=skipped, detections=len(job.detections))
+        span.count(tiles=len(job.tiles) - skipped - span.items.get("cached_tiles", 0))
+        span.wrote(os.path.join(job.tile_dir, "detections.det"), os.path.join(job.tile_dir, "detections.csv"))
+        if config.stream and config.save_tiles:
+            span.wrote(*(tile.path for tile in job.tiles))
+    elif stage == "dedup":
+        span.count(detections=len(job.detections), deduplicated=len(job.deduped))
+        span.wrote(os.path.join(job.tile_dir, "deduplicated_detections.det"),
+                   os.path.join(job.tile_dir, "deduplicated_detections.csv"))
+    elif stage == "aggregate" and not cached:
+        span.count(detections=len(job.deduped))
+        span.wrote(*aggregate_paths(job.output_dir).values())
+    elif stage in ("export", "merge", "exif") and not cached:
+        span.count(detections=len(job.deduped))
+        if stage == "merge":
+            span.count(tiles=len(job.tiling.tiles))
+        span.wrote({"export": job.geojson_path, "merge": job.merged_path, "exif": job.exif_path}[stage])
+        if stage == "merge" and config.merge_format == "dzi":
+            span.wrote(os.path.splitext(job.merged_path)[0] + "_files")
+
+
+def job_tasks(config, job, rank, models, cache=None, image_key=None, telemetry=None):
+    # The image's stage DAG; rank keeps earlier images ahead among ready tasks
+    def name(stage):
+        return f"{stage}:{job.name}"
+
+    def measured(stage, func):
+        # Run the stage inside a telemetry span
+        def _run(*args):
+            with telemetry.span(stage, image=job.name) as span:
+                func(*args)
+                _stage_metrics(span, stage, config, job)
+        return func if telemetry is None else _run
+
+    tasks = [
+        Task(name("tile"), _stage_task(f"Step 1: Tiling [{job.name}]", 1, measured("tile", tile_job), config, job,
+                                       cache, image_key),
+             "cpu", [], (rank, 0)),
+        Task(name("detect"), _stage_task(f"Step 2: Detection [{job.name}]", 2, measured("detect", detect_job), config,
+                                         job, models, cache, image_key),
+             "inference", [name("tile")], (rank, 1)),
+        Task(name("dedup"), _stage_task(f"Step 2.6: Deduplication [{job.name}]", 26, measured("dedup", dedup_job),
+                                        config, job, cache, image_key),
+             "cpu", [name("detect")], (rank, 2)),
+        Task(name("export"), _stage_task(f"Step 4: Export GeoJSON [{job.name}]", 4, measured("export", export_job),
+                                         config, job, cache),
+             "io", [name("dedup")], (rank, 3)),
+        Task(name("merge"), _stage_task(f"Step 2.7: Merge Dots [{job.name}]", 27, measured("merge", merge_job),
+                                        config, job, cache),
+             "io", [name("dedup")], (rank, 3)),
+        Task(name("aggregate"), _stage_task(f"Step 2.8: Aggregate Statistics [{job.name}]", 28,
+                                            measured("aggregate", aggregate_job), config, job, cache),
+             "cpu", [name("merge")], (rank, 4)),
+    ]
+    # === Conditional EXIF Injection ===
+    if (job.exif_source or config.world_file) and not config.skip_exif and config.merge_format != "dzi":
+        tasks.append(Task(name("exif"), _stage_task(f"Step 3: Inject GPS EXIF [{job.name}]", 3,
+                                                    measured("exif", exif_job), config, job, cache),
+                          "io", [name("merge")], (rank, 4)))
+    else:
+        print(f"⚠️ Skipping EXIF embedding [{job.name}]")
+    return tasks
+
+
+def run_pipeline(config):
+    # Every run leaves a manifest of per-stage timings next to its outputs,
+    # whether it succeeds or fails
+    telemetry = Telemetry().start()
+    outcome = {"status": "failed"}
+    result = None
+    try:
+        result = _run_pipeline(config, telemetry)
+        outcome = {"status": "ok", "report": result.report_path}
+    except PipelineError as e:
+        outcome = {"status": "failed", "failed_step": e.label, "exit_code": e.step_code}
+        raise
+    finally:
+        telemetry.stop()
+        paths = save_telemetry(config, telemetry, outcome)
+    result.manifest_path, result.trace_path = paths
+    return result
+
+
+def save_telemetry(config, telemetry, outcome):
+    # (manifest path, trace path); a failure here never hides the run's own error
+    manifest_path = trace_path = ""
+    try:
+        os.makedirs(config.output_dir, exist_ok=True)
+        manifest_path = telemetry.save_manifest(os.path.join(config.output_dir, MANIFEST_NAME),
+                                                config=asdict(config), **outcome)
+        if config.trace:
+            trace_path = telemetry.save_trace(os.path.join(config.output_dir, TRACE_NAME))
+    except Exception as e:
+        print(f"⚠️ Could not save run telemetry: {e}")
+        return manifest_path, trace_path
+
+    print("\n⏱️ Stage timings")
+    for record in telemetry.stages():
+        print(f"   {format_stage(record)}")
+    totals = telemetry.totals()
+    print(f"   total: {totals['wall_s']:.2f}s wall, {totals['cpu_s']:.2f}s CPU"
+          + (f", {totals['peak_rss_mb']:.0f} MB peak" if totals["peak_rss_mb"] is not None else ""))
+    print(f"🧾 Run manifest saved to: {manifest_path}")
+    if trace_path:
+        print(f"🧵 Chrome trace saved to: {trace_path}")
+    return manifest_path, trace_path
+
+
+def _run_pipeline(config, telemetry):
+    os.makedirs(config.tile_dir, exist_ok=True)
+    os.makedirs(config.output_dir, exist_ok=True)
+    image_paths = find_images(config.input_dir)
+    if not image_paths:
+        print("❌ Failed at Step 1: Tiling: no input images found")
+        raise PipelineError("Step 1: Tiling", 1)
+    with telemetry.span("scan inputs", "setup") as span:
+        catalog = InputCatalog(config.cache_dir or os.path.join(config.project_root, "cache"))
+        try:
+            images = run_step("Step 0: Scan inputs", 1, catalog.scan, image_paths)
+        finally:
+            catalog.close()
+        span.count(images=len(image_paths), headers_read=catalog.read)
+    print(f"🗂️ {format_catalog(images, catalog.read)}")
+    jobs = plan_jobs(config, image_paths, images)
+    model_file = config.model_path
+    if config.inference_backend != "torch":
+        with telemetry.span("prepare model", "setup", backend=config.inference_backend):
+            calibration_dir = config.calibration_dir or os.path.join(config.project_root, "datasets", "roboflow",
+                                                                     "train", "images")
+            model_file = run_step(f"Step 0: Prepare {config.inference_backend} model", 2, prepare_backend,
+                                  config.model_path, config.inference_backend, calibration_dir)
+
+    cache = image_keys = None
+    if config.use_cache:
+        cache = RunCache(config.cache_dir or os.path.join(config.project_root, "cache"), config.cache_max_mb)
+        with telemetry.span("hash inputs", "setup") as span:
+            image_keys = run_step("Step 0: Hash inputs", 1, _image_keys, cache, image_paths, config, model_file)
+            span.count(images=len(image_paths))
+
+    try:
+        return _run_jobs(config, jobs, cache, image_keys, model_file, telemetry)
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def _report_images(jobs):
+    # Lightweight artefacts the report embeds, plus the full image it links to
+    images = []
+    for job in jobs:
+        paths = aggregate_paths(job.output_dir)
+        full = job.exif_path if job.exif_written else job.merged_path
+        images.append({"name": job.name, "stats": job.aggregates, "preview": paths["preview"],
+                       "heatmap": paths["heatmap"], "full": full})
+    return images
+
+
+def _report_downloads(config, jobs):
+    # (label, path) per output the report links to, from each job's own directories
+    downloads = []
+    for job in jobs:
+        suffix = f" [{job.name}]" if len(jobs) > 1 else ""
+        detections = os.path.join(job.tile_dir, "deduplicated_detections." + ("csv" if config.export_csv else "det"))
+        merged = ("📷 Merged image with EXIF", job.exif_path) if job.exif_written else \
+            ("📷 Merged image", job.merged_path)
+        downloads += [(label + suffix, path) for label, path in
+                      (merged, ("📄 Deduplicated detections", detections), ("🌍 Detections export", job.geojson_path))]
+    return downloads
+
+
+def _run_jobs(config, jobs, cache, image_keys, model_file, telemetry):
+    # === Stages of different images overlap, bounded per resource class ===
+    limits = dict(RESOURCE_LIMITS, **(config.resource_limits or {}))
+    print(f"🗂️ {len(jobs)} image job(s); concurrency " + ", ".join(f"{k}={v}" for k, v in limits.items()))
+    layout_key = digest("shard-layout", platform.node(), os.cpu_count(), cache.file_digest(model_file),
+                        config.batch_size, config.tile_size) if cache else None
+    models = ModelPool(model_file, config.inference_shards, cache, layout_key, config.inference_backend)
+    tasks = []
+    for rank, job in enumerate(jobs):
+        tasks += job_tasks(config, job, rank, models, cache, image_keys[job.image_path] if cache else None,
+                           telemetry)
+    try:
+        _, errors = run_dag(tasks, limits)
+    finally:
+        models.close()
+
+    failures = [(name, e) for name, e in errors.items() if not isinstance(e, TaskSkipped)]
+    if failures:
+        failed = sorted({name.split(":", 1)[1] for name, _ in failures})
+        print(f"❌ {len(failed)} of {len(jobs)} image(s) failed: {', '.join(failed)}")
+        raise failures[0][1]
+
+    deduped = Detections.concat([job.deduped for job in jobs])
+    with telemetry.span("report") as span:
+        report_path = run_step("Step 5: Generate HTML Report", 5, generate_report, deduped, config.project_root,
+                               {"totals": telemetry.totals(), "stages": telemetry.stages()}, _report_images(jobs),
+                               _report_downloads(config, jobs))
+        span.count(detections=len(deduped))
+        span.wrote(report_path)
+    return PipelineResult(jobs, report_path)
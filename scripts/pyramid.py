@@ -0,0 +1,143 @@
+import os
+import math
+import shutil
+import tempfile
+import warnings
+import numpy as np
+from PIL import Image
+import rasterio
+import rasterio.shutil
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.windows import Window
+
+# === CONFIGURATION ===
+DZI_TILE_SIZE = 256
+DZI_FORMAT = "jpg"
+JPEG_QUALITY = 90
+COG_BLOCK_SIZE = 512
+
+
+def downsample(rows):
+    # 2x2 box filter; an odd trailing row/column is averaged with itself
+    if rows.shape[0] % 2:
+        rows = np.concatenate([rows, rows[-1:]])
+    if rows.shape[1] % 2:
+        rows = np.concatenate([rows, rows[:, -1:]], axis=1)
+    summed = rows.reshape(rows.shape[0] // 2, 2, rows.shape[1] // 2, 2, 3).sum(axis=(1, 3), dtype=np.uint16)
+    return ((summed + 2) // 4).astype(np.uint8)
+
+
+# === Deep Zoom (DZI) ===
+class _DeepZoomLevel:
+    def __init__(self, writer, level, width):
+        self.writer = writer
+        self.level = level
+        self.width = width
+        self.row = 0
+        self.tile_rows = np.empty((0, width, 3), dtype=np.uint8)
+        self.down_rows = np.empty((0, width, 3), dtype=np.uint8)
+        self.next = _DeepZoomLevel(writer, level - 1, math.ceil(width / 2)) if level > 0 else None
+        os.makedirs(os.path.join(writer.files_dir, str(level)), exist_ok=True)
+
+    def _write_tile_row(self, rows):
+        size = self.writer.tile_size
+        for col, x in enumerate(range(0, self.width, size)):
+            tile = Image.fromarray(rows[:, x:x + size])
+            path = os.path.join(self.writer.files_dir, str(self.level), f"{col}_{self.row}.{self.writer.fmt}")
+            if self.writer.fmt == "jpg":
+                tile.save(path, quality=JPEG_QUALITY)
+            else:
+                tile.save(path)
+        self.row += 1
+
+    def push(self, rows):
+        size = self.writer.tile_size
+        self.tile_rows = np.concatenate([self.tile_rows, rows])
+        while self.tile_rows.shape[0] >= size:
+            self._write_tile_row(self.tile_rows[:size])
+            self.tile_rows = self.tile_rows[size:]
+
+        if self.next is not None:
+            self.down_rows = np.concatenate([self.down_rows, rows])
+            even = self.down_rows.shape[0] - self.down_rows.shape[0] % 2
+            if even:
+                self.next.push(downsample(self.down_rows[:even]))
+                self.down_rows = self.down_rows[even:]
+
+    def finish(self):
+        if self.tile_rows.shape[0]:
+            self._write_tile_row(self.tile_rows)
+        if self.next is not None:
+            if self.down_rows.shape[0]:
+                self.next.push(downsample(self.down_rows))
+            self.next.finish()
+
+
+class DeepZoomWriter:
+    """Write a Deep Zoom pyramid from full-resolution row strips, top to bottom.
+
+    Each level keeps less than one tile row (plus one row awaiting its 2x2
+    partner) in memory, so the whole pyramid is built in a single pass.
+    """
+
+    def __init__(self, output_path, width, height, tile_size=DZI_TILE_SIZE, fmt=DZI_FORMAT):
+        self.output_path = output_path
+        self.width, self.height = width, height
+        self.tile_size = tile_size
+        self.fmt = fmt
+        self.files_dir = os.path.splitext(output_path)[0] + "_files"
+        if os.path.isdir(self.files_dir):
+            shutil.rmtree(self.files_dir)
+        max_level = math.ceil(math.log2(max(width, height, 1)))
+        self.top = _DeepZoomLevel(self, max_level, width)
+
+    def write_strip(self, y, strip):
+        self.top.push(strip)
+
+    def close(self):
+        self.top.finish()
+        with open(self.output_path, "w") as f:
+            f.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{self.tile_size}" '
+                f'Overlap="0" Format="{self.fmt}">\n'
+                f'  <Size Width="{self.width}" Height="{self.height}"/>\n'
+                '</Image>\n'
+            )
+
+
+# === Cloud-Optimized GeoTIFF ===
+class CogWriter:
+    """Write row strips into a tiled GeoTIFF, then lay it out as a COG.
+
+    Strips go straight to disk block by block; GDAL's COG driver then builds
+    the overviews from the tiled intermediate without loading it whole.
+    """
+
+    def __init__(self, output_path, width, height, transform=None, crs=None, block_size=COG_BLOCK_SIZE):
+        self.output_path = output_path
+        self.tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(output_path) or ".")
+        self.tmp_path = os.path.join(self.tmp_dir, "strips.tif")
+        profile = dict(driver="GTiff", width=width, height=height, count=3, dtype="uint8",
+                       tiled=True, blockxsize=block_size, blockysize=block_size,
+                       compress="deflate", BIGTIFF="IF_SAFER")
+        if transform is not None:
+            profile.update(transform=transform, crs=crs)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", NotGeoreferencedWarning)
+            self.dst = rasterio.open(self.tmp_path, "w", **profile)
+        self.block_size = block_size
+
+    def write_strip(self, y, strip):
+        self.dst.write(strip.transpose(2, 0, 1), window=Window(0, y, strip.shape[1], strip.shape[0]))
+
+    def close(self):
+        self.dst.close()
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", NotGeoreferencedWarning)
+                rasterio.shutil.copy(self.tmp_path, self.output_path, driver="COG",
+                                     COMPRESS="JPEG", QUALITY=JPEG_QUALITY, BLOCKSIZE=self.block_size,
+                                     OVERVIEW_RESAMPLING="AVERAGE", BIGTIFF="IF_SAFER")
+        finally:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
@@ -0,0 +1,166 @@
+import io
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+
+from stage_types import Detections, Tile
+
+# === CONFIGURATION ===
+CACHE_DIR = r"C:/Users/palac/Documents/OilPalms/cache"
+CACHE_MAX_MB = 2048  # least recently used entries are evicted beyond this
+HASH_CHUNK = 1024 * 1024
+
+
+def digest(*parts):
+    # Stable key from JSON-serialisable parts
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _pack_detections(detections):
+    buffer = io.BytesIO()
+    np.savez(buffer, tile=detections.tile.astype(str), cls=detections.cls, conf=detections.conf,
+             x=detections.x, y=detections.y, w=detections.w, h=detections.h)
+    return buffer.getvalue()
+
+
+def _unpack_detections(data):
+    with np.load(io.BytesIO(data)) as arrays:
+        return Detections(
+            tile=arrays["tile"].astype(object), cls=arrays["cls"], conf=arrays["conf"],
+            x=arrays["x"], y=arrays["y"], w=arrays["w"], h=arrays["h"],
+        )
+
+
+class RunCache:
+    """Content-addressed store that lets reruns skip unchanged work.
+
+    Entries (per-tile detections, tile manifests, dedup results) are keyed by
+    hashes of everything that produced them and kept in one SQLite file;
+    once the total passes max_mb the least recently used are evicted.
+    Stage stamps record the key that last produced each output file.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_mb=CACHE_MAX_MB):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(cache_dir, "run_cache.sqlite"), check_same_thread=False)
+        self.db.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, data BLOB, size INTEGER, last_used REAL);
+            CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_used);
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT);
+            CREATE TABLE IF NOT EXISTS stages (output TEXT PRIMARY KEY, key TEXT);
+        """)
+        # Running byte total of entries, so puts never re-sum the table
+        self.total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+    # === File hashes (re-hashed only when size or mtime changes) ===
+    def file_digest(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, digest FROM files WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                sha.update(chunk)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                            (path, stat.st_size, stat.st_mtime_ns, sha.hexdigest()))
+            self.db.commit()
+        return sha.hexdigest()
+
+    # === Entries ===
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key, data):
+        self.put_many([(key, data)])
+
+    def put_many(self, items):
+        # Insert or replace (key, data) pairs in one transaction
+        with self.lock:
+            for key, data in items:
+                old = self.db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+                self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                                (key, data, len(data), time.time()))
+                self.total += len(data) - (old[0] if old else 0)
+            if self.total > self.max_bytes:
+                self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        # Drop least recently used entries until the total fits again
+        stale = []
+        for key, size in self.db.execute("SELECT key, size FROM entries ORDER BY last_used"):
+            if self.total <= self.max_bytes:
+                break
+            stale.append((key,))
+            self.total -= size
+        self.db.executemany("DELETE FROM entries WHERE key = ?", stale)
+
+    def get_detections(self, key):
+        data = self.get(key)
+        return None if data is None else _unpack_detections(data)
+
+    def put_detections(self, key, detections):
+        self.put(key, _pack_detections(detections))
+
+    def put_detections_many(self, items):
+        # (key, Detections) pairs, e.g. one inference batch, in one commit
+        self.put_many([(key, _pack_detections(detections)) for key, detections in items])
+
+    # === Per-image tile manifests and per-tile detections ===
+    def load_image(self, image_key, image_path):
+        # (tiles, {tile name: Detections}) when every tile of the image is cached
+        data = self.get(f"tiles:{image_key}")
+        if data is None:
+            return None
+        tiles = [Tile(name, x, y, w, h, source=image_path, lon=lon, lat=lat, skip=skip[0] if skip else None)
+                 for name, x, y, w, h, lon, lat, *skip in json.loads(data)]
+        per_tile = {}
+        for tile in tiles:
+            if tile.skip:  # pre-filtered tiles never ran, so have no entry
+                per_tile[tile.name] = Detections()
+                continue
+            detections = self.get_detections(digest(image_key, tile.name))
+            if detections is None:
+                return None
+            per_tile[tile.name] = detections
+        return tiles, per_tile
+
+    def store_manifest(self, image_key, tiles):
+        rows = [(t.name, t.x, t.y, t.width, t.height, t.lon, t.lat, t.skip) for t in tiles]
+        self.put(f"tiles:{image_key}", json.dumps(rows).encode())
+
+    # === Stage stamps ===
+    def stage_fresh(self, key, outputs):
+        if not all(os.path.exists(path) for path in outputs):
+            return False
+        with self.lock:
+            row = self.db.execute("SELECT key FROM stages WHERE output = ?", (outputs[0],)).fetchone()
+        return row is not None and row[0] == key
+
+    def mark_stage(self, key, outputs):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO stages VALUES (?, ?)", (outputs[0], key))
+            self.db.commit()
@@ -0,0 +1,83 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Tuple
+
+# === CONFIGURATION ===
+# Concurrent tasks per resource class: one model forward pass at a time,
+# CPU-heavy stages (tiling, dedup) up to half the cores, I/O-bound encodes wider
+RESOURCE_LIMITS = {"inference": 1, "cpu": max(1, (os.cpu_count() or 2) // 2), "io": 4}
+
+
+@dataclass
+class Task:
+    name: str
+    func: Callable[[], Any]
+    resource: str = "cpu"
+    deps: List[str] = field(default_factory=list)
+    priority: Tuple = ()  # among ready tasks the lowest runs first
+
+
+class TaskSkipped(RuntimeError):
+    pass
+
+
+def run_dag(tasks, limits=RESOURCE_LIMITS):
+    # Run each task once its deps have finished, at most limits[resource] at
+    # a time per resource class. Returns ({name: result}, {name: exception});
+    # tasks downstream of a failure are reported as TaskSkipped.
+    by_name = {task.name: task for task in tasks}
+    for task in tasks:
+        missing = [dep for dep in task.deps if dep not in by_name]
+        if missing:
+            raise ValueError(f"Task {task.name!r} depends on unknown task(s) {missing}")
+        if limits.get(task.resource, 0) < 1:
+            raise ValueError(f"Task {task.name!r} needs resource {task.resource!r}, which has no slots")
+    dependents = {name: [] for name in by_name}
+    for task in tasks:
+        for dep in task.deps:
+            dependents[dep].append(task.name)
+
+    waiting = {task.name: len(task.deps) for task in tasks}
+    order = {task.name: i for i, task in enumerate(tasks)}
+    ready = [task.name for task in tasks if not task.deps]
+    busy = {resource: 0 for resource in limits}
+    results, errors, running = {}, {}, {}
+
+    def _skip(name, cause):
+        for child in dependents[name]:
+            if child not in errors:
+                errors[child] = TaskSkipped(f"{child} skipped: {cause} failed")
+                _skip(child, cause)
+
+    with ThreadPoolExecutor(max_workers=sum(limits.values())) as executor:
+        while ready or running:
+            ready.sort(key=lambda name: (by_name[name].priority, order[name]))
+            for name in list(ready):
+                task = by_name[name]
+                if busy[task.resource] < limits[task.resource]:
+                    ready.remove(name)
+                    busy[task.resource] += 1
+                    running[executor.submit(task.func)] = name
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                busy[by_name[name].resource] -= 1
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    errors[name] = e
+                    _skip(name, name)
+                    continue
+                for child in dependents[name]:
+                    waiting[child] -= 1
+                    if not waiting[child] and child not in errors:
+                        ready.append(child)
+
+    if len(results) + len(errors) < len(tasks):
+        stuck = sorted(set(by_name) - set(results) - set(errors))
+        raise ValueError(f"Dependency cycle among tasks {stuck}")
+    return results, errors
@@ -0,0 +1,229 @@
+import csv
+import os
+import json
+from glob import glob
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+# === Shared data model for in-process pipeline stages ===
+CLASS_NAMES = ['Oil Palm', 'VOP']
+DETECTION_FIELDS = ["Tile", "Class", "Conf", "X", "Y", "W", "H"]
+
+# === Columnar detection store (.det) ===
+# magic | uint32 header length | JSON header | 64-byte aligned column blocks.
+# Tile names live in the header; the tile column holds int32 indices into them.
+DET_MAGIC = b"OPDETS1\n"
+DET_COLUMNS = [("tile", "<i4"), ("cls", "i1"), ("conf", "<f8"), ("x", "<f8"), ("y", "<f8"), ("w", "<f8"), ("h", "<f8")]
+DET_ALIGN = 64
+
+
+def class_code(name):
+    lowered = name.strip().lower()
+    for code, class_name in enumerate(CLASS_NAMES):
+        if class_name.lower() == lowered:
+            return code
+    raise ValueError(f"Unknown detection class: {name!r}")
+
+
+@dataclass
+class Tile:
+    name: str
+    x: int
+    y: int
+    width: int
+    height: int
+    source: str
+    path: Optional[str] = None
+    lon: Optional[float] = None
+    lat: Optional[float] = None
+    skip: Optional[str] = None  # pre-filter reason; the tile is kept but not detected
+
+
+def parse_tile_name(tile_name):
+    parts = os.path.splitext(tile_name)[0].split("_")
+    return int(parts[-2]), int(parts[-1])
+
+
+def tiles_from_dir(tile_dir):
+    tiles = []
+    for tile_path in sorted(glob(os.path.join(tile_dir, "*.jpg"))):
+        tile_name = os.path.basename(tile_path)
+        try:
+            x_offset, y_offset = parse_tile_name(tile_name)
+        except (IndexError, ValueError):
+            print(f"⚠️ Skipping file with unexpected name format: {tile_name}")
+            continue
+        with Image.open(tile_path) as img:
+            tile_w, tile_h = img.size
+        tiles.append(Tile(tile_name, x_offset, y_offset, tile_w, tile_h, source=tile_path, path=tile_path))
+    return tiles
+
+
+@dataclass
+class TilingResult:
+    tiles: List[Tile]
+    image_size: Tuple[int, int]
+
+    @property
+    def image_width(self):
+        return self.image_size[0]
+
+    @property
+    def image_height(self):
+        return self.image_size[1]
+
+
+def canvas_size(tiles: Sequence[Tile]) -> Tuple[int, int]:
+    max_x = max((t.x + t.width for t in tiles), default=0)
+    max_y = max((t.y + t.height for t in tiles), default=0)
+    return max_x, max_y
+
+
+@dataclass
+class Detections:
+    """Column-oriented detections in absolute image pixel coordinates."""
+    tile: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=object))
+    cls: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int8))
+    conf: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float64))
+    x: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float64))
+    y: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float64))
+    w: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float64))
+    h: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float64))
+
+    def __len__(self):
+        return len(self.x)
+
+    @property
+    def class_names(self):
+        return np.asarray(CLASS_NAMES, dtype=object)[self.cls.astype(np.intp)]
+
+    def take(self, index):
+        return Detections(
+            tile=self.tile[index], cls=self.cls[index], conf=self.conf[index],
+            x=self.x[index], y=self.y[index], w=self.w[index], h=self.h[index],
+        )
+
+    @classmethod
+    def concat(cls, parts):
+        parts = [p for p in parts if len(p)]
+        if not parts:
+            return cls()
+        return cls(
+            tile=np.concatenate([p.tile for p in parts]),
+            cls=np.concatenate([p.cls for p in parts]),
+            conf=np.concatenate([p.conf for p in parts]),
+            x=np.concatenate([p.x for p in parts]),
+            y=np.concatenate([p.y for p in parts]),
+            w=np.concatenate([p.w for p in parts]),
+            h=np.concatenate([p.h for p in parts]),
+        )
+
+    @classmethod
+    def from_rows(cls, rows):
+        rows = list(rows)
+        return cls(
+            tile=np.array([r['Tile'] for r in rows], dtype=object),
+            cls=np.array([class_code(r['Class']) for r in rows], dtype=np.int8),
+            conf=np.array([float(r['Conf']) for r in rows], dtype=np.float64),
+            x=np.array([float(r['X']) for r in rows], dtype=np.float64),
+            y=np.array([float(r['Y']) for r in rows], dtype=np.float64),
+            w=np.array([float(r['W']) for r in rows], dtype=np.float64),
+            h=np.array([float(r['H']) for r in rows], dtype=np.float64),
+        )
+
+    @classmethod
+    def read_csv(cls, path):
+        with open(path, newline='') as f:
+            return cls.from_rows(csv.DictReader(f))
+
+    def to_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(DETECTION_FIELDS)
+            writer.writerows(zip(
+                self.tile.tolist(), self.class_names.tolist(), self.conf.tolist(),
+                self.x.tolist(), self.y.tolist(), self.w.tolist(), self.h.tolist(),
+            ))
+
+    def tile_codes(self):
+        # Detections arrive grouped by tile, so only run heads need a lookup
+        n = len(self)
+        if not n:
+            return [], np.empty(0, dtype=np.int32)
+        heads = np.flatnonzero(np.r_[True, self.tile[1:] != self.tile[:-1]])
+        index = {}
+        head_codes = [index.setdefault(name, len(index)) for name in self.tile[heads].tolist()]
+        codes = np.repeat(np.asarray(head_codes, dtype=np.int32), np.diff(np.r_[heads, n]))
+        return list(index), codes
+
+    def save(self, path, meta=None):
+        names, codes = self.tile_codes()
+        columns = {"tile": codes, "cls": self.cls, "conf": self.conf,
+                   "x": self.x, "y": self.y, "w": self.w, "h": self.h}
+
+        layout, offset = [], 0
+        for name, dtype in DET_COLUMNS:
+            layout.append({"name": name, "dtype": dtype, "offset": offset})
+            offset += -(-len(self) * np.dtype(dtype).itemsize // DET_ALIGN) * DET_ALIGN
+        header = json.dumps({"count": len(self), "class_names": CLASS_NAMES, "tiles": names,
+                             "columns": layout, "meta": meta or {}}).encode()
+        data_start = -(-(len(DET_MAGIC) + 4 + len(header)) // DET_ALIGN) * DET_ALIGN
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(DET_MAGIC)
+            f.write(np.uint32(len(header)).tobytes())
+            f.write(header)
+            for column in layout:
+                f.seek(data_start + column["offset"])
+                f.write(np.ascontiguousarray(columns[column["name"]], dtype=column["dtype"]).tobytes())
+            f.truncate(data_start + offset)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def read_header(path):
+        with open(path, "rb") as f:
+            if f.read(len(DET_MAGIC)) != DET_MAGIC:
+                raise ValueError(f"Not a detection store: {path}")
+            size = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+            header = json.loads(f.read(size))
+        header["data_start"] = -(-(len(DET_MAGIC) + 4 + size) // DET_ALIGN) * DET_ALIGN
+        return header
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        # Columns are memory-mapped (read-only) unless mmap=False
+        header = cls.read_header(path)
+        n = header["count"]
+        if header["class_names"] != CLASS_NAMES:
+            raise ValueError(f"{path} was written for classes {header['class_names']}")
+        if not n:
+            return cls()
+        raw = np.memmap(path, dtype=np.uint8, mode="r") if mmap else np.fromfile(path, dtype=np.uint8)
+        columns = {}
+        for column in header["columns"]:
+            start = header["data_start"] + column["offset"]
+            dtype = np.dtype(column["dtype"])
+            columns[column["name"]] = raw[start:start + n * dtype.itemsize].view(dtype)
+        tile_names = np.asarray(header["tiles"], dtype=object)
+        return cls(
+            tile=tile_names[columns["tile"]], cls=columns["cls"], conf=columns["conf"],
+            x=columns["x"], y=columns["y"], w=columns["w"], h=columns["h"],
+        )
+
+
+def read_detections(path):
+    # Any stage input: .det store or legacy CSV
+    if path.lower().endswith(".csv"):
+        return Detections.read_csv(path)
+    return Detections.load(path)
+
+
+def detection_meta(path):
+    # Metadata written alongside a .det store (CSV carries none)
+    if path.lower().endswith(".csv"):
+        return {}
+    return Detections.read_header(path)["meta"]
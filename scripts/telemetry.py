@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import platform
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# === CONFIGURATION ===
+MANIFEST_NAME = "run_manifest.json"  # written next to the outputs after every run
+TRACE_NAME = "run_trace.json"  # Chrome trace events, opt-in
+RSS_SAMPLE_S = 0.05
+THROUGHPUT_ITEMS = ("tiles", "detections")  # items reported per second
+
+
+# === Memory ===
+def current_rss():
+    # Resident set size in bytes (psutil when installed, /proc on Linux)
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class RssSampler:
+    # Peak RSS over a block, polled from a background thread; growth is the
+    # peak above the starting RSS, which earlier work does not skew.
+    # keep_samples records (perf_counter, bytes) pairs for per-span peaks.
+    def __init__(self, interval=RSS_SAMPLE_S, keep_samples=False):
+        self.interval = interval
+        self.start_rss = self.peak = current_rss()
+        self.samples = [] if keep_samples else None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._poll, name="rss-sampler", daemon=True)
+
+    def _record(self):
+        rss = current_rss()
+        if rss is None:
+            return
+        if self.peak is None or rss > self.peak:
+            self.peak = rss
+        if self.samples is not None:
+            self.samples.append((time.perf_counter(), rss))
+
+    def _poll(self):
+        while not self.stop_event.wait(self.interval):
+            self._record()
+
+    def start(self):
+        self._record()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self._record()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+# === Spans ===
+def path_bytes(path):
+    # Size of a file, or of everything under a directory (DZI pyramids)
+    if not path or not os.path.exists(path):
+        return 0
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+_local = threading.local()
+
+
+def current_span():
+    # The innermost span open on this thread, if any
+    return getattr(_local, "span", None)
+
+
+def mark_cached():
+    # The running stage reused cached outputs instead of doing the work
+    span = current_span()
+    if span is not None:
+        span.args["cached"] = True
+
+
+class Span:
+    def __init__(self, name, category, args):
+        self.name, self.category, self.args = name, category, args
+        self.items, self.bytes_written, self.error = {}, 0, None
+        self.start = self.end = self.cpu_s = self.thread_cpu_s = None
+        self.thread, self.tid = threading.current_thread().name, threading.get_ident()
+
+    def count(self, **items):
+        # Items processed, e.g. tiles=..., detections=...; throughput is per wall second
+        for key, value in items.items():
+            if value is not None:
+                self.items[key] = self.items.get(key, 0) + int(value)
+
+    def wrote(self, *paths):
+        self.bytes_written += sum(path_bytes(path) for path in paths)
+
+
+class Telemetry:
+    """Wall/CPU time, peak RSS, items and bytes written per pipeline stage.
+
+    Stages run inside span(); a background sampler tracks RSS so each span
+    gets its own peak and the trace a memory counter. cpu_s is the whole
+    process's CPU time while the span ran (worker threads included, and
+    stages running alongside it); thread_cpu_s is the calling thread's own.
+    """
+
+    def __init__(self, sample_interval=RSS_SAMPLE_S):
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.origin, self.cpu_origin = time.perf_counter(), time.process_time()
+        self.spans = []
+        self.lock = threading.Lock()
+        self.rss = RssSampler(sample_interval, keep_samples=True)
+        self.finished = None
+
+    def start(self):
+        self.rss.start()
+        return self
+
+    def stop(self):
+        if self.finished is None:
+            self.rss.stop()
+            self.finished = (time.perf_counter(), time.process_time())
+
+    @contextmanager
+    def span(self, name, category="stage", **args):
+        span, outer = Span(name, category, args), current_span()
+        _local.span = span
+        span.start, cpu, thread_cpu = time.perf_counter(), time.process_time(), time.thread_time()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _local.span = outer
+            span.end = time.perf_counter()
+            span.cpu_s, span.thread_cpu_s = time.process_time() - cpu, time.thread_time() - thread_cpu
+            with self.lock:
+                self.spans.append(span)
+
+    def _peak(self, start, end):
+        peaks = [rss for t, rss in list(self.rss.samples) if start <= t <= end]
+        if not peaks:  # shorter than one sampling interval: nearest sample before it
+            before = [rss for t, rss in list(self.rss.samples) if t <= start]
+            peaks = before[-1:]
+        return max(peaks) / 2 ** 20 if peaks else None
+
+    # === Output ===
+    def stages(self):
+        # One JSON-ready record per span, in start order
+        records = []
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        for span in spans:
+            wall = span.end - span.start
+            throughput = {f"{key}_per_s": round(span.items[key] / wall, 3)
+                          for key in THROUGHPUT_ITEMS if key in span.items and wall > 0}
+            if span.args.get("cached"):  # reused outputs: rates would be meaningless
+                throughput = {}
+            elif span.bytes_written and wall > 0:
+                throughput["mb_written_per_s"] = round(span.bytes_written / 2 ** 20 / wall, 3)
+            peak = self._peak(span.start, span.end)
+            records.append({
+                "name": span.name, "category": span.category, **span.args,
+                "start_s": round(span.start - self.origin, 4), "wall_s": round(wall, 4),
+                "cpu_s": round(span.cpu_s, 4), "thread_cpu_s": round(span.thread_cpu_s, 4),
+                "peak_rss_mb": None if peak is None else round(peak, 1),
+                "items": span.items, "mb_written": round(span.bytes_written / 2 ** 20, 3),
+                "throughput": throughput, "error": span.error,
+            })
+        return records
+
+    def totals(self):
+        end, cpu_end = self.finished or (time.perf_counter(), time.process_time())
+        return {"wall_s": round(end - self.origin, 3), "cpu_s": round(cpu_end - self.cpu_origin, 3),
+                "peak_rss_mb": None if self.rss.peak is None else round(self.rss.peak / 2 ** 20, 1)}
+
+    def save_manifest(self, path, **extra):
+        manifest = {
+            "started": self.started, **extra, "totals": self.totals(), "stages": self.stages(),
+            "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                        "cpu_count": os.cpu_count(), "node": platform.node()},
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2, default=str)
+        return path
+
+    def save_trace(self, path):
+        # Chrome trace-event JSON: one complete event per span, thread names,
+        # and an RSS counter track (chrome://tracing or ui.perfetto.dev)
+        pid = os.getpid()
+        events = [{"ph": "M", "name": "process_name", "pid": pid, "tid": 0, "args": {"name": "oil palm pipeline"}}]
+        for tid, thread in {span.tid: span.thread for span in self.spans}.items():
+            events.append({"ph": "M", "name": "thread_name", "pid": pid, "tid": tid, "args": {"name": thread}})
+        for span, record in zip(sorted(self.spans, key=lambda s: s.start), self.stages()):
+            events.append({
+                "ph": "X", "name": record.get("image") and f"{span.name} [{record['image']}]" or span.name,
+                "cat": span.category, "pid": pid, "tid": span.tid,
+                "ts": round((span.start - self.origin) * 1e6), "dur": round((span.end - span.start) * 1e6),
+                "args": {key: record[key] for key in ("cpu_s", "peak_rss_mb", "items", "mb_written", "throughput",
+                                                      "error") if record[key]},
+            })
+        for t, rss in list(self.rss.samples):
+            events.append({"ph": "C", "name": "RSS", "pid": pid, "tid": 0, "ts": round((t - self.origin) * 1e6),
+                           "args": {"MB": round(rss / 2 ** 20, 1)}})
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return path
+
+
+def format_stage(record):
+    # One console line per stage record
+    line = f"{record['name']}" + (f" [{record['image']}]" if record.get("image") else "")
+    line += f": {record['wall_s']:.2f}s wall, {record['cpu_s']:.2f}s CPU"
+    if record["peak_rss_mb"] is not None:
+        line += f", {record['peak_rss_mb']:.0f} MB peak"
+    rates = [f"{value:,.1f} {key[:-6]}/s" for key, value in record["throughput"].items() if key != "mb_written_per_s"]
+    if "mb_written_per_s" in record["throughput"]:
+        rates.append(f"{record['throughput']['mb_written_per_s']:.1f} MB/s written")
+    if rates:
+        line += ", " + ", ".join(rates)
+    if record.get("cached"):
+        line += " (cached)"
+    return line
@@ -0,0 +1,94 @@
+import os
+from collections import Counter
+
+import numpy as np
+from PIL import Image
+
+from stage_types import tiles_from_dir
+
+# === CONFIGURATION ===
+# Tiles that cannot contain palms skip detection: nodata borders, flat
+# colour (water, tarmac, clipped sky) and anything without green cover.
+# Heuristic, so it changes detection counts: opt-in.
+PREFILTER_TILES = False
+FILTER_STRIDE = 4  # checks run on 4x4 block means, which also evens out sensor noise
+NODATA_DARK = 8  # pixels this dark or ...
+NODATA_BRIGHT = 247  # ... this bright in every band count as nodata (padding, collar)
+MIN_VALID_FRACTION = 0.02  # below this share of valid pixels a tile is "nodata"
+UNIFORM_STD = 2.0  # every band's std below this is "uniform"
+EXG_THRESHOLD = 10  # excess green 2G - R - B above which a pixel counts as vegetation
+MIN_GREEN_FRACTION = 0.02  # below this share of green valid pixels a tile is "no_vegetation"
+SKIP_REASONS = ("nodata", "uniform", "no_vegetation")
+TILE_DIR = r"C:/Users/palac/Documents/Oilpalms/scripts/tiles"
+
+
+def filter_params():
+    # Everything that decides which tiles are skipped, for cache keys
+    return ["prefilter", "colour-only-exg", FILTER_STRIDE, NODATA_DARK, NODATA_BRIGHT, MIN_VALID_FRACTION, UNIFORM_STD,
+            EXG_THRESHOLD, MIN_GREEN_FRACTION]
+
+
+def _blocks(array):
+    # Mean over FILTER_STRIDE x FILTER_STRIDE blocks (partial edge blocks dropped)
+    h, w = array.shape[0] // FILTER_STRIDE * FILTER_STRIDE, array.shape[1] // FILTER_STRIDE * FILTER_STRIDE
+    rows = sum(array[i:h:FILTER_STRIDE, :w].astype(np.uint16) for i in range(FILTER_STRIDE))
+    return sum(rows[:, j::FILTER_STRIDE] for j in range(FILTER_STRIDE)) * np.float32(1 / FILTER_STRIDE ** 2)
+
+
+def is_colour(bands):
+    # Excess green only means something for 3-band colour; greyscale,
+    # palette and single-band inputs skip the vegetation test
+    return bands >= 3
+
+
+def skip_reason(array, mask=None, vegetation=True):
+    # Why an RGB tile cannot contain palms, or None to detect it.
+    # mask is the GeoTIFF dataset mask for the same window (0 = nodata);
+    # vegetation=False (non-colour input) keeps only the nodata/uniform tests.
+    if min(array.shape[:2]) < FILTER_STRIDE:
+        return None
+    view = _blocks(array[..., :3])
+    valid = (view.max(axis=2) > NODATA_DARK) & (view.min(axis=2) < NODATA_BRIGHT)
+    if mask is not None:
+        valid &= _blocks(mask[..., None])[..., 0] > 127
+    if valid.mean() < MIN_VALID_FRACTION:
+        return "nodata"
+
+    pixels = view[valid]
+    if pixels.std(axis=0).max() < UNIFORM_STD:
+        return "uniform"
+    if not vegetation:
+        return None
+    exg = 2 * pixels[:, 1] - pixels[:, 0] - pixels[:, 2]
+    if (exg > EXG_THRESHOLD).mean() < MIN_GREEN_FRACTION:
+        return "no_vegetation"
+    return None
+
+
+def skip_summary(tiles):
+    # {reason: count} over tiles the pre-filter dropped
+    counts = Counter(tile.skip for tile in tiles if tile.skip)
+    return {reason: counts[reason] for reason in SKIP_REASONS if counts[reason]}
+
+
+def format_skips(tiles):
+    skipped = skip_summary(tiles)
+    total = sum(skipped.values())
+    detail = ", ".join(f"{reason} {count}" for reason, count in skipped.items())
+    share = 100 * total / len(tiles) if tiles else 0
+    summary = f"{total} of {len(tiles)} tile(s) skipped before detection ({share:.0f}%)"
+    return f"{summary}: {detail}" if detail else summary
+
+
+if __name__ == "__main__":
+    # Dry run over saved tiles to tune the thresholds
+    tiles = tiles_from_dir(TILE_DIR)
+    if not tiles:
+        raise FileNotFoundError(f"❌ No tile images found in {TILE_DIR}")
+    for tile in tiles:
+        with Image.open(tile.path) as img:
+            tile.skip = skip_reason(np.asarray(img.convert("RGB")), vegetation=is_colour(len(img.getbands())))
+    print(f"🚫 {format_skips(tiles)}")
+    for tile in tiles:
+        if tile.skip:
+            print(f"   {os.path.basename(tile.path)}: {tile.skip}")
@@ -1,13 +1,23 @@
 import os
 import glob
+import queue
+import threading
+import warnings
+from collections import deque
+from math import lcm
+import numpy as np
 from tqdm import tqdm
 from PIL import Image, ImageFile
 import piexif
 import rasterio
+from rasterio.errors import NotGeoreferencedWarning, RasterioIOError
 from rasterio.windows import Window
 from concurrent.futures import ThreadPoolExecutor
 import csv
 
+from stage_types import Tile, TilingResult, canvas_size
+from tile_filter import is_colour, skip_reason
+
 # === PIL Decompression Bomb Override ===
 Image.MAX_IMAGE_PIXELS = None
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -17,100 +27,342 @@ INPUT_FOLDER = r"C:/Users/palac/Documents/Oilpalms/input"
 OUTPUT_DIR = r"C:/Users/palac/Documents/Oilpalms/scripts/tiles"
 CSV_PATH = os.path.join(OUTPUT_DIR, "tile_geolocation.csv")
 TILE_SIZE = 640
+TILE_OVERLAP = 0  # pixels shared by neighbouring tiles (e.g. 64 for palm-sized seams)
 MAX_WORKERS = 6
 SAVE_GEO_CSV = True
-
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+QUEUE_SIZE = 64  # in-memory tiles buffered between tiling and detection
+STRIP_CACHE_MB = 32  # GDAL block cache while strip-reading JPEG/PNG
+MAX_BAND_ROWS = 8  # cap on tile rows grouped to line up with GeoTIFF blocks
 
 # === SUPPORTED FORMATS ===
 SUPPORTED_EXTS = ['*.jpg', '*.jpeg', '*.png', '*.tif', '*.tiff']
 
+
 # === FIND INPUT IMAGES ===
-image_paths = []
-for ext in SUPPORTED_EXTS:
-    image_paths.extend(glob.glob(os.path.join(INPUT_FOLDER, ext)))
+def find_images(input_folder=INPUT_FOLDER):
+    image_paths = []
+    for ext in SUPPORTED_EXTS:
+        image_paths.extend(glob.glob(os.path.join(input_folder, ext)))
+    return image_paths
 
-print(f"📷 Found {len(image_paths)} input image(s)...")
 
-# === Optional: Geolocation CSV ===
-geo_csv_rows = []
+def is_geotiff(image_path):
+    return image_path.lower().endswith((".tif", ".tiff"))
 
-# === TILE IMAGE ===
-def tile_image(image_path):
+
+def tile_starts(length, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f"Tile overlap must be in [0, {tile_size}), got {overlap}")
+    starts = list(range(0, length, tile_size - overlap))
+    # Drop trailing tiles that would only repeat the previous tile's overlap
+    while len(starts) > 1 and starts[-1] + overlap >= length:
+        starts.pop()
+    return starts
+
+
+def load_exif(image_path):
+    if is_geotiff(image_path):
+        return None
     base_name = os.path.splitext(os.path.basename(image_path))[0]
-    tile_count = 0
+    try:
+        with Image.open(image_path) as img:
+            return piexif.load(img.info.get("exif", b""))
+    except Exception:
+        print(f"⚠️ No EXIF: {base_name}")
+        return None
 
+
+def exif_bytes(image_path, info=None):
+    # Serialized EXIF for an image's tiles, dumped once per image; info is
+    # its input catalog entry, which already holds the bytes
+    if info is not None:
+        return info.exif
+    exif_data = load_exif(image_path)
+    return piexif.dump(exif_data) if exif_data else None
+
+
+# === READ STRIPS (non-GeoTIFF) ===
+def _strip_to_rgb(strip, src):
+    if strip.shape[0] >= 3:
+        return strip[:3].transpose(1, 2, 0)
+    if src.colorinterp and src.colorinterp[0].name == "palette":
+        colormap = src.colormap(1)
+        lut = np.zeros((256, 3), dtype=np.uint8)
+        for index, rgba in colormap.items():
+            lut[index] = rgba[:3]
+        return lut[strip[0]]
+    return np.repeat(strip[0][:, :, None], 3, axis=2)
+
+
+def _open_strip_source(image_path):
     try:
-        if image_path.lower().endswith((".tif", ".tiff")):
-            # --- Use rasterio for GeoTIFF ---
-            with rasterio.open(image_path) as src:
-                width, height = src.width, src.height
-                print(f"🌍 GeoTIFF detected: {base_name} ({width}x{height})")
-
-                for y in range(0, height, TILE_SIZE):
-                    for x in range(0, width, TILE_SIZE):
-                        window = Window(x, y, TILE_SIZE, TILE_SIZE)
-                        transform = src.window_transform(window)
-                        tile = src.read([1, 2, 3], window=window)  # RGB only
-                        tile_img = Image.fromarray(tile.transpose(1, 2, 0)).convert("RGB")
-
-                        tile_name = f"{base_name}_tile_{x}_{y}.jpg"
-                        tile_path = os.path.join(OUTPUT_DIR, tile_name)
-                        tile_img.save(tile_path, "JPEG")
-
-                        if SAVE_GEO_CSV:
-                            lon, lat = transform * (0, 0)
-                            geo_csv_rows.append({
-                                "Tile": tile_name,
-                                "TopLeft_Lon": lon,
-                                "TopLeft_Lat": lat
-                            })
-
-                        tile_count += 1
-                return tile_count
-
-        else:
-            # --- Use PIL for non-GeoTIFF ---
-            img = Image.open(image_path).convert("RGB")
-            width, height = img.size
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", NotGeoreferencedWarning)
+            src = rasterio.open(image_path)
+    except RasterioIOError:
+        return None
+    if src.dtypes[0] != "uint8":
+        src.close()
+        return None
+    return src
 
-            try:
-                exif_data = piexif.load(img.info.get("exif", b""))
-            except Exception:
-                exif_data = None
-                print(f"⚠️ No EXIF: {base_name}")
 
-            for y in range(0, height, TILE_SIZE):
-                for x in range(0, width, TILE_SIZE):
-                    box = (x, y, x + TILE_SIZE, y + TILE_SIZE)
-                    tile = img.crop(box)
+def read_strips(image_path, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    # GDAL decodes JPEG/PNG scanlines sequentially, so reading one tile row at
+    # a time keeps memory at roughly tile_size x width x 3 bytes. The block
+    # cache is capped so decoded rows do not pile up as we move down.
+    with rasterio.Env(GDAL_CACHEMAX=STRIP_CACHE_MB):
+        src = _open_strip_source(image_path)
+        if src is not None:
+            with src:
+                prev, prev_y = None, 0
+                for y in tile_starts(src.height, tile_size, overlap):
+                    end = min(y + tile_size, src.height)
+                    # Overlapping rows are reused from the previous strip so the
+                    # decoder never has to seek backwards
+                    read_from = y if prev is None else max(y, prev_y + prev.shape[0])
+                    strip = _strip_to_rgb(src.read(window=Window(0, read_from, src.width, end - read_from)), src)
+                    if read_from > y:
+                        strip = np.concatenate([prev[y - prev_y:], strip])
+                    yield y, strip
+                    prev, prev_y = strip, y
+            return
+
+    # --- Fallback: full PIL decode ---
+    img = Image.open(image_path).convert("RGB")
+    array = np.asarray(img)
+    for y in tile_starts(img.height, tile_size, overlap):
+        yield y, array[y:y + tile_size]
+
+
+# === GEOTIFF BANDS (intra-image parallelism) ===
+def geotiff_bands(src, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    # Group tile rows so that band edges fall on the raster's internal block
+    # rows; each compressed block is then decoded by exactly one worker.
+    block_h = src.block_shapes[0][0]
+    stride = tile_size - overlap
+    rows_per_band = lcm(stride, block_h) // stride
+    if rows_per_band > MAX_BAND_ROWS:
+        rows_per_band = 1
+    rows = tile_starts(src.height, tile_size, overlap)
+    return [rows[i:i + rows_per_band] for i in range(0, len(rows), rows_per_band)]
+
+
+def _read_geotiff_band(image_path, band_rows, tile_size, on_tile=None, overlap=TILE_OVERLAP, prefilter=False):
+    base_name = os.path.splitext(os.path.basename(image_path))[0]
+    results = []
+
+    # Every worker opens its own handle; rasterio datasets are not thread-safe
+    with rasterio.open(image_path) as src:
+        vegetation = is_colour(src.count)
+        for y in band_rows:
+            for x in tile_starts(src.width, tile_size, overlap):
+                window = Window(x, y, tile_size, tile_size)
+                transform = src.window_transform(window)
+                tile = src.read([1, 2, 3], window=window)  # RGB only
+                array = np.ascontiguousarray(tile.transpose(1, 2, 0))
+
+                lon, lat = transform * (0, 0)
+                tile_name = f"{base_name}_tile_{x}_{y}.jpg"
+                tile_meta = Tile(tile_name, x, y, array.shape[1], array.shape[0],
+                                 source=image_path, lon=lon, lat=lat)
+                if prefilter:
+                    tile_meta.skip = skip_reason(array, src.dataset_mask(window=window), vegetation)
+                if on_tile:
+                    on_tile(tile_meta, array)
+                results.append((tile_meta, array))
+    return results
+
+
+def read_geotiff_tiles(image_path, tile_size=TILE_SIZE, max_workers=MAX_WORKERS, on_tile=None, keep_arrays=True,
+                       overlap=TILE_OVERLAP, prefilter=False):
+    base_name = os.path.splitext(os.path.basename(image_path))[0]
+    with rasterio.open(image_path) as src:
+        print(f"🌍 GeoTIFF detected: {base_name} ({src.width}x{src.height})")
+        bands = geotiff_bands(src, tile_size, overlap)
+
+    def _band(band_rows):
+        results = _read_geotiff_band(image_path, band_rows, tile_size, on_tile, overlap, prefilter)
+        return results if keep_arrays else [(tile, None) for tile, _ in results]
+
+    # Bands are yielded in row-major order with a bounded number in flight
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for band_rows in bands:
+            pending.append(executor.submit(_band, band_rows))
+            if len(pending) >= 2 * max_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+# === READ TILES (in memory) ===
+def read_tiles(image_path, tile_size=TILE_SIZE, max_workers=1, on_tile=None, keep_arrays=True,
+               overlap=TILE_OVERLAP, prefilter=False):
+    # prefilter tags tiles that cannot contain palms with Tile.skip
+    base_name = os.path.splitext(os.path.basename(image_path))[0]
+
+    if is_geotiff(image_path):
+        # --- Use rasterio for GeoTIFF, bands split across workers ---
+        yield from read_geotiff_tiles(image_path, tile_size, max_workers, on_tile, keep_arrays, overlap, prefilter)
+
+    else:
+        # --- Windowed strips for non-GeoTIFF (edge tiles padded black) ---
+        vegetation = False
+        if prefilter:
+            with Image.open(image_path) as img:  # header only: greyscale strips are expanded to RGB
+                vegetation = is_colour(len(img.getbands()))
+        for y, strip in read_strips(image_path, tile_size, overlap):
+            for x in tile_starts(strip.shape[1], tile_size, overlap):
+                chunk = strip[:, x:x + tile_size]
+                array = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
+                array[:chunk.shape[0], :chunk.shape[1]] = chunk
+
+                tile_name = f"{base_name}_tile_{x}_{y}.jpg"
+                tile = Tile(tile_name, x, y, array.shape[1], array.shape[0], source=image_path)
+                if prefilter:
+                    tile.skip = skip_reason(array, vegetation=vegetation)  # black padding counts as nodata
+                if on_tile:
+                    on_tile(tile, array)
+                yield tile, array
+
 
-                    tile_name = f"{base_name}_tile_{x}_{y}.jpg"
-                    tile_path = os.path.join(OUTPUT_DIR, tile_name)
+def save_tile(tile, array, output_dir, exif=None):
+    # exif: serialized EXIF bytes (see exif_bytes)
+    tile_img = Image.fromarray(array).convert("RGB")
+    tile.path = os.path.join(output_dir, tile.name)
 
-                    if exif_data:
-                        tile.save(tile_path, "JPEG", exif=piexif.dump(exif_data))
-                    else:
-                        tile.save(tile_path, "JPEG")
+    if exif:
+        tile_img.save(tile.path, "JPEG", exif=exif)
+    else:
+        tile_img.save(tile.path, "JPEG")
 
-                    tile_count += 1
-            return tile_count
+
+# === TILE IMAGE ===
+def tile_image(image_path, output_dir=OUTPUT_DIR, tile_size=TILE_SIZE, max_workers=1, overlap=TILE_OVERLAP,
+               prefilter=False, info=None):
+    base_name = os.path.splitext(os.path.basename(image_path))[0]
+
+    try:
+        exif = exif_bytes(image_path, info)
+
+        def _save(tile, array):
+            save_tile(tile, array, output_dir, exif)
+
+        # Tiles are encoded by the worker that read them
+        return [tile for tile, _ in read_tiles(image_path, tile_size, max_workers, _save,
+                                               keep_arrays=False, overlap=overlap, prefilter=prefilter)]
 
     except Exception as e:
         print(f"❌ Error processing {base_name}: {e}")
-        return 0
+        return []
+
 
 # === MULTI-THREADED EXECUTION ===
-with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-    results = list(tqdm(executor.map(tile_image, image_paths), total=len(image_paths), desc="🧩 Tiling with ETA"))
+def tile_images(image_paths, output_dir=OUTPUT_DIR, tile_size=TILE_SIZE, max_workers=MAX_WORKERS,
+                overlap=TILE_OVERLAP, prefilter=False, infos=None):
+    # infos: {path: ImageInfo} from the input catalog, so EXIF is not re-read
+    os.makedirs(output_dir, exist_ok=True)
+    infos = infos or {}
+    print(f"📷 Found {len(image_paths)} input image(s)...")
+
+    # GeoTIFFs get the whole pool each (split by tile bands); other formats
+    # decode sequentially, so those are spread across the pool per image.
+    results = [None] * len(image_paths)
+    geotiffs = [i for i, path in enumerate(image_paths) if is_geotiff(path)]
+    others = [i for i, path in enumerate(image_paths) if not is_geotiff(path)]
+
+    for i in tqdm(geotiffs, desc="🧩 Tiling GeoTIFFs"):
+        results[i] = tile_image(image_paths[i], output_dir, tile_size, max_workers, overlap, prefilter,
+                                infos.get(image_paths[i]))
+
+    def _tile(i):
+        return tile_image(image_paths[i], output_dir, tile_size, overlap=overlap, prefilter=prefilter,
+                          info=infos.get(image_paths[i]))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for i, image_tiles in zip(others, tqdm(executor.map(_tile, others), total=len(others), desc="🧩 Tiling with ETA")):
+            results[i] = image_tiles
+
+    tiles = [tile for image_tiles in results for tile in image_tiles]
+    print(f"\n🎉 Done. Total tiles saved: {len(tiles)}")
+    return TilingResult(tiles=tiles, image_size=canvas_size(tiles))
+
+
+# === STREAMING EXECUTION ===
+_DONE = object()
+
+
+def stream_tiles(image_paths, tile_size=TILE_SIZE, output_dir=None, queue_size=QUEUE_SIZE,
+                 max_workers=MAX_WORKERS, overlap=TILE_OVERLAP, prefilter=False, infos=None):
+    # Tiles are produced on a background thread into a bounded queue so that
+    # tiling overlaps with whatever consumes them; JPEGs are only written
+    # when output_dir is given.
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    infos = infos or {}
+    buffer = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce():
+        try:
+            for image_path in image_paths:
+                base_name = os.path.splitext(os.path.basename(image_path))[0]
+                try:
+                    on_tile = None
+                    if output_dir:
+                        exif = exif_bytes(image_path, infos.get(image_path))
+
+                        def on_tile(tile, array):
+                            save_tile(tile, array, output_dir, exif)
+
+                    for tile, array in read_tiles(image_path, tile_size, max_workers, on_tile, overlap=overlap,
+                                                  prefilter=prefilter):
+                        if not _put((tile, array)):
+                            return
+                except Exception as e:
+                    print(f"❌ Error processing {base_name}: {e}")
+        finally:
+            _put(_DONE)
+
+    producer = threading.Thread(target=_produce, name="tile-producer", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _DONE:
+                break
+            yield item
+    finally:
+        stop.set()
+        producer.join()
 
-total_tiles = sum(results)
-print(f"\n🎉 Done. Total tiles saved: {total_tiles}")
 
 # === OPTIONAL: Save geolocation CSV ===
-if SAVE_GEO_CSV and geo_csv_rows:
-    with open(CSV_PATH, 'w', newline='') as f:
+def save_geo_csv(tiles, csv_path=CSV_PATH):
+    geo_csv_rows = [
+        {"Tile": t.name, "TopLeft_Lon": t.lon, "TopLeft_Lat": t.lat}
+        for t in tiles if t.lon is not None
+    ]
+    if not geo_csv_rows:
+        return
+    with open(csv_path, 'w', newline='') as f:
         writer = csv.DictWriter(f, fieldnames=["Tile", "TopLeft_Lon", "TopLeft_Lat"])
         writer.writeheader()
         writer.writerows(geo_csv_rows)
-    print(f"📍 Geo-location CSV saved: {CSV_PATH}")
+    print(f"📍 Geo-location CSV saved: {csv_path}")
+
+
+if __name__ == "__main__":
+    result = tile_images(find_images(INPUT_FOLDER), OUTPUT_DIR)
+    if SAVE_GEO_CSV:
+        save_geo_csv(result.tiles, CSV_PATH)
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# The stage modules are flat scripts run from scripts/ (and GUI/), not a package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+sys.path.insert(0, os.path.join(ROOT, "GUI"))
+
+from stage_types import Detections  # noqa: E402
+
+
+def make_detections(x, y, w=40.0, h=40.0, conf=None, cls=None, tile=None):
+    # Detections from plain arrays; scalars broadcast
+    n = len(x)
+    return Detections(
+        tile=np.asarray(tile if tile is not None else ["image_tile_0_0.jpg"] * n, dtype=object),
+        cls=np.asarray(cls if cls is not None else np.zeros(n), dtype=np.int8),
+        conf=np.asarray(conf if conf is not None else np.linspace(0.9, 0.5, n), dtype=np.float64),
+        x=np.asarray(x, dtype=np.float64), y=np.asarray(y, dtype=np.float64),
+        w=np.broadcast_to(np.asarray(w, dtype=np.float64), (n,)).copy(),
+        h=np.broadcast_to(np.asarray(h, dtype=np.float64), (n,)).copy(),
+    )
+
+
+def assert_same(a, b):
+    # Column-for-column equality of two Detections
+    for column in ("tile", "cls", "conf", "x", "y", "w", "h"):
+        np.testing.assert_array_equal(getattr(a, column), getattr(b, column))
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
@@ -0,0 +1,108 @@
+import json
+
+import numpy as np
+import pytest
+
+from cluster_index import CLUSTER_MAX_ZOOM, CLUSTER_MIN_ZOOM, ClusterIndex, cell_size
+from conftest import make_detections
+from export_geojson import export_geojson
+from feature_index import CLASS_NAMES, FeatureIndex
+
+ZOOMS = range(CLUSTER_MIN_ZOOM, CLUSTER_MAX_ZOOM + 1)
+
+
+def brute_force(x, y, cls, zoom):
+    # {(row, col): (count, sum x, sum y, per-class counts)} straight from the points
+    size = cell_size(zoom)
+    cells = {}
+    for px, py, c in zip(x.tolist(), y.tolist(), cls.tolist()):
+        key = (int(np.floor(py / size)), int(np.floor(px / size)))
+        count, sx, sy, classes = cells.get(key, (0, 0.0, 0.0, [0] * len(CLASS_NAMES)))
+        if c >= 0:
+            classes[c] += 1
+        cells[key] = (count + 1, sx + px, sy + py, classes)
+    return cells
+
+
+def level_cells(index, zoom):
+    level = index.levels[zoom]
+    rows = (level["keys"] >> 32).tolist()
+    cols = ((level["keys"] & 0xFFFFFFFF) - (1 << 31)).tolist()
+    return {(r, c): (int(n), float(sx), float(sy), classes.tolist())
+            for r, c, n, sx, sy, classes in zip(rows, cols, level["count"], level["sx"], level["sy"], level["classes"])}
+
+
+def assert_levels(index, x, y, cls):
+    for zoom in ZOOMS:
+        got, expected = level_cells(index, zoom), brute_force(x, y, cls, zoom)
+        assert got.keys() == expected.keys(), zoom
+        for key, (count, sx, sy, classes) in expected.items():
+            assert got[key][0] == count and got[key][3] == classes, (zoom, key)
+            assert got[key][1:3] == pytest.approx((sx, sy)), (zoom, key)
+
+
+@pytest.fixture
+def points(rng):
+    # Map coordinates may be negative, so cells straddle the origin
+    n = 3000
+    detections = make_detections(rng.uniform(-3000, 9000, n), rng.uniform(-2000, 6000, n), cls=rng.integers(0, 2, n))
+    return detections.x, detections.y, detections.cls.astype(np.int64)
+
+
+def test_levels_match_brute_force(points):
+    x, y, cls = points
+    cls = np.where(np.arange(len(cls)) % 97 == 0, -1, cls)  # unknown classes count but have no breakdown
+    assert_levels(ClusterIndex(x, y, cls, CLASS_NAMES), x, y, cls)
+
+
+def test_every_zoom_counts_every_point(points):
+    x, y, cls = points
+    index = ClusterIndex(x, y, cls, CLASS_NAMES)
+    for zoom in ZOOMS:
+        features = [json.loads(f) for f in index.features(zoom)]
+        assert sum(f["properties"]["point_count"] for f in features) == len(x)
+        assert sum(f["properties"]["classes"]["VOP"] for f in features) == int((cls == 1).sum())
+
+
+def test_bbox_query_returns_overlapping_cells(points, rng):
+    x, y, cls = points
+    index = ClusterIndex(x, y, cls, CLASS_NAMES)
+    for zoom in ZOOMS:
+        size = cell_size(zoom)
+        keys = list(level_cells(index, zoom))
+        for _ in range(20):
+            west, south = rng.uniform(-4000, 9000), rng.uniform(-3000, 6000)
+            bbox = (west, south, west + rng.uniform(0, 6000), south + rng.uniform(0, 4000))
+            rows = range(int(np.floor(bbox[1] / size)), int(np.floor(bbox[3] / size)) + 1)
+            cols = range(int(np.floor(bbox[0] / size)), int(np.floor(bbox[2] / size)) + 1)
+            expected = {key for key in keys if key[0] in rows and key[1] in cols}
+            assert {keys[i] for i in index.query(zoom, bbox).tolist()} == expected, (zoom, bbox)
+
+
+def test_updates_match_a_rebuild(points, rng):
+    x, y, cls = points
+    index = ClusterIndex(x, y, cls, CLASS_NAMES)
+    removed = rng.choice(len(x), 300, replace=False)
+    new_x, new_y = rng.uniform(-5000, 12000, 200), rng.uniform(-5000, 9000, 200)
+    new_cls = rng.integers(0, 2, 200)
+    index.update(x[removed], y[removed], cls[removed], np.full(len(removed), -1))
+    index.update(new_x, new_y, new_cls, np.ones(len(new_x), dtype=np.int64))
+
+    kept = np.setdiff1d(np.arange(len(x)), removed)
+    assert_levels(index, np.r_[x[kept], new_x], np.r_[y[kept], new_y], np.r_[cls[kept], new_cls])
+
+
+def test_gui_cluster_counts_follow_edits(tmp_path, rng):
+    n = 500
+    detections = make_detections(rng.uniform(0, 4000, n), rng.uniform(0, 4000, n), cls=rng.integers(0, 2, n))
+    index = FeatureIndex(export_geojson(detections, 4000, str(tmp_path / "detections.geojson")))
+    index.refresh()
+    index.apply([{"op": "delete", "id": 0}, {"op": "move", "id": 1, "coordinates": [-500.0, -500.0]},
+                 {"op": "reclassify", "id": 2, "class": "VOP"}])
+    vop = int((detections.cls[3:] == 1).sum()) + int(detections.cls[1] == 1) + 1
+
+    for zoom in ZOOMS:
+        body, _ = index.response(None, zoom)
+        features = json.loads(body)["features"]
+        assert sum(f["properties"]["point_count"] for f in features) == n - 1
+        assert sum(f["properties"]["classes"]["VOP"] for f in features) == vop
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from conftest import make_detections
+from deduplicate_detections import deduplicate, deduplicate_nms
+
+TILE, OVERLAP = 640, 64
+LEFT, RIGHT = "img_tile_0_0.jpg", "img_tile_576_0.jpg"  # neighbours sharing x 576..640
+
+
+def test_seam_duplicate_keeps_the_stronger_box():
+    detections = make_detections([605.0, 607.0], [300.0, 302.0], conf=[0.6, 0.9], tile=[LEFT, RIGHT])
+    kept = deduplicate_nms(detections, TILE, OVERLAP)
+    assert kept.conf.tolist() == [0.9]
+
+
+def test_crown_cut_by_tile_edge_is_caught_by_containment():
+    # The left tile only saw the part of the crown inside its edge at x=640
+    detections = make_detections([620.0, 610.0], [300.0, 300.0], w=[40.0, 80.0], h=[80.0, 80.0],
+                                 conf=[0.8, 0.7], tile=[LEFT, RIGHT])
+    assert deduplicate_nms(detections, TILE, OVERLAP).conf.tolist() == [0.8]
+
+
+def test_same_tile_other_class_and_interior_boxes_are_kept():
+    detections = make_detections(
+        [605.0, 607.0, 606.0, 300.0, 302.0], [300.0, 300.0, 301.0, 300.0, 300.0],
+        conf=[0.9, 0.8, 0.7, 0.6, 0.5], cls=[0, 0, 1, 0, 0], tile=[LEFT, LEFT, RIGHT, LEFT, LEFT])
+    # same-tile overlaps are the detector's own NMS business; interior boxes never meet another tile
+    assert len(deduplicate_nms(detections, TILE, OVERLAP)) == 5
+
+
+def test_suppression_is_greedy_in_confidence_order():
+    # A overlaps B, B overlaps C, A and C are apart: B goes, C survives
+    detections = make_detections([590.0, 600.0, 610.0], [300.0, 300.0, 300.0], w=30.0, h=30.0,
+                                 conf=[0.9, 0.8, 0.7], tile=[LEFT, RIGHT, LEFT])
+    assert deduplicate_nms(detections, TILE, OVERLAP).conf.tolist() == [0.9, 0.7]
+
+
+def test_outlier_box_still_finds_overlaps(rng):
+    n = 200
+    x = np.concatenate([rng.uniform(590, 626, n), [608.0]])
+    y = np.concatenate([rng.uniform(100, 4900, n), [2500.0]])
+    w = np.concatenate([np.full(n, 20.0), [60.0]])
+    h = np.concatenate([np.full(n, 20.0), [5000.0]])
+    conf = np.concatenate([rng.uniform(0, 0.5, n), [0.99]])
+    tile = [LEFT] * n + [RIGHT]
+    kept = deduplicate_nms(make_detections(x, y, w=w, h=h, conf=conf, tile=tile), TILE, OVERLAP)
+    # every small box lies inside the tall one, so containment removes them all
+    assert kept.conf.tolist() == [0.99]
+
+
+def test_nms_without_overlap_is_rejected():
+    with pytest.raises(ValueError):
+        deduplicate(make_detections([1.0], [1.0]), "nms", TILE, 0)
@@ -0,0 +1,43 @@
+import numpy as np
+
+from conftest import assert_same, make_detections
+from deduplicate_detections import EPS, deduplicate, deduplicate_dbscan, deduplicate_partitioned
+
+
+def test_matches_dbscan_on_scattered_points(rng):
+    n = 3000
+    detections = make_detections(rng.uniform(0, 2000, n), rng.uniform(0, 2000, n), conf=rng.uniform(0, 1, n))
+    assert_same(deduplicate_partitioned(detections, block_size=256, max_workers=2),
+                deduplicate_dbscan(detections))
+
+
+def test_clusters_straddling_block_edges_are_joined():
+    # Chains of points under EPS apart cross a vertical edge, a horizontal
+    # edge and a corner; each stays one cluster only if the halos stitch
+    # the blocks together
+    block = 500
+    step = EPS * 0.9
+    chain = np.arange(-4, 5) * step
+    diagonal = block + chain / np.sqrt(2)
+    x = np.concatenate([block + chain, np.full(9, 250.0), diagonal])
+    y = np.concatenate([np.full(9, 250.0), block + chain, diagonal])
+    detections = make_detections(x, y, conf=np.linspace(0.2, 0.9, len(x)))
+
+    partitioned = deduplicate_partitioned(detections, block_size=block, max_workers=2)
+    assert_same(partitioned, deduplicate_dbscan(detections))
+    assert len(partitioned) == 3  # one survivor per chain
+
+
+def test_single_block_and_empty_input():
+    detections = make_detections([10.0, 15.0, 400.0], [10.0, 12.0, 400.0])
+    assert_same(deduplicate_partitioned(detections, block_size=4096), deduplicate_dbscan(detections))
+    assert len(deduplicate_partitioned(make_detections([], []))) == 0
+
+
+def test_dispatcher_forwards_eps_and_block_size():
+    # Points 50 px apart merge only with a non-default eps
+    x = np.array([100.0, 150.0, 600.0, 650.0])
+    detections = make_detections(x, np.full(4, 100.0))
+    assert len(deduplicate(detections, "partitioned", max_workers=2, eps=60, block_size=512)) == 2
+    assert len(deduplicate(detections, "partitioned", max_workers=2, block_size=512)) == 4
+    assert len(deduplicate(detections, "dbscan", eps=60)) == 2
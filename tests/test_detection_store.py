@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from conftest import assert_same, make_detections
+from stage_types import Detections, detection_meta, read_detections
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_det_round_trip(tmp_path, rng, mmap):
+    n = 1001  # not a multiple of the column alignment
+    tiles = [f"img_tile_{640 * (i // 100)}_0.jpg" for i in range(n)]
+    detections = make_detections(rng.uniform(0, 9000, n), rng.uniform(0, 9000, n), w=rng.uniform(10, 80, n),
+                                 h=rng.uniform(10, 80, n), conf=rng.uniform(0, 1, n), cls=rng.integers(0, 2, n),
+                                 tile=tiles)
+    path = str(tmp_path / "detections.det")
+    detections.save(path, meta={"image_width": 9000, "image_height": 9000})
+
+    assert_same(Detections.load(path, mmap=mmap), detections)
+    assert detection_meta(path) == {"image_width": 9000, "image_height": 9000}
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_empty_store_and_csv_agree(tmp_path):
+    path = str(tmp_path / "empty.det")
+    Detections().save(path)
+    assert len(read_detections(path)) == 0
+
+    detections = make_detections([1.5, 2.5], [3.5, 4.5], cls=[0, 1], tile=["a_tile_0_0.jpg", "a_tile_640_0.jpg"])
+    det_path, csv_path = str(tmp_path / "d.det"), str(tmp_path / "d.csv")
+    detections.save(det_path)
+    detections.to_csv(csv_path)
+    assert_same(read_detections(det_path), read_detections(csv_path))
+
+
+def test_foreign_file_is_rejected(tmp_path):
+    path = tmp_path / "not.det"
+    path.write_bytes(b"Tile,Class\n")
+    with pytest.raises(ValueError):
+        Detections.load(str(path))
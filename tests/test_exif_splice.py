@@ -0,0 +1,86 @@
+import numpy as np
+import piexif
+import pytest
+from PIL import Image
+
+from inject_exif_to_merged import EXIF_HEADER, exif_segment, inject_exif, jpeg_header, splice_exif
+
+GPS = {piexif.GPSIFD.GPSLatitudeRef: b"N", piexif.GPSIFD.GPSLatitude: ((3, 1), (8, 1), (1234, 100)),
+       piexif.GPSIFD.GPSLongitudeRef: b"E", piexif.GPSIFD.GPSLongitude: ((101, 1), (42, 1), (5, 1))}
+
+
+def write_jpeg(path, size=(320, 200), exif=None, seed=0):
+    pixels = np.random.default_rng(seed).integers(0, 255, (size[1], size[0], 3), dtype=np.uint8)
+    kwargs = {"exif": exif} if exif else {}
+    Image.fromarray(pixels).save(path, "JPEG", quality=90, **kwargs)
+    return path
+
+
+def scan_bytes(path):
+    with open(path, "rb") as f:
+        _, _, scan_start = jpeg_header(f)
+        f.seek(scan_start)
+        return f.read()
+
+
+def exif_segments(path):
+    with open(path, "rb") as f:
+        segments, _, _ = jpeg_header(f)
+        f.seek(0)
+        data = f.read()
+    return [s for m, s, e in segments if m == 0xE1 and data[s + 4:s + 4 + len(EXIF_HEADER)] == EXIF_HEADER]
+
+
+@pytest.fixture
+def source(tmp_path):
+    # A flight photo with GPS and a thumbnail
+    thumbnail = write_jpeg(str(tmp_path / "thumb.jpg"), size=(32, 20), seed=2)
+    with open(thumbnail, "rb") as f:
+        exif = piexif.dump({"0th": {piexif.ImageIFD.Make: b"Drone"}, "GPS": GPS,
+                            "1st": {piexif.ImageIFD.Compression: 6}, "thumbnail": f.read()})
+    return write_jpeg(str(tmp_path / "source.jpg"), exif=exif, seed=1)
+
+
+def test_splice_keeps_scan_bytes(tmp_path, source):
+    merged = write_jpeg(str(tmp_path / "merged.jpg"))
+    output = str(tmp_path / "merged_with_exif.jpg")
+    assert piexif.load(source)["thumbnail"]
+    assert inject_exif(source, merged, output)
+
+    assert scan_bytes(output) == scan_bytes(merged)
+    assert len(exif_segments(output)) == 1
+    with Image.open(merged) as a, Image.open(output) as b:
+        assert np.array_equal(np.asarray(a), np.asarray(b))
+
+    exif = piexif.load(output)
+    assert exif["GPS"][piexif.GPSIFD.GPSLatitude] == GPS[piexif.GPSIFD.GPSLatitude]
+    assert exif["Exif"][piexif.ExifIFD.PixelXDimension] == 320
+    assert exif["Exif"][piexif.ExifIFD.PixelYDimension] == 200
+    assert exif["thumbnail"] is None
+
+
+def test_splice_replaces_existing_exif(tmp_path):
+    old = piexif.dump({"0th": {piexif.ImageIFD.Make: b"Stale"}, "GPS": {}})
+    merged = write_jpeg(str(tmp_path / "merged.jpg"), exif=old)
+    output = str(tmp_path / "out.jpg")
+    splice_exif(merged, exif_segment({"0th": {}, "Exif": {}, "GPS": GPS}, (320, 200)), output)
+
+    assert scan_bytes(output) == scan_bytes(merged)
+    assert len(exif_segments(output)) == 1
+    exif = piexif.load(output)
+    assert piexif.ImageIFD.Make not in exif["0th"]
+    assert exif["GPS"][piexif.GPSIFD.GPSLongitude] == GPS[piexif.GPSIFD.GPSLongitude]
+
+
+def test_splice_in_place(tmp_path):
+    merged = write_jpeg(str(tmp_path / "merged.jpg"))
+    before = scan_bytes(merged)
+    splice_exif(merged, exif_segment({"GPS": GPS}), merged)
+    assert scan_bytes(merged) == before
+    assert len(exif_segments(merged)) == 1
+
+
+def test_source_without_gps_is_skipped(tmp_path):
+    plain = write_jpeg(str(tmp_path / "plain.jpg"))
+    merged = write_jpeg(str(tmp_path / "merged.jpg"))
+    assert not inject_exif(plain, merged, str(tmp_path / "out.jpg"))
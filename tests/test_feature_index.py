@@ -0,0 +1,73 @@
+import json
+
+import numpy as np
+import pytest
+
+from conftest import make_detections
+from export_geojson import export_geojson
+from feature_index import FeatureIndex
+
+HEIGHT = 5000
+
+
+def brute_force(x, y, bbox):
+    west, south, east, north = bbox
+    return set(np.flatnonzero((x >= west) & (x <= east) & (y >= south) & (y <= north)).tolist())
+
+
+def random_bboxes(rng, count=200, extent=6000):
+    # Viewports of every size, some hanging off the data or missing it entirely
+    corner = rng.uniform(-1000, extent, (count, 2))
+    size = rng.uniform(0, extent / 2, (count, 2)) ** rng.uniform(0.5, 1, (count, 1))
+    return [tuple(float(v) for v in (cx, cy, cx + w, cy + h)) for (cx, cy), (w, h) in zip(corner, size)]
+
+
+@pytest.fixture
+def exported(tmp_path, rng):
+    # Clustered plantation blocks plus scattered palms, as the pipeline exports them
+    n = 4000
+    centres = rng.uniform(0, HEIGHT, (8, 2))
+    block = centres[rng.integers(0, 8, n)] + rng.normal(0, 150, (n, 2))
+    x = np.where(rng.random(n) < 0.2, rng.uniform(0, HEIGHT, n), block[:, 0])
+    y = np.where(rng.random(n) < 0.2, rng.uniform(0, HEIGHT, n), block[:, 1])
+    detections = make_detections(x, y, cls=rng.integers(0, 2, n))
+    path = export_geojson(detections, HEIGHT, str(tmp_path / "detections.geojson"))
+    index = FeatureIndex(path)
+    index.refresh()
+    return index, detections.x, HEIGHT - detections.y  # ids are row numbers, positions as displayed
+
+
+def response_ids(index, bbox):
+    body, _ = index.response(bbox)
+    return sorted(feature["id"] for feature in json.loads(body)["features"])
+
+
+def test_grid_query_matches_brute_force(exported, rng):
+    index, px, py = exported
+    for bbox in random_bboxes(rng) + [(0.0, 0.0, 0.0, 0.0), (-50.0, -50.0, 1e9, 1e9)]:
+        assert set(index.ids[index.query(bbox)].tolist()) == brute_force(px, py, bbox), bbox
+
+
+def test_query_edges_are_inclusive(exported):
+    index, px, py = exported
+    x, y = float(px[7]), float(py[7])
+    assert 7 in index.ids[index.query((x, y, x, y))].tolist()
+
+
+def test_responses_follow_edits(exported, rng):
+    # Moved, added and deleted features are found where they are now, not
+    # where the base grid had them
+    index, px, py = exported
+    px, py = px.copy(), py.copy()
+    index.apply([{"op": "move", "id": 0, "coordinates": [4900.0, 10.0]}, {"op": "delete", "id": 1}])
+    added = index.apply([{"op": "add", "feature": {"type": "Feature",
+                                                   "geometry": {"type": "Point", "coordinates": [25.0, 4975.0]},
+                                                   "properties": {"class": "VOP"}}}])[0]
+    px[0], py[0] = 4900.0, 10.0
+    px[1] = py[1] = np.nan
+    px, py = np.append(px, 25.0), np.append(py, 4975.0)
+    assert added == len(px) - 1
+
+    for bbox in random_bboxes(rng, 50) + [(4800.0, 0.0, 5000.0, 100.0), (0.0, 4900.0, 100.0, 5000.0)]:
+        assert response_ids(index, bbox) == sorted(brute_force(px, py, bbox)), bbox
+    assert response_ids(index, None) == sorted(set(range(len(px))) - {1})
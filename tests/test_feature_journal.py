@@ -0,0 +1,122 @@
+import json
+import os
+
+import pytest
+
+from feature_index import FeatureIndex
+
+
+def point(x, y, cls="Oil Palm", **props):
+    return {"type": "Feature", "geometry": {"type": "Point", "coordinates": [x, y]},
+            "properties": dict(props, **{"class": cls})}
+
+
+def write_collection(path, features, **members):
+    with open(path, "w") as f:
+        json.dump(dict({"type": "FeatureCollection"}, **members, features=features), f)
+
+
+def state(index):
+    return sorted((f["id"], f["properties"]["class"], tuple(f["geometry"]["coordinates"]))
+                  for f in index.merged_features())
+
+
+@pytest.fixture
+def geojson(tmp_path):
+    path = str(tmp_path / "detections.geojson")
+    write_collection(path, [point(10, 10), point(20, 20), point(30, 30, "VOP")])
+    return path
+
+
+def edit_session(path):
+    index = FeatureIndex(path)
+    index.refresh()
+    added = index.apply([{"op": "add", "feature": point(40, 40)}])[0]
+    index.apply([{"op": "move", "id": 0, "coordinates": [11, 12]}, {"op": "reclassify", "id": 1, "class": "VOP"},
+                 {"op": "delete", "id": 2}])
+    return index, added
+
+
+def test_journal_replays_in_a_new_process(geojson):
+    index, added = edit_session(geojson)
+    assert added == 3
+    assert os.path.exists(index.journal_path)
+
+    reopened = FeatureIndex(geojson)
+    reopened.refresh()
+    assert state(reopened) == state(index) == [
+        (0, "Oil Palm", (11.0, 12.0)), (1, "VOP", (20, 20)), (3, "Oil Palm", (40, 40))]
+
+
+def test_torn_last_line_is_not_applied(geojson):
+    index, _ = edit_session(geojson)
+    with open(index.journal_path, "ab") as f:
+        f.write(b'{"op":"delete","id":0')
+    reopened = FeatureIndex(geojson)
+    reopened.refresh()
+    assert state(reopened) == state(index)
+
+
+def test_rejected_batch_leaves_no_trace(geojson):
+    index, _ = edit_session(geojson)
+    before = state(index), os.path.getsize(index.journal_path)
+    with pytest.raises(KeyError):
+        index.apply([{"op": "reclassify", "id": 0, "class": "VOP"}, {"op": "delete", "id": 99}])
+    assert (state(index), os.path.getsize(index.journal_path)) == before
+
+
+def test_compaction_folds_the_journal_into_the_base(geojson):
+    index, _ = edit_session(geojson)
+    expected = state(index)
+    index.compact()
+
+    assert not os.path.exists(index.journal_path) and not os.path.exists(index.compacting_path)
+    with open(geojson) as f:
+        saved = json.load(f)["features"]
+    assert sorted(f["id"] for f in saved) == [0, 1, 3]
+
+    reopened = FeatureIndex(geojson)
+    reopened.refresh()
+    assert state(reopened) == expected
+    # Ids keep counting past the compacted ones
+    assert reopened.apply([{"op": "add", "feature": point(50, 50)}]) == [4]
+
+
+def test_interrupted_compaction_is_replayed(geojson):
+    index, _ = edit_session(geojson)
+    expected = state(index)
+    os.replace(index.journal_path, index.compacting_path)  # crash after rotating the journal
+
+    reopened = FeatureIndex(geojson)
+    reopened.refresh()
+    assert state(reopened) == expected
+
+
+def test_georeferenced_moves_keep_both_spaces(tmp_path):
+    # px/py is the image position; geometry comes from the display affine
+    path = str(tmp_path / "geo.geojson")
+    georef = {"transform": [0.5, 0.0, 1000.0, 0.0, 0.5, 2000.0], "crs": "EPSG:32648"}
+    crs = {"type": "name", "properties": {"name": "EPSG:32648"}}
+    write_collection(path, [point(1005.0, 2005.0, px=10.0, py=10.0)], crs=crs, georef=georef)
+    index = FeatureIndex(path)
+    index.refresh()
+
+    index.apply([{"op": "move", "id": 0, "coordinates": [20, 40]}])
+    added = index.apply([{"op": "add", "feature": point(100, 200)}])[0]
+    moved, new = index.get(0), index.get(added)
+    assert (moved["properties"]["px"], moved["properties"]["py"]) == (20.0, 40.0)
+    assert moved["geometry"]["coordinates"] == [1010.0, 2020.0]
+    assert (new["properties"]["px"], new["properties"]["py"]) == (100.0, 200.0)
+    assert new["geometry"]["coordinates"] == [1050.0, 2100.0]
+
+    index.compact()
+    with open(path) as f:
+        saved = json.load(f)
+    assert saved["georef"] == georef and saved["crs"] == crs
+
+
+def test_replace_all_rejects_a_non_collection(geojson):
+    index = FeatureIndex(geojson)
+    with pytest.raises(ValueError):
+        index.replace_all(None)
+    assert index.replace_all({"features": [point(1, 1)]}) == 1
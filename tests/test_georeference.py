@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import Affine
+
+from conftest import make_detections
+from feature_index import map_projection
+from georeference import display_transform, georeference, pixel_to_world, reproject
+from stage_types import Tile
+
+# UTM 47N at 10 cm: pixel (1000, 500) lands on easting 500000 (the zone's
+# 99°E central meridian) and northing 0 (the equator)
+CRS = "EPSG:32647"
+TRANSFORM = Affine(0.1, 0.0, 499900.0, 0.0, -0.1, 50.0)
+CONTROL_PIXEL = (1000.0, 500.0)
+CONTROL_WORLD = (500000.0, 0.0)
+CONTROL_LONLAT = (99.0, 0.0)
+HEIGHT = 800
+
+
+@pytest.fixture
+def geotiff(tmp_path):
+    path = str(tmp_path / "ortho.tif")
+    with rasterio.open(path, "w", driver="GTiff", width=4, height=4, count=1, dtype="uint8",
+                       crs=CRS, transform=TRANSFORM) as dst:
+        dst.write(np.zeros((1, 4, 4), dtype=np.uint8))
+    return path
+
+
+def test_control_point_through_the_affine():
+    x, y = pixel_to_world(np.array([CONTROL_PIXEL[0]]), np.array([CONTROL_PIXEL[1]]), TRANSFORM)
+    np.testing.assert_allclose([x[0], y[0]], CONTROL_WORLD)
+
+
+@pytest.mark.parametrize("target, expected, crs", [("native", CONTROL_WORLD, CRS),
+                                                   ("wgs84", CONTROL_LONLAT, "EPSG:4326")])
+def test_control_point_through_georeference(geotiff, target, expected, crs):
+    detections = make_detections([CONTROL_PIXEL[0], 0.0], [CONTROL_PIXEL[1], 0.0])
+    tiles = [Tile("image_tile_0_0.jpg", 0, 0, 640, 640, source=geotiff)]
+    xs, ys, out_crs = georeference(detections, tiles, target)
+    assert out_crs == crs
+    np.testing.assert_allclose([xs[0], ys[0]], expected, atol=1e-9)
+
+
+def test_pixel_target_keeps_pixels(geotiff):
+    tiles = [Tile("image_tile_0_0.jpg", 0, 0, 640, 640, source=geotiff)]
+    assert georeference(make_detections([1.0], [1.0]), tiles, "none") is None
+
+
+def test_batched_reprojection_matches_one_pass(rng):
+    n = 1000
+    xs, ys = rng.uniform(400000, 600000, n), rng.uniform(-50000, 50000, n)
+    one_x, one_y = reproject(xs, ys, CRS, chunk=n)
+    batched_x, batched_y = reproject(xs, ys, CRS, chunk=64)
+    np.testing.assert_array_equal(batched_x, one_x)
+    np.testing.assert_array_equal(batched_y, one_y)
+
+    # Along the central meridian longitude is exact, and latitude grows with northing
+    meridian_x, meridian_y = reproject(np.full(5, 500000.0), np.linspace(0, 40000, 5), CRS, chunk=2)
+    np.testing.assert_allclose(meridian_x, 99.0, atol=1e-9)
+    assert meridian_y[0] == pytest.approx(0.0, abs=1e-9) and np.all(np.diff(meridian_y) > 0)
+
+
+def test_display_transform_maps_exported_px_py(rng):
+    # The exports' (px, py) = (x, height - y) through the display affine lands
+    # where the pixel position does through the source affine
+    x, y = rng.uniform(0, 2000, 50), rng.uniform(0, HEIGHT, 50)
+    display = display_transform(TRANSFORM, HEIGHT)
+    np.testing.assert_allclose(pixel_to_world(x, HEIGHT - y, display), pixel_to_world(x, y, TRANSFORM))
+
+
+def test_gui_projection_reaches_the_control_point():
+    members = {"georef": {"transform": display_transform(TRANSFORM, HEIGHT), "crs": CRS}}
+    px, py = CONTROL_PIXEL[0], HEIGHT - CONTROL_PIXEL[1]
+    np.testing.assert_allclose(map_projection(members)(px, py), CONTROL_LONLAT, atol=1e-9)
+    members["crs"] = {"type": "name", "properties": {"name": CRS}}
+    np.testing.assert_allclose(map_projection(members)(px, py), CONTROL_WORLD)
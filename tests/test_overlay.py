@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from conftest import make_detections
+from overlay import MARKER_RADIUS, overlay_array, overlay_image
+
+SIZE = (300, 200)
+
+
+def reference(detections, size=SIZE, radius=MARKER_RADIUS):
+    # The drawing the overlay replaces: one draw.ellipse per row, in row order
+    img = Image.new("RGB", size)
+    draw = ImageDraw.Draw(img)
+    for x, y, cls in zip(detections.x.tolist(), detections.y.tolist(), detections.cls.tolist()):
+        color = "red" if cls == 0 else "blue"
+        draw.ellipse([(x - radius, y - radius), (x + radius, y + radius)], fill=color, outline=color)
+    return np.asarray(img)
+
+
+CASES = {
+    "interior": ([150.3], [100.7], [0]),
+    # VOP under Oil Palm and Oil Palm under VOP: the later row stays on top
+    "overlapping": ([100.2, 110.6, 200.4, 190.1], [80.5, 85.3, 120.8, 118.2], [1, 0, 0, 1]),
+    "edge": ([3.4, 296.8, 150.5, 60.2, -4.0], [100.1, 50.6, 1.7, 197.3, 3.9], [0, 1, 0, 1, 0]),
+}
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_overlay_image_matches_draw_ellipse(case):
+    x, y, cls = CASES[case]
+    detections = make_detections(x, y, cls=cls)
+    stamped = overlay_image(Image.new("RGB", SIZE), detections, block_size=64)
+    np.testing.assert_array_equal(np.asarray(stamped), reference(detections))
+
+
+def test_overlay_array_matches_per_strip_drawing(rng):
+    # Pyramid strips were drawn one at a time, so markers are clipped at the
+    # strip edges too
+    n = 400
+    detections = make_detections(rng.uniform(-5, 305, n), rng.uniform(-5, 405, n), cls=rng.integers(0, 2, n))
+    detections = detections.take(np.argsort(detections.y, kind="stable"))
+    y0 = 100
+    strip = np.zeros((SIZE[1], SIZE[0], 3), dtype=np.uint8)
+    overlay_array(strip, detections, 0, y0, block_size=64)
+
+    shifted = make_detections(detections.x, detections.y - y0, cls=detections.cls)
+    np.testing.assert_array_equal(strip, reference(shifted))
+
+
+def test_random_markers_match(rng):
+    n = 400
+    detections = make_detections(rng.uniform(-10, 310, n), rng.uniform(-10, 210, n), cls=rng.integers(0, 2, n))
+    stamped = overlay_image(Image.new("RGB", SIZE), detections, block_size=64)
+    np.testing.assert_array_equal(np.asarray(stamped), reference(detections))